@@ -144,19 +144,14 @@ const LikesPageContent = () => {
     const targetSlackId = targetUserData.slack_id;
 
     try {
-      const response = await axios.get(`${CLOUD_RUN_URL}/connect_dm?slack_id1=${mySlackId}&slack_id2=${targetSlackId}`);
-      const response_common = await axios.get(`${CLOUD_RUN_URL}/common_attributes?user_id1=${userId}&user_id2=${user.user_id}`);
-      const response_bot = await axios.get(`${CLOUD_RUN_URL}/send-greeting?user1_slack_id=${mySlackId}&user2_slack_id=${targetSlackId}&common_point=出身地`);
-      
+      // DM作成・共通点の取得・挨拶メッセージ送信をまとめて行う
+      const response = await axios.get(`${CLOUD_RUN_URL}/on_match?user_id1=${userId}&user_id2=${user.user_id}&slack_id1=${mySlackId}&slack_id2=${targetSlackId}`);
+
       if (response.status === 200) {
         window.location.href = response.data.URL;
       } else {
         console.error("Slack リダイレクトエラー:", response.data);
       }
-      
-      if (response_bot.status == 422) {
-        window.location.href = response_bot.data.URL;
-      }
     } catch (error) {
       console.error("Slack API エラー:", error);
     }    
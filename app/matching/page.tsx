@@ -31,7 +31,7 @@ const MatchingPageContent = () => {
       if (index === messages.length - 1) {
         setTimeout(async () => {
           try {
-            const response = await axios.get(`${CLOUD_RUN_URL}/matching_result?user_id=${userId}`); 
+            const response = await axios.get(`${CLOUD_RUN_URL}/matching_result?user_id=${userId}&exclude_liked=true`); 
             const userIds = response.data.matches
               .map((match: any) => match.user_id)
               .join('&user_ids=');
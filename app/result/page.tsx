@@ -113,6 +113,12 @@ const MatchingResult = () => {
       //alert(error.message);
       alert("いいねの保存に失敗しました。");
     } else {
+      // バックエンドのいいね情報（絞り込み用）を更新。失敗してもいいね自体は保存済み
+      try {
+        await axios.post(`${CLOUD_RUN_URL}/like_graph/add?user_id=${userId}&target_user_id=${targetUserId}`);
+      } catch (e) {
+        console.log("Error updating like graph:", e);
+      }
       alert("いいねを保存しました！");
     }
   };
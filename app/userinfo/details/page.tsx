@@ -8,6 +8,8 @@ import {
   Heading, Select, Stack, VStack, Card, CardBody, CardHeader, Tag, TagLabel, TagCloseButton, Input
 } from '@chakra-ui/react';
 import { User } from 'lucide-react';
+import axios from 'axios';
+import { CLOUD_RUN_URL } from '@/utils/config';
 
 const supabase = createClient(
   process.env.NEXT_PUBLIC_SUPABASE_URL!,
@@ -159,6 +161,13 @@ function SearchParamsWrapper({ router }: { router: any }) {
       return;
     }
 
+    // バックエンドの属性キャッシュを更新。失敗してもプロフィール自体は保存済み
+    try {
+      await axios.post(`${CLOUD_RUN_URL}/attribute_store/invalidate?user_id=${userId}`);
+    } catch (e) {
+      console.log("Error invalidating attribute store:", e);
+    }
+
     alert("プロフィールを更新しました！");
     router.push(`/matching?userId=${userId}`);
   };
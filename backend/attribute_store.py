@@ -0,0 +1,305 @@
+import threading
+import time
+from concurrent.futures import Future
+from repository import repository
+from config import ATTRIBUTE_STORE_TTL_SECONDS
+from match_scoring import EncodedUsers
+from feature_store import MATCHING_FIELDS, feature_store
+
+
+class AttributeStore:
+    """user_attributes と users.cluster のスナップショットをメモリ上に保持する
+
+    - 初回アクセス時と TTL 経過後に全件を取り直す（MATCHING_FIELDS の列だけを user_id 順のページに分けて読む）
+      TTL 経過後はバックグラウンドで取り直し、その間は古いスナップショットを返す。読み込みは同時に1回だけ行う
+    - 取り直している間に書き込み側が更新したユーザーは、読み込んだ行で上書きしない
+    - 書き込み側は refresh_user / remove_user / set_clusters で該当ユーザーだけを更新する
+    - マッチング用のエンコード結果もここでキャッシュし、変更があったときだけ作り直す
+    """
+
+    def __init__(self, repository, ttl_seconds: float = ATTRIBUTE_STORE_TTL_SECONDS, columns: tuple = tuple(MATCHING_FIELDS)):
+        self.repository = repository
+        self.columns = columns
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.RLock()
+
+        self.rows = {}       # user_id -> user_attributes の行
+        self.clusters = {}   # user_id -> cluster
+        self.loaded_at = None
+        self.version = 0     # スナップショットが変わるたびに増やす
+        self.changed_at = 0.0  # 属性の内容が最後に変わった時刻（UNIX 秒）
+        self.changes = 0       # 属性の内容が変わった回数
+        self.clusters_version = 0  # クラスタの割り当てが変わるたびに増やす
+
+        # 全件の取り直し（同時に1回だけ）と、その間に書き込み側が更新したもの
+        self._reloading = None     # 実行中の取り直しの Future
+        self._generation = 0       # invalidate のたびに増やす（それより前に始まった取り直しでは loaded_at を進めない）
+        self._writes = 0           # 書き込み側の更新の通し番号
+        self._modified = {}        # user_id -> 属性を最後に更新したときの通し番号
+        self._clusters_modified = {}  # user_id -> クラスタを最後に更新したときの通し番号
+        self._clusters_replaced = 0   # クラスタを丸ごと入れ替えたときの通し番号
+
+        self._encoded = None
+        self._encoded_version = -1
+        self._positions = {}
+
+        # 計測用カウンタ
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.last_refresh_seconds = 0.0
+        self.total_refresh_seconds = 0.0
+        self.reloads = 0
+        self.background_reloads = 0
+        self.last_reload_error = None
+
+    # ---------- 読み込み ----------
+
+    def reload(self):
+        """データベースから全件を取り直す（実行中の取り直しがあれば、新しく始めずにそれが終わるのを待つ）"""
+        with self.lock:
+            future = self._reloading
+            owner = future is None
+            if owner:
+                future, started_write, generation = self._begin_reload()
+        if owner:
+            self._run_reload(future, started_write, generation)
+        future.result()
+
+    def _begin_reload(self) -> tuple:
+        """取り直しを始めたことにして、その時点の書き込みの通し番号と世代を返す（lock の中で呼ぶ）"""
+        self._reloading = Future()
+        return self._reloading, self._writes, self._generation
+
+    def _run_reload(self, future: Future, started_write: int, generation: int):
+        try:
+            self._load(started_write, generation)
+        except Exception as e:
+            with self.lock:
+                self._reloading = None
+                self.last_reload_error = str(e)
+            future.set_exception(e)
+        else:
+            with self.lock:
+                self._reloading = None
+                self.last_reload_error = None
+            future.set_result(None)
+
+    def _load(self, started_write: int, generation: int):
+        started = time.perf_counter()
+        rows = {}
+        for page in self.repository.attribute_pages(columns=self.columns):
+            rows.update((row["user_id"], row) for row in page)
+        clusters = {user_id: cluster for user_id, cluster in self.repository.user_clusters().items() if cluster is not None}
+        elapsed = time.perf_counter() - started
+
+        with self.lock:
+            # 読み込み中に更新されたユーザーは、今のスナップショットの値（削除済みなら無し）を残す
+            for user_id, written in self._modified.items():
+                if written > started_write:
+                    if user_id in self.rows:
+                        rows[user_id] = self.rows[user_id]
+                    else:
+                        rows.pop(user_id, None)
+            if self._clusters_replaced > started_write:
+                clusters = dict(self.clusters)
+            else:
+                for user_id, written in self._clusters_modified.items():
+                    if written > started_write:
+                        if user_id in self.clusters:
+                            clusters[user_id] = self.clusters[user_id]
+                        else:
+                            clusters.pop(user_id, None)
+            self._modified = {}
+            self._clusters_modified = {}
+
+            # 初回の読み込みは「変更」とみなさない
+            if self.rows and rows != self.rows:
+                self.changed_at = time.time()
+                self.changes += 1
+            self.rows = rows
+            self.clusters = clusters
+            self.clusters_version += 1
+            # 読み込み中に invalidate されたら、次のアクセスでもう一度取り直す
+            if generation == self._generation:
+                self.loaded_at = time.monotonic()
+            self.version += 1
+            self.reloads += 1
+            self.refreshes += 1
+            self.last_refresh_seconds = elapsed
+            self.total_refresh_seconds += elapsed
+
+    def _ensure_loaded(self):
+        """まだ読み込んでいなければ読み込みを待ち、TTL を過ぎていればバックグラウンドで取り直す"""
+        while True:
+            with self.lock:
+                if self.loaded_at is None:
+                    pass
+                elif time.monotonic() - self.loaded_at <= self.ttl_seconds or self._reloading is not None:
+                    return
+                else:
+                    self.background_reloads += 1
+                    threading.Thread(target=self._run_reload, args=self._begin_reload(), daemon=True).start()
+                    return
+            self.reload()
+
+    def _touch(self, user_id: str, clusters: bool = True):
+        """書き込み側の更新を記録する（lock の中で呼ぶ）"""
+        self._writes += 1
+        self._modified[user_id] = self._writes
+        if clusters:
+            self._clusters_modified[user_id] = self._writes
+
+    def get(self, user_id: str):
+        """1ユーザー分の属性を返す（スナップショットに無ければ Supabase に問い合わせる）"""
+        self._ensure_loaded()
+        with self.lock:
+            row = self.rows.get(user_id)
+            if row is not None:
+                self.hits += 1
+                return row
+            self.misses += 1
+        return self.refresh_user(user_id)
+
+    def get_many(self, user_ids: list) -> dict:
+        """複数ユーザーの属性を user_id -> 行 で返す（スナップショットに無い分は1回の問い合わせで取得）"""
+        self._ensure_loaded()
+        with self.lock:
+            found = {user_id: self.rows[user_id] for user_id in user_ids if user_id in self.rows}
+            missing = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in found]
+            self.hits += len(found)
+            self.misses += len(missing)
+        if not missing:
+            return found
+
+        attributes = self.repository.attributes(missing, self.columns)
+        with self.lock:
+            for row in attributes:
+                self.rows[row["user_id"]] = row
+                self._touch(row["user_id"], clusters=False)
+                found[row["user_id"]] = row
+            if attributes:
+                self.version += 1
+                self.changed_at = time.time()
+                self.changes += 1
+        return found
+
+    def all(self) -> list:
+        """全ユーザーの属性を返す"""
+        self._ensure_loaded()
+        with self.lock:
+            self.hits += 1
+            return list(self.rows.values())
+
+    def others(self, user_id: str) -> list:
+        """指定したユーザー以外の属性を返す"""
+        return [row for row in self.all() if row["user_id"] != user_id]
+
+    def cluster_assignments(self) -> dict:
+        """user_id -> cluster の対応を返す（未割り当てのユーザーは含まない）"""
+        self._ensure_loaded()
+        with self.lock:
+            self.hits += 1
+            return dict(self.clusters)
+
+    def encoded(self):
+        """全ユーザーをエンコードした EncodedUsers と user_id -> 行番号の辞書を返す"""
+        self._ensure_loaded()
+        with self.lock:
+            if self._encoded_version != self.version:
+                self._encoded = EncodedUsers(list(self.rows.values()))
+                self._positions = {user_id: i for i, user_id in enumerate(self._encoded.user_ids)}
+                self._encoded_version = self.version
+            return self._encoded, self._positions
+
+    # ---------- 書き込み側からの無効化 ----------
+
+    def refresh_user(self, user_id: str):
+        """1ユーザー分の属性とクラスタを取り直す（登録・更新後に呼ぶ）"""
+        started = time.perf_counter()
+        attributes = self.repository.attributes([user_id], self.columns)
+        cluster = self.repository.user_clusters([user_id]).get(user_id)
+        elapsed = time.perf_counter() - started
+
+        with self.lock:
+            self._touch(user_id)
+            # 行・クラスタが変わったときだけ版を進める（変わらなければエンコード結果や候補インデックスを作り直さない）
+            if attributes:
+                if self.rows.get(user_id) != attributes[0]:
+                    self.rows[user_id] = attributes[0]
+                    self.version += 1
+                    self.changed_at = time.time()
+                    self.changes += 1
+            elif self.rows.pop(user_id, None) is not None:
+                feature_store.forget(user_id)
+                self.version += 1
+                self.changed_at = time.time()
+                self.changes += 1
+            if self.clusters.get(user_id) != cluster:
+                if cluster is not None:
+                    self.clusters[user_id] = cluster
+                else:
+                    self.clusters.pop(user_id, None)
+                self.clusters_version += 1
+            self.refreshes += 1
+            self.last_refresh_seconds = elapsed
+            self.total_refresh_seconds += elapsed
+            return self.rows.get(user_id)
+
+    def remove_user(self, user_id: str):
+        """削除されたユーザーをスナップショットから外す"""
+        with self.lock:
+            self._touch(user_id)
+            self.rows.pop(user_id, None)
+            self.clusters.pop(user_id, None)
+            feature_store.forget(user_id)
+            self.version += 1
+            self.clusters_version += 1
+            self.changed_at = time.time()
+            self.changes += 1
+
+    def set_clusters(self, assignments: dict):
+        """users.cluster を書き込んだ後に、スナップショット側のクラスタも更新する"""
+        with self.lock:
+            self._writes += 1
+            for user_id in assignments:
+                self._clusters_modified[user_id] = self._writes
+            self.clusters.update(assignments)
+            self.clusters_version += 1
+
+    def replace_clusters(self, assignments: dict):
+        """再クラスタリング後に、スナップショット側のクラスタを丸ごと入れ替える"""
+        with self.lock:
+            self._writes += 1
+            self._clusters_replaced = self._writes
+            self.clusters = dict(assignments)
+            self.clusters_version += 1
+
+    def invalidate(self):
+        """次のアクセスで全件を取り直す（実行中の取り直しは、終わってももう一度取り直す）"""
+        with self.lock:
+            self.loaded_at = None
+            self._generation += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "users": len(self.rows),
+                "version": self.version,
+                "changed_at": self.changed_at,
+                "changes": self.changes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "reloads": self.reloads,
+                "background_reloads": self.background_reloads,
+                "reloading": self._reloading is not None,
+                "last_reload_error": self.last_reload_error,
+                "last_refresh_seconds": self.last_refresh_seconds,
+                "total_refresh_seconds": self.total_refresh_seconds,
+                "age_seconds": None if self.loaded_at is None else time.monotonic() - self.loaded_at,
+                "feature_store": feature_store.stats(),
+            }
+
+
+attribute_store = AttributeStore(repository)
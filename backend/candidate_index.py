@@ -0,0 +1,187 @@
+import threading
+import time
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from attribute_store import attribute_store
+from hobby_similarity import hobby_similarity
+from config import CANDIDATE_INDEX_LISTS, CANDIDATE_INDEX_N_PROBE, CANDIDATE_INDEX_RETRAIN_RATIO
+from match_scoring import CATEGORICAL_COLUMNS, SCORE_COLUMNS, candidate_mask, preference_weights, score_users, top_k_matches
+
+# マッチ度は「対象側のクエリベクトル」と「候補側の特徴量ベクトル」の内積に分解できる
+#   属性:  重み × one-hot(対象) · one-hot(候補)
+#   MBTI:  重み × 相性表[対象]  · one-hot(候補)
+#   趣味:  重み / 3 × Σ趣味ベクトル(対象) · Σ趣味ベクトル(候補)   （類似度行列 = E E^T のため）
+# クラスタごとの特徴量の平均との内積でクラスタを選び（IVF）、候補だけを厳密にスコアリングする
+
+
+def candidate_features(encoded) -> np.ndarray:
+    """候補側の特徴量行列（ユーザー×次元）を作成"""
+    blocks = []
+    for column in CATEGORICAL_COLUMNS:
+        one_hot = np.zeros((len(encoded), len(encoded.vocabularies[column])), dtype=np.float32)
+        # 値が無いユーザー（コード -1）はすべて 0 のまま
+        present = np.flatnonzero(encoded.codes[column] >= 0)
+        one_hot[present, encoded.codes[column][present]] = 1.0
+        blocks.append(one_hot)
+    # 趣味ベクトルの合計（sum pooling）
+    blocks.append((encoded.hobby_counts @ hobby_similarity.vectors).astype(np.float32))
+    return np.hstack(blocks)
+
+
+def query_vector(target_user: dict, encoded) -> np.ndarray:
+    """対象側のクエリベクトルを作成（candidate_features との内積がマッチ度になる）"""
+    weights = preference_weights(target_user.get("preferences", []))
+    blocks = []
+    for column in CATEGORICAL_COLUMNS:
+        block = np.zeros(len(encoded.vocabularies[column]), dtype=np.float32)
+        code = encoded.code(column, target_user[column])
+        weight = weights[SCORE_COLUMNS.index(column)]
+        if code >= 0 and column == "mbti":
+            block[:] = encoded.mbti_compatibility[code] * weight
+        elif code >= 0:
+            block[code] = weight
+        blocks.append(block)
+    pooled = hobby_similarity.vectors[hobby_similarity.to_indices(target_user["hobby_ids"])].sum(axis=0)
+    blocks.append((pooled * weights[SCORE_COLUMNS.index("hobbies")] / 3.0).astype(np.float32))
+    return np.concatenate(blocks)
+
+
+class CandidateIndex:
+    """candidate_features を k-means で粗く量子化した転置ファイル（IVF）インデックス
+
+    - リスト数は既定で √N（users.cluster はクラスタ数が N/3 と多く、重心との比較だけで全件計算と同じくらいかかるため使わない）
+    - 検索では、クエリベクトルとの内積（= リスト内の平均マッチ度）が高い n_probe 個のリストだけを厳密にスコアリングする
+    """
+
+    def __init__(self, encoded, positions: dict, n_lists: int = CANDIDATE_INDEX_LISTS, quantizer=None):
+        """quantizer に前の版の重心を渡すと、k-means を学習し直さずに各ユーザーを最も近い重心に割り当てるだけにする"""
+        self.encoded = encoded
+        self.positions = positions
+        self.user_ids = np.array(encoded.user_ids, dtype=object)  # 候補の行番号からまとめて引けるように
+        self.features = candidate_features(encoded)
+
+        started = time.perf_counter()
+        n_lists = min(len(encoded), n_lists or int(round(np.sqrt(len(encoded)))))
+        if quantizer is not None and quantizer.shape[1] == self.features.shape[1]:
+            # 最も近い重心 = argmax(x·c - |c|²/2)
+            centroids = quantizer
+            labels = np.argmax(self.features @ centroids.T - 0.5 * (centroids ** 2).sum(axis=1), axis=1)
+        elif n_lists > 0:
+            kmeans = MiniBatchKMeans(n_clusters=n_lists, batch_size=4096, random_state=42, n_init=1).fit(self.features)
+            centroids = kmeans.cluster_centers_.astype(np.float32)
+            labels = kmeans.labels_
+        else:
+            centroids = np.zeros((0, self.features.shape[1]), dtype=np.float32)
+            labels = np.zeros(0, dtype=np.intp)
+        self.quantizer = centroids
+        self.trained = centroids is not quantizer
+
+        # リストごとの行番号（行番号順）。空のリストは除く
+        order = np.argsort(labels, kind="stable")
+        sizes = np.bincount(labels, minlength=len(centroids))
+        lists = np.split(order, np.cumsum(sizes)[:-1]) if len(centroids) else []
+        self.lists = [rows for rows in lists if len(rows)]
+        self.centroids = centroids[sizes > 0] if len(centroids) else centroids
+        self.build_seconds = time.perf_counter() - started
+
+    def search(self, target_user: dict, n_probe: int, min_candidates: int = 0, mask=None) -> np.ndarray:
+        """期待マッチ度の高いリストから n_probe 個の候補を集める（min_candidates 人に満たなければリストを足す）
+
+        mask（self.encoded の行ごとの真偽値）が False の行は、数える前に取り除く
+        （絞り込みが厳しくても、条件に合う候補を min_candidates 人集められるように）
+        """
+        query = query_vector(target_user, self.encoded)
+        order = np.argsort(-(self.centroids @ query), kind="stable")
+
+        selected = [np.zeros(0, dtype=np.intp)]
+        total = 0
+        for probed, list_index in enumerate(order):
+            if probed >= n_probe and total >= min_candidates:
+                break
+            rows = self.lists[list_index]
+            if mask is not None:
+                rows = rows[mask[rows]]
+            selected.append(rows)
+            total += len(rows)
+
+        return np.sort(np.concatenate(selected))
+
+
+_index = None
+_index_version = None
+_lock = threading.Lock()
+
+
+def get_candidate_index() -> CandidateIndex:
+    """属性が変わったときだけインデックスを作り直す（スナップショットの版ごとに1回）"""
+    global _index, _index_version
+    encoded, positions = attribute_store.encoded()
+    with _lock:
+        version = attribute_store.version
+        if _index is None or _index_version != version:
+            # 登録・更新のたびに学習し直さないよう、ユーザー数が大きく変わらないうちは前の重心を使い回す
+            quantizer = None
+            if _index is not None and len(_index.quantizer):
+                expected = CANDIDATE_INDEX_LISTS or np.sqrt(len(encoded))
+                if abs(len(_index.quantizer) - expected) <= expected * CANDIDATE_INDEX_RETRAIN_RATIO:
+                    quantizer = _index.quantizer
+            _index = CandidateIndex(encoded, positions, quantizer=quantizer)
+            _index_version = version
+        return _index
+
+
+def search_matches(target_user: dict, k: int, n_probe: int = CANDIDATE_INDEX_N_PROBE, filters=None, exclude_user_ids=()) -> list:
+    """候補を絞り込んでから厳密なマッチ度で上位 k 人を返す
+
+    filters（属性名 -> 値）に合わないユーザーと exclude_user_ids は候補にしない
+    （マスクはインデックスを作ったときのスナップショットの行番号で作る）
+    """
+    index = get_candidate_index()
+    exclude_user_ids = set(exclude_user_ids) | {target_user["user_id"]}
+    exclude_rows = [index.positions[user_id] for user_id in exclude_user_ids if user_id in index.positions]
+    mask = candidate_mask(index.encoded, filters or {}, exclude_rows)
+    rows = index.search(target_user, n_probe, min_candidates=k, mask=mask)
+    scores = score_users(target_user, index.encoded, rows)
+    return top_k_matches(index.user_ids[rows], scores, k)
+
+
+def recall_check(k: int = 5, n_probe: int = CANDIDATE_INDEX_N_PROBE, sample_size: int = 100, seed: int = 0) -> dict:
+    """全件スコアリングの上位 k 人と比べたときの再現率と処理時間を測る"""
+    index = get_candidate_index()
+    encoded = index.encoded
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(encoded), size=min(sample_size, len(encoded)), replace=False)
+
+    exact_seconds = 0.0
+    approx_seconds = 0.0
+    hits = 0
+    total = 0
+    same_top_k = 0
+    for row in sample:
+        target_user = attribute_store.get(encoded.user_ids[row])
+
+        started = time.perf_counter()
+        exact = top_k_matches(encoded.user_ids, score_users(target_user, encoded), k, exclude=[row])
+        exact_seconds += time.perf_counter() - started
+
+        started = time.perf_counter()
+        approx = search_matches(target_user, k, n_probe)
+        approx_seconds += time.perf_counter() - started
+
+        exact_ids = {match["user_id"] for match in exact}
+        hits += len(exact_ids & {match["user_id"] for match in approx})
+        total += len(exact_ids)
+        same_top_k += exact == approx
+
+    return {
+        "users": len(encoded),
+        "lists": len(index.lists),
+        "n_probe": n_probe,
+        "build_seconds": index.build_seconds,
+        "trained": index.trained,
+        "sample_size": len(sample),
+        "recall": hits / total if total else None,
+        "same_top_k_rate": same_top_k / len(sample) if len(sample) else None,
+        "exact_ms_per_query": exact_seconds / len(sample) * 1000 if len(sample) else None,
+        "approx_ms_per_query": approx_seconds / len(sample) * 1000 if len(sample) else None,
+    }
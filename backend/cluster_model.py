@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+import numpy as np
+from scipy import sparse
+from feature_store import CATEGORICAL_COLUMNS, feature_store, feature_vocabularies, one_hot
+from hobby_similarity import hobby_similarity
+from attribute_store import attribute_store
+
+# クラスタリングの結果（エンコーダの語彙とクラスタの重心）を保存するファイル
+CLUSTER_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cluster_model.npz")
+
+
+class ClusterModel:
+    """クラスタリング時の語彙と重心を保持し、新規ユーザーを最も近いクラスタに割り当てる
+
+    特徴量は clustering() と同じく「趣味の multi-hot」+「属性ごとの one-hot」
+    """
+
+    def __init__(self, version: int, hobbies: list, vocabularies: dict, cluster_ids, centroids, created_at: float = None, user_ids=()):
+        self.version = version
+        self.user_ids = list(user_ids)  # 学習に使ったユーザー（新規登録者数の判定に使う）
+        self.created_at = time.time() if created_at is None else created_at
+        self.hobbies = list(hobbies)
+        self.vocabularies = {column: list(vocabularies[column]) for column in CATEGORICAL_COLUMNS}
+        self.cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        self.centroids = np.asarray(centroids, dtype=np.float64)
+
+        # 特徴量の列番号（趣味 → 各属性の順に並べる）
+        self.offsets = {}
+        offset = len(self.hobbies)
+        for column in CATEGORICAL_COLUMNS:
+            self.offsets[column] = offset
+            offset += len(self.vocabularies[column])
+        self.hobby_index = {hobby: i for i, hobby in enumerate(self.hobbies)}
+        self.category_index = {
+            column: {value: self.offsets[column] + i for i, value in enumerate(self.vocabularies[column])}
+            for column in CATEGORICAL_COLUMNS
+        }
+        # ||c - x||^2 = ||c||^2 - 2 c·x + ||x||^2 の ||c||^2 を先に計算しておく
+        self.centroid_norms = (self.centroids ** 2).sum(axis=1)
+
+    @classmethod
+    def fit(cls, users: list, assignments: dict, version: int = 1):
+        """クラスタが割り当て済みのユーザーから重心を計算（語彙は feature_store のもの）"""
+        users = [user for user in users if assignments.get(user["user_id"]) is not None]
+        batch = feature_store.encode_many(users)
+        hobbies, vocabularies = feature_vocabularies(batch)
+        labels = [int(assignments[user["user_id"]]) for user in users]
+        # 重心 = クラスタごとの特徴量の平均（NearestCentroid と同じ）
+        return cls.from_features(one_hot(batch), labels, hobbies, vocabularies, version=version, user_ids=batch.user_ids)
+
+    @classmethod
+    def from_features(cls, features, labels, hobbies: list, vocabularies: dict, version: int = 1, user_ids=()):
+        """特徴量行列（列の並びはこのクラスと同じ、疎行列でもよい）とクラスタ番号から重心を計算"""
+        labels = np.asarray(labels, dtype=np.int64)
+        cluster_ids, rows = np.unique(labels, return_inverse=True)
+        # クラスタ×ユーザーの所属行列（疎行列）を掛けて、クラスタごとの合計を求める
+        membership = sparse.csr_matrix(
+            (np.ones(len(labels)), (rows, np.arange(len(labels)))), shape=(len(cluster_ids), len(labels))
+        )
+        sums = np.asarray((membership @ features).todense()) if sparse.issparse(features) else membership @ features
+        return cls(version, hobbies, vocabularies, cluster_ids, sums / np.bincount(rows)[:, None], user_ids=user_ids)
+
+    def feature_indices(self, user: dict) -> np.ndarray:
+        """ユーザーの特徴量のうち 1 になる列番号（モデルの語彙にない値は無視）"""
+        # モデルは趣味名で保存しているので、趣味 ID を名前に戻してから引く
+        hobbies = hobby_similarity.names(user["hobby_ids"])
+        indices = {self.hobby_index[hobby] for hobby in hobbies if hobby in self.hobby_index}
+        for column in CATEGORICAL_COLUMNS:
+            index = self.category_index[column].get(user[column])
+            if index is not None:
+                indices.add(index)
+        return np.array(sorted(indices), dtype=np.intp)
+
+    def assign(self, user: dict) -> int:
+        """最も近い重心のクラスタ番号を返す"""
+        indices = self.feature_indices(user)
+        distances = self.centroid_norms - 2.0 * self.centroids[:, indices].sum(axis=1)
+        return int(self.cluster_ids[np.argmin(distances)])
+
+    def save(self, path: str = CLUSTER_MODEL_PATH, replace: bool = True):
+        """npz ファイルに保存（書き込み途中のファイルを読まれないよう、一時ファイルから置き換える）
+
+        replace=False なら一時ファイルに書くだけで、そのパスを返す
+        """
+        arrays = {
+            "version": np.array(self.version),
+            "created_at": np.array(self.created_at),
+            "hobbies": np.array(self.hobbies, dtype=str),
+            "cluster_ids": self.cluster_ids,
+            "centroids": self.centroids,
+            "user_ids": np.array(self.user_ids, dtype=str),
+        }
+        for column in CATEGORICAL_COLUMNS:
+            arrays[f"vocab_{column}"] = np.array(self.vocabularies[column], dtype=str)
+        temporary_path = f"{path}.tmp.npz"
+        np.savez(temporary_path, **arrays)
+        if replace:
+            os.replace(temporary_path, path)
+        return temporary_path
+
+    @classmethod
+    def load(cls, path: str = CLUSTER_MODEL_PATH):
+        """npz ファイルから読み込む"""
+        with np.load(path) as data:
+            return cls(
+                int(data["version"]),
+                data["hobbies"].tolist(),
+                {column: data[f"vocab_{column}"].tolist() for column in CATEGORICAL_COLUMNS},
+                data["cluster_ids"],
+                data["centroids"],
+                created_at=float(data["created_at"]),
+                user_ids=data["user_ids"].tolist() if "user_ids" in data.files else (),
+            )
+
+
+_model = None
+_model_mtime = None
+_lock = threading.RLock()
+
+
+def _file_mtime(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def get_cluster_model(path: str = CLUSTER_MODEL_PATH):
+    """保存済みのモデルを返す（ファイルが更新されていたら読み込み直す、無ければ None）"""
+    global _model, _model_mtime
+    with _lock:
+        mtime = _file_mtime(path)
+        if mtime is not None and mtime != _model_mtime:
+            _model = ClusterModel.load(path)
+            _model_mtime = mtime
+        return _model
+
+
+def assign_user(row: dict, path: str = CLUSTER_MODEL_PATH):
+    """現在のモデルでユーザーを割り当て、スナップショット側のクラスタにも記録する（モデルが無ければ None）
+
+    swap_cluster_snapshot と同じロックの中で行うので、古いモデルの割り当てが新しい版に混ざらない
+    """
+    with attribute_store.lock, _lock:
+        model = get_cluster_model(path)
+        if model is None or len(model.cluster_ids) == 0:
+            return None
+        cluster = model.assign(row)
+        attribute_store.set_clusters({row["user_id"]: cluster})
+        return cluster
+
+
+def next_model_version(path: str = CLUSTER_MODEL_PATH) -> int:
+    current = get_cluster_model(path)
+    return 1 if current is None else current.version + 1
+
+
+def save_cluster_model(model: ClusterModel, path: str = CLUSTER_MODEL_PATH) -> ClusterModel:
+    """モデルを保存し、以降の割り当てに使う"""
+    global _model, _model_mtime
+    temporary_path = model.save(path, replace=False)
+    with _lock:
+        os.replace(temporary_path, path)
+        _model = model
+        _model_mtime = _file_mtime(path)
+    return model
+
+
+def swap_cluster_snapshot(model: ClusterModel, assignments: dict, path: str = CLUSTER_MODEL_PATH) -> dict:
+    """再クラスタリングの結果（モデルと全ユーザーの割り当て）をまとめて差し替える
+
+    モデルとスナップショット側のクラスタを同じロックの中で入れ替えるので、割り当てと /invite は
+    常にどちらか一方の版だけを見る。クラスタリング中に登録されたユーザーは新しいモデルで割り当て直し、
+    その割り当て（users.cluster への書き込みが必要な分）を返す
+    """
+    global _model, _model_mtime
+    temporary_path = model.save(path, replace=False)
+    with attribute_store.lock, _lock:
+        late = {
+            user_id: model.assign(row)
+            for user_id, row in attribute_store.rows.items()
+            if user_id not in assignments
+        }
+        os.replace(temporary_path, path)
+        _model = model
+        _model_mtime = _file_mtime(path)
+        attribute_store.replace_clusters({**assignments, **late})
+    return late
+
+
+def publish_cluster_model(users: list, assignments: dict, path: str = CLUSTER_MODEL_PATH) -> ClusterModel:
+    """クラスタリング結果から新しい版のモデルを作成して保存する"""
+    model = ClusterModel.fit(users, assignments, version=next_model_version(path))
+    return save_cluster_model(model, path)
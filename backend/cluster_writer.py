@@ -0,0 +1,48 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from repository import repository
+from attribute_store import attribute_store
+from config import CLUSTER_WRITE_CHUNK_SIZE, CLUSTER_WRITE_CONCURRENCY
+
+# users.cluster を更新するのはこのモジュールだけにする
+# 1チャンクごとに repository.write_clusters を呼び出す（Supabase では update_user_clusters 関数（routes/database.py で作成）に
+# 割り当てを SQL 文字列に埋め込まず JSON の引数として渡す）
+
+
+def write_chunk(chunk: list) -> int:
+    """1チャンク分の割り当てを1回の呼び出しで書き込み、更新した行数を返す"""
+    return repository.write_clusters(chunk)
+
+
+def write_cluster_assignments(
+    assignments: dict,
+    chunk_size: int = CLUSTER_WRITE_CHUNK_SIZE,
+    concurrency: int = CLUSTER_WRITE_CONCURRENCY,
+    update_snapshot: bool = True,
+) -> dict:
+    """user_id -> cluster の割り当てを users.cluster にまとめて書き込む
+
+    update_snapshot=False なら attribute_store は更新しない（再クラスタリングで後からまとめて差し替える場合）
+    """
+    rows = [{"id": user_id, "cluster": int(cluster)} for user_id, cluster in assignments.items()]
+    chunks = [rows[start:start + chunk_size] for start in range(0, len(rows), chunk_size)]
+
+    started = time.perf_counter()
+    if len(chunks) <= 1 or concurrency <= 1:
+        updated = sum(write_chunk(chunk) for chunk in chunks)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            updated = sum(executor.map(write_chunk, chunks))
+    seconds = time.perf_counter() - started
+
+    # スナップショット側のクラスタも更新
+    if update_snapshot:
+        attribute_store.set_clusters({row["id"]: row["cluster"] for row in rows})
+
+    return {
+        "rows": len(rows),
+        "updated": updated,
+        "chunks": len(chunks),
+        "seconds": seconds,
+        "rows_per_second": len(rows) / seconds if seconds > 0 else None,
+    }
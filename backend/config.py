@@ -7,4 +7,105 @@ if os.getenv("GAE_ENV") is None: # Cloud Run 環境では GAE_ENV が設定さ
 
 SUPABASE_URL = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
 SUPABASE_KEY = os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY")
-SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
\ No newline at end of file
+SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
+
+# ユーザー属性スナップショットを全件再取得する間隔（秒）
+ATTRIBUTE_STORE_TTL_SECONDS = float(os.getenv("ATTRIBUTE_STORE_TTL_SECONDS", "300"))
+
+# 事前計算したおすすめ（recommendations テーブル）を使ってよい期間（秒）
+RECOMMENDATIONS_MAX_AGE_SECONDS = float(os.getenv("RECOMMENDATIONS_MAX_AGE_SECONDS", "3600"))
+# recommendations テーブルに行があるかを確かめ直す間隔（秒）。行が無い・テーブルが無い間は問い合わせない
+RECOMMENDATIONS_TABLE_CHECK_SECONDS = float(os.getenv("RECOMMENDATIONS_TABLE_CHECK_SECONDS", "60"))
+
+# マッチングの候補を近似最近傍インデックスで絞り込むか（ユーザー数が多いとき用）
+CANDIDATE_INDEX_ENABLED = os.getenv("CANDIDATE_INDEX_ENABLED", "false").lower() == "true"
+# インデックスのリスト数（0 なら √ユーザー数）
+CANDIDATE_INDEX_LISTS = int(os.getenv("CANDIDATE_INDEX_LISTS", "0"))
+# 1回の検索で調べるリスト数（多いほど正確、少ないほど高速）
+CANDIDATE_INDEX_N_PROBE = int(os.getenv("CANDIDATE_INDEX_N_PROBE", "16"))
+# リスト数が √ユーザー数 からこの割合以上ずれたら、インデックスの k-means を学習し直す（それまでは重心を使い回す）
+CANDIDATE_INDEX_RETRAIN_RATIO = float(os.getenv("CANDIDATE_INDEX_RETRAIN_RATIO", "0.2"))
+
+# /matching_result の exclude_liked / exclude_matched で、likes テーブルをメモリ上のグラフとして保持するか
+# （false なら毎回問い合わせる。グラフはインスタンスごとに持つので、他のインスタンスで追加されたいいねは TTL まで反映されない）
+LIKE_GRAPH_ENABLED = os.getenv("LIKE_GRAPH_ENABLED", "false").lower() == "true"
+# likes グラフを全件再取得する間隔（秒）
+LIKE_GRAPH_TTL_SECONDS = float(os.getenv("LIKE_GRAPH_TTL_SECONDS", "300"))
+
+# クラスタリング結果を users.cluster に書き込むときの1回あたりの行数
+CLUSTER_WRITE_CHUNK_SIZE = int(os.getenv("CLUSTER_WRITE_CHUNK_SIZE", "2000"))
+# 同時に送る書き込みの数
+CLUSTER_WRITE_CONCURRENCY = int(os.getenv("CLUSTER_WRITE_CONCURRENCY", "4"))
+
+# クラスタリングの方式（dense: 従来の KMeans、sparse: 疎行列 + MiniBatchKMeans）
+CLUSTERING_MODE = os.getenv("CLUSTERING_MODE", "dense")
+# sparse 方式で user_attributes を1回に取得する件数
+CLUSTERING_PAGE_SIZE = int(os.getenv("CLUSTERING_PAGE_SIZE", "1000"))
+# sparse 方式の MiniBatchKMeans のミニバッチの大きさ
+CLUSTERING_BATCH_SIZE = int(os.getenv("CLUSTERING_BATCH_SIZE", "4096"))
+# sparse 方式で MiniBatchKMeans を使うユーザー数（これ未満は疎行列のまま KMeans）
+CLUSTERING_MINIBATCH_MIN_USERS = int(os.getenv("CLUSTERING_MINIBATCH_MIN_USERS", "20000"))
+
+# API プロセス内で再クラスタリングを自動実行するか
+# （モデルと割り当てはプロセスのメモリと cluster_model.npz にあり、他のインスタンスには伝わらないので、API を1インスタンスで動かす場合だけ true にする）
+RECLUSTER_ENABLED = os.getenv("RECLUSTER_ENABLED", "false").lower() == "true"
+# 前回のクラスタリング以降に登録されたユーザーがこの人数に達したら再クラスタリングする
+RECLUSTER_MIN_NEW_USERS = int(os.getenv("RECLUSTER_MIN_NEW_USERS", "50"))
+# 前回のクラスタリングからこの秒数が経ったら再クラスタリングする
+RECLUSTER_INTERVAL_SECONDS = float(os.getenv("RECLUSTER_INTERVAL_SECONDS", "86400"))
+# 再クラスタリングが必要かを確認する間隔（秒）
+RECLUSTER_CHECK_SECONDS = float(os.getenv("RECLUSTER_CHECK_SECONDS", "60"))
+
+# Slack の メールアドレス -> Slack ID 一覧を取り直す間隔（秒）
+SLACK_DIRECTORY_TTL_SECONDS = float(os.getenv("SLACK_DIRECTORY_TTL_SECONDS", "600"))
+# Slack に見つからなかったメールアドレスを覚えておく時間（秒）
+SLACK_DIRECTORY_MISS_TTL_SECONDS = float(os.getenv("SLACK_DIRECTORY_MISS_TTL_SECONDS", "60"))
+
+# Slack のチャンネル名 -> ID 一覧を取り直す間隔（秒）
+SLACK_CHANNEL_TTL_SECONDS = float(os.getenv("SLACK_CHANNEL_TTL_SECONDS", "3600"))
+# 一覧に無いチャンネル名を聞かれたときに取り直す最短の間隔（秒）
+SLACK_CHANNEL_MISS_RELOAD_SECONDS = float(os.getenv("SLACK_CHANNEL_MISS_RELOAD_SECONDS", "10"))
+
+# Slack API の再試行回数（429・5xx・接続エラーのとき）
+SLACK_MAX_RETRIES = int(os.getenv("SLACK_MAX_RETRIES", "3"))
+# Slack API のタイムアウト（秒）
+SLACK_TIMEOUT_SECONDS = float(os.getenv("SLACK_TIMEOUT_SECONDS", "10"))
+# Slack API への接続プールの大きさ
+SLACK_POOL_SIZE = int(os.getenv("SLACK_POOL_SIZE", "20"))
+
+# Slack への送信キューのワーカー数（同時に Slack へ送る数の上限）
+SLACK_OUTBOX_WORKERS = int(os.getenv("SLACK_OUTBOX_WORKERS", "4"))
+# ワーカーが一度に取り出すメッセージ数
+SLACK_OUTBOX_BATCH_SIZE = int(os.getenv("SLACK_OUTBOX_BATCH_SIZE", "20"))
+# 送信に失敗したメッセージを試す最大回数
+SLACK_OUTBOX_MAX_ATTEMPTS = int(os.getenv("SLACK_OUTBOX_MAX_ATTEMPTS", "5"))
+# 再送までの待ち時間（秒、失敗するたびに倍にする）
+SLACK_OUTBOX_RETRY_SECONDS = float(os.getenv("SLACK_OUTBOX_RETRY_SECONDS", "5"))
+# 同じ宛先・同じ本文のメッセージを重複とみなす時間（秒）
+SLACK_OUTBOX_DEDUP_SECONDS = float(os.getenv("SLACK_OUTBOX_DEDUP_SECONDS", "300"))
+# 送信キューを slack_outbox テーブルにも保存する（再起動しても未送信のメッセージを送る）
+SLACK_OUTBOX_DURABLE = os.getenv("SLACK_OUTBOX_DURABLE", "false").lower() == "true"
+# slack_outbox の行を取り出したインスタンスが送信を受け持つ時間（秒）。過ぎても送信済みにならなければ他のインスタンスが取り出す
+SLACK_OUTBOX_LEASE_SECONDS = float(os.getenv("SLACK_OUTBOX_LEASE_SECONDS", "300"))
+
+# 2人の Slack ID -> DM のチャンネル ID を dm_channels テーブルにも保存する（再起動しても conversations.open を呼び直さない）
+SLACK_DM_CHANNELS_DURABLE = os.getenv("SLACK_DM_CHANNELS_DURABLE", "false").lower() == "true"
+
+# 架空データを書き込むときの1回の INSERT の行数
+SYNTHETIC_BATCH_SIZE = int(os.getenv("SYNTHETIC_BATCH_SIZE", "5000"))
+# 架空データを並列に書き込む数
+SYNTHETIC_CONCURRENCY = int(os.getenv("SYNTHETIC_CONCURRENCY", "4"))
+# 架空データのユーザー数の上限
+SYNTHETIC_MAX_USERS = int(os.getenv("SYNTHETIC_MAX_USERS", "1000000"))
+# 架空ユーザー1人あたりのいいねの上限
+SYNTHETIC_MAX_LIKES = int(os.getenv("SYNTHETIC_MAX_LIKES", "50"))
+
+# データの保存先（supabase: Supabase、sqlite: ローカルの SQLite。Supabase 無しで負荷試験する場合に使う）
+DATA_BACKEND = os.getenv("DATA_BACKEND", "supabase")
+# DATA_BACKEND=sqlite のときのファイル（":memory:" ならメモリ上だけ）
+SQLITE_PATH = os.getenv("SQLITE_PATH", ":memory:")
+
+# 全件を読み出すときの1ページの行数（PostgREST の max-rows 以下にする）
+REPOSITORY_PAGE_SIZE = int(os.getenv("REPOSITORY_PAGE_SIZE", "1000"))
+# id を指定して読み出すときに1回の問い合わせに含める id の数（URL の長さの上限に収める）
+REPOSITORY_IN_CHUNK_SIZE = int(os.getenv("REPOSITORY_IN_CHUNK_SIZE", "200"))
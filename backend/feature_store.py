@@ -0,0 +1,162 @@
+import threading
+from collections import namedtuple
+import numpy as np
+from scipy import sparse
+from hobby_similarity import hobby_similarity
+
+# マッチングとクラスタリングで使う属性（趣味以外）
+CATEGORICAL_COLUMNS = ["hometown", "field", "role", "mbti", "alma_mater"]
+# クラスタリングで読み出す user_attributes の列（趣味は書き込み時にエンコード済みの hobby_ids を読む）
+FEATURE_FIELDS = ["user_id", "hobby_ids"] + CATEGORICAL_COLUMNS
+# マッチングで読み出す列（重視する項目 preferences も使う）
+MATCHING_FIELDS = FEATURE_FIELDS + ["preferences"]
+
+# 選択肢が決まっている属性の語彙（user_attributes テーブルの CHECK 制約もここから作る）
+FIELD_VALUES = ["公共", "法人", "金融", "TC&S", "技統本"]
+ROLE_VALUES = ["SE", "営業", "コンサル", "スタッフ"]
+MBTI_TYPES = [
+    "INTJ", "INTP", "ENTJ", "ENTP", "INFJ", "INFP", "ENFJ", "ENFP",
+    "ISTJ", "ISFJ", "ESTJ", "ESFJ", "ISTP", "ISFP", "ESTP", "ESFP",
+]
+FIXED_VOCABULARIES = {"field": FIELD_VALUES, "role": ROLE_VALUES, "mbti": MBTI_TYPES}
+
+# 1ユーザー分のエンコード結果
+#   codes:   CATEGORICAL_COLUMNS の順の整数コード（値が無い場合は -1）
+#   hobbies: 趣味 ID（hobby_similarity.vocab の行番号）の配列（hobby_ids の並び順・重複はそのまま）
+UserFeatures = namedtuple("UserFeatures", ["codes", "hobbies"])
+
+# 複数ユーザー分を列ごとにまとめたもの
+#   codes:         属性名 -> コード配列
+#   hobby_indices: 全ユーザーの趣味インデックスを連結したもの（hobby_indptr で区切る、CSR と同じ形式）
+#   vocabularies:  まとめた時点の 属性名 -> {値: コード}
+FeatureBatch = namedtuple("FeatureBatch", ["user_ids", "codes", "hobby_indices", "hobby_indptr", "vocabularies"])
+
+
+class FeatureStore:
+    """属性の語彙を一か所で管理し、ユーザーごとのエンコード結果をキャッシュする
+
+    - field / role / mbti の語彙は固定、hometown / alma_mater は新しい値が出るたびに末尾に追加する
+      （コードは一度決まったら変わらない）
+    - 趣味は hobby_ids（書き込み時にエンコード済みの趣味 ID）をそのまま使う
+    - 同じ内容のユーザーは一度しかエンコードしない
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.vocabularies = {
+            column: {value: code for code, value in enumerate(FIXED_VOCABULARIES.get(column, []))}
+            for column in CATEGORICAL_COLUMNS
+        }
+        self._cache = {}  # user_id -> (エンコードに使った値, UserFeatures)
+
+        # 計測用カウンタ
+        self.hits = 0
+        self.misses = 0
+
+    def code(self, column: str, value) -> int:
+        """値のコード（None は -1、未知の値は語彙に追加する）"""
+        if value is None:
+            return -1
+        vocabulary = self.vocabularies[column]
+        code = vocabulary.get(value)
+        if code is None:
+            with self.lock:
+                code = vocabulary.setdefault(value, len(vocabulary))
+        return code
+
+    def encode(self, row: dict) -> UserFeatures:
+        """1ユーザー分をエンコード（同じ内容の行は前回の結果を返す）"""
+        # エンコードに使う列だけを比べる（自己紹介文などが変わっても作り直さない）
+        key = (tuple(row["hobby_ids"] or ()),) + tuple(row[column] for column in CATEGORICAL_COLUMNS)
+        cached = self._cache.get(row["user_id"])
+        if cached is not None and cached[0] == key:
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        features = UserFeatures(
+            np.array([self.code(column, row[column]) for column in CATEGORICAL_COLUMNS], dtype=np.int32),
+            hobby_similarity.to_indices(row["hobby_ids"]),
+        )
+        self._cache[row["user_id"]] = (key, features)
+        return features
+
+    def forget(self, user_id: str):
+        """削除されたユーザーのキャッシュを消す"""
+        self._cache.pop(user_id, None)
+
+    def encode_many(self, rows: list) -> FeatureBatch:
+        """複数ユーザーをエンコードして列ごとにまとめる"""
+        return self.batch([row["user_id"] for row in rows], [self.encode(row) for row in rows])
+
+    def batch(self, user_ids: list, features: list) -> FeatureBatch:
+        """UserFeatures のリストを列ごとにまとめる"""
+        codes = np.array([feature.codes for feature in features], dtype=np.int32).reshape(len(features), len(CATEGORICAL_COLUMNS))
+        lengths = [len(feature.hobbies) for feature in features]
+        hobby_indptr = np.zeros(len(features) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=hobby_indptr[1:])
+        hobby_indices = np.concatenate([feature.hobbies for feature in features]) if features else np.zeros(0, dtype=np.intp)
+        return FeatureBatch(
+            list(user_ids),
+            {column: codes[:, i] for i, column in enumerate(CATEGORICAL_COLUMNS)},
+            hobby_indices.astype(np.intp),
+            hobby_indptr,
+            self.vocabulary_snapshot(),
+        )
+
+    def vocabulary_snapshot(self) -> dict:
+        """現在の語彙のコピー（以降に追加された値の影響を受けない）"""
+        with self.lock:
+            return {column: dict(vocabulary) for column, vocabulary in self.vocabularies.items()}
+
+    def stats(self) -> dict:
+        return {
+            "cached_users": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "vocabulary_sizes": {column: len(vocabulary) for column, vocabulary in self.vocabularies.items()},
+        }
+
+
+def hobby_counts(batch: FeatureBatch) -> np.ndarray:
+    """ユーザー×趣味の語彙の出現回数行列"""
+    counts = np.zeros((len(batch.user_ids), len(hobby_similarity.vocab)))
+    rows = np.repeat(np.arange(len(batch.user_ids)), np.diff(batch.hobby_indptr))
+    np.add.at(counts, (rows, batch.hobby_indices), 1.0)
+    return counts
+
+
+def one_hot(batch: FeatureBatch) -> sparse.csr_matrix:
+    """クラスタリング用の疎な特徴量行列（趣味の multi-hot → 属性ごとの one-hot、列の並びは語彙のコード順）"""
+    n_users = len(batch.user_ids)
+    blocks = [
+        sparse.csr_matrix(
+            (np.ones(len(batch.hobby_indices)), batch.hobby_indices, batch.hobby_indptr),
+            shape=(n_users, len(hobby_similarity.vocab)),
+        )
+    ]
+    for column in CATEGORICAL_COLUMNS:
+        codes = batch.codes[column]
+        present = np.flatnonzero(codes >= 0)
+        blocks.append(sparse.csr_matrix(
+            (np.ones(len(present)), (present, codes[present])),
+            shape=(n_users, len(batch.vocabularies[column])),
+        ))
+    matrix = sparse.hstack(blocks, format="csr")
+    # 同じ趣味が重複していても 1 にする（multi-hot）
+    matrix.sum_duplicates()
+    matrix.data[:] = 1.0
+    return matrix
+
+
+def feature_vocabularies(batch: FeatureBatch) -> tuple:
+    """one_hot の列に対応する (趣味の語彙, 属性名 -> 値のリスト) を返す"""
+    vocabularies = {
+        column: sorted(batch.vocabularies[column], key=batch.vocabularies[column].get)
+        for column in CATEGORICAL_COLUMNS
+    }
+    return list(hobby_similarity.vocab), vocabularies
+
+
+# マッチング・クラスタリング・新規ユーザーの割り当てで共有する
+feature_store = FeatureStore()
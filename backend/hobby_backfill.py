@@ -0,0 +1,38 @@
+import time
+from repository import repository
+from hobby_similarity import encode_hobbies
+
+# 既存の user_attributes の hobby_ids を hobbies から埋める（/migrate-hobby-ids から呼ぶ）
+# 新しく書き込まれる行は、Supabase ではトリガー（routes/database.py）、SQLite では repository.insert_attributes で埋まる
+
+# 読み出す列
+BACKFILL_COLUMNS = ("user_id", "hobbies", "hobby_ids")
+
+
+def backfill_hobby_ids(page_size: int = 1000) -> dict:
+    """hobbies から作った趣味 ID が hobby_ids と違う行だけを書き込む（語彙にない趣味を含む行は invalid として返す）"""
+    started = time.perf_counter()
+    rows = 0
+    updated = 0
+    invalid = []
+    for page in repository.attribute_pages(page_size, BACKFILL_COLUMNS):
+        rows += len(page)
+        assignments = []
+        for row in page:
+            try:
+                hobby_ids = encode_hobbies(row["hobbies"])
+            except ValueError as e:
+                invalid.append({"user_id": row["user_id"], "error": str(e)})
+                continue
+            if row["hobby_ids"] != hobby_ids:
+                assignments.append({"user_id": row["user_id"], "hobby_ids": hobby_ids})
+        if assignments:
+            updated += repository.write_hobby_ids(assignments)
+    seconds = time.perf_counter() - started
+
+    return {
+        "rows": rows,
+        "updated": updated,
+        "invalid": invalid,
+        "seconds": seconds,
+    }
@@ -0,0 +1,82 @@
+import os
+import numpy as np
+
+# 趣味ベクトルのファイル（word2vec.py で生成）
+#   hobby_vectors.npy:       正規化済みの float32 の行列（mmap で読み込むのでコピーしない）
+#   hobby_vectors.vocab.txt: 行列の各行の単語
+HOBBY_VECTORS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hobby_vectors.npy")
+HOBBY_VECTORS_VOCAB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hobby_vectors.vocab.txt")
+
+# 趣味の語彙（フロントエンドの選択肢と同じ順番）
+# 並び順がそのまま趣味 ID（user_attributes.hobby_ids の値）になるので、追加は末尾にだけ行う
+HOBBY_VALUES = [
+    "サッカー", "バスケットボール", "野球", "ランニング", "旅行", "映画鑑賞", "アニメ", "漫画", "ゲーム", "カフェ",
+    "読書", "音楽", "カメラ", "キャンプ", "筋トレ", "料理", "プログラミング", "ボードゲーム", "ダンス", "登山",
+    "温泉", "釣り", "DIY", "ガーデニング", "スポーツ観戦", "イラスト", "手芸", "ラーメン", "居酒屋", "ボランティア",
+]
+HOBBY_IDS = {hobby: i for i, hobby in enumerate(HOBBY_VALUES)}
+
+
+def encode_hobbies(hobbies, skip_unknown: bool = False) -> list:
+    """趣味リスト（または "A, B, C" 形式の文字列）を趣味 ID のリストにする（語彙にない趣味は ValueError）
+
+    書き込み時に1回だけ呼ぶ。読み出し側は hobby_ids をそのまま使い、文字列は解析しない
+    （hobby_ids 列が無い DB から読む場合だけ、skip_unknown=True で語彙にない趣味を読み飛ばす）
+    """
+    if isinstance(hobbies, str):
+        hobbies = hobbies.split(", ") if hobbies else []
+    hobbies = hobbies or []
+    unknown = [hobby for hobby in hobbies if hobby not in HOBBY_IDS]
+    if unknown and not skip_unknown:
+        raise ValueError(f"unknown hobbies: {', '.join(unknown)}")
+    return [HOBBY_IDS[hobby] for hobby in hobbies if hobby in HOBBY_IDS]
+
+
+class HobbySimilarity:
+    """趣味同士のコサイン類似度行列を保持し、趣味 ID のリスト間の類似度を返す"""
+
+    def __init__(self, vectors: np.ndarray, words: list, vocab: list = HOBBY_VALUES):
+        """vectors は正規化済みの行列、words はその各行の単語"""
+        # 語彙（趣味名）と行番号の対応（行番号 = 趣味 ID）
+        rows = {word: row for row, word in enumerate(words)}
+        missing = [hobby for hobby in vocab if hobby not in rows]
+        if missing:
+            raise ValueError(f"hobby vectors are missing: {', '.join(missing)}")
+        self.vocab = list(vocab)
+        self.index = {hobby: i for i, hobby in enumerate(self.vocab)}
+
+        # ファイルの先頭が趣味 ID の順に並んでいれば（word2vec.py の既定）、コピーせずにそのまま使う
+        order = [rows[hobby] for hobby in self.vocab]
+        if order == list(range(len(order))):
+            self.vectors = vectors[:len(order)]
+        else:
+            self.vectors = vectors[order]
+
+        # 語彙数×語彙数の類似度行列（ベクトルは正規化済みなので、内積がそのままコサイン類似度になる）
+        vectors64 = self.vectors.astype(np.float64)
+        self.matrix = vectors64 @ vectors64.T
+
+    @classmethod
+    def load(cls, path: str = HOBBY_VECTORS_PATH, vocab_path: str = HOBBY_VECTORS_VOCAB_PATH):
+        """word2vec.py で保存した行列を mmap で読み込む"""
+        with open(vocab_path, encoding="utf-8") as f:
+            words = f.read().splitlines()
+        return cls(np.load(path, mmap_mode="r"), words)
+
+    def to_indices(self, hobby_ids) -> np.ndarray:
+        """趣味 ID のリスト（未設定なら None）を行番号の配列にする"""
+        return np.asarray(hobby_ids or (), dtype=np.intp)
+
+    def names(self, hobby_ids) -> list:
+        """趣味 ID のリストを趣味名のリストに戻す"""
+        return [self.vocab[hobby_id] for hobby_id in hobby_ids or ()]
+
+    def score(self, hobby_ids1, hobby_ids2) -> float:
+        """2つの趣味 ID のリストについて、全ペアのコサイン類似度の合計を返す"""
+        indices1 = self.to_indices(hobby_ids1)
+        indices2 = self.to_indices(hobby_ids2)
+        return float(self.matrix[np.ix_(indices1, indices2)].sum())
+
+
+# 起動時に一度だけ読み込み、マッチングやクラスタリングから共有する
+hobby_similarity = HobbySimilarity.load()
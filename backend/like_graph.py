@@ -0,0 +1,87 @@
+import threading
+import time
+from repository import repository
+from config import LIKE_GRAPH_ENABLED, LIKE_GRAPH_TTL_SECONDS
+
+
+class LikeGraph:
+    """likes テーブルを「誰が誰をいいねしたか」の隣接集合としてメモリ上に保持する"""
+
+    def __init__(self, repository, ttl_seconds: float = LIKE_GRAPH_TTL_SECONDS, enabled: bool = LIKE_GRAPH_ENABLED):
+        self.repository = repository
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.lock = threading.RLock()
+        self.outgoing = {}  # user_id -> いいねした相手の集合
+        self.incoming = {}  # user_id -> いいねしてくれた相手の集合
+        self.loaded_at = None
+
+    def reload(self):
+        """データベースから全件を取り直す"""
+        likes = self.repository.likes()
+        with self.lock:
+            self.outgoing = {}
+            self.incoming = {}
+            for like in likes:
+                self._add(like["user_id"], like["target_user_id"])
+            self.loaded_at = time.monotonic()
+
+    def invalidate(self):
+        """次のアクセスで全件を取り直す"""
+        with self.lock:
+            self.loaded_at = None
+
+    def _ensure_loaded(self):
+        with self.lock:
+            expired = self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl_seconds
+        if expired:
+            self.reload()
+
+    def _add(self, user_id: str, target_user_id: str):
+        self.outgoing.setdefault(user_id, set()).add(target_user_id)
+        self.incoming.setdefault(target_user_id, set()).add(user_id)
+
+    def add_like(self, user_id: str, target_user_id: str):
+        """いいねが追加されたときに呼ぶ（グラフを使っていない・まだ読み込んでいないときは何もしない）"""
+        with self.lock:
+            if not self.enabled or self.loaded_at is None:
+                return
+            self._add(user_id, target_user_id)
+
+    def liked_by(self, user_id: str) -> set:
+        """user_id がいいねした相手"""
+        self._ensure_loaded()
+        with self.lock:
+            return set(self.outgoing.get(user_id, ()))
+
+    def likers_of(self, user_id: str) -> set:
+        """user_id をいいねした相手"""
+        self._ensure_loaded()
+        with self.lock:
+            return set(self.incoming.get(user_id, ()))
+
+
+like_graph = LikeGraph(repository)
+
+
+def fetch_like_status(user_id: str, target_user_ids: list) -> dict:
+    """user_id と各 target の間のいいね状況をまとめて返す
+
+    マッチ成立の判定は古い結果を返せないので、グラフは使わずに1回の問い合わせで両方向のいいねを取得する
+    """
+    outbound = set()
+    inbound = set()
+    for like in repository.likes_between(user_id, target_user_ids):
+        if like["user_id"] == user_id:
+            outbound.add(like["target_user_id"])
+        else:
+            inbound.add(like["user_id"])
+
+    return {
+        target_user_id: {
+            "match": target_user_id in outbound and target_user_id in inbound,
+            "liked": target_user_id in outbound,     # user_id -> target のいいね
+            "liked_by": target_user_id in inbound,   # target -> user_id のいいね
+        }
+        for target_user_id in target_user_ids
+    }
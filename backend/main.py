@@ -1,6 +1,8 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from routes import root, users, database, matching, slack, clustering
+from config import RECLUSTER_ENABLED
+from slack_outbox import slack_outbox
 
 app = FastAPI()
 
@@ -21,6 +23,25 @@ app.include_router(matching.router) # マッチングに関する操作
 app.include_router(slack.router) # Slack に関する操作
 app.include_router(clustering.router) # クラスタリングに関する操作
 
+# 再クラスタリングをバックグラウンドで自動実行する
+@app.on_event("startup")
+def start_recluster_scheduler():
+    if RECLUSTER_ENABLED:
+        clustering.recluster_scheduler.start()
+
+@app.on_event("shutdown")
+def stop_recluster_scheduler():
+    clustering.recluster_scheduler.stop()
+
+# Slack への送信キューのワーカーを起動・停止する
+@app.on_event("startup")
+async def start_slack_outbox():
+    await slack_outbox.start()
+
+@app.on_event("shutdown")
+async def stop_slack_outbox():
+    await slack_outbox.stop()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
@@ -0,0 +1,212 @@
+import numpy as np
+from hobby_similarity import hobby_similarity
+# 一致したら 1.0 を加算する属性（CATEGORICAL_COLUMNS）と MBTI の語彙は feature_store で管理
+from feature_store import CATEGORICAL_COLUMNS, MBTI_TYPES, feature_store, hobby_counts
+
+# マッチ度の内訳（合計する順番もこの順）
+SCORE_COLUMNS = ["hometown", "field", "role", "mbti", "alma_mater", "hobbies"]
+
+# MBTI の相性が良い組み合わせ
+BEST_MATCHES = {
+    "INTJ": ["ESFJ", "ISFP", "INTP"],
+    "INTP": ["ESFP", "ISFJ", "ENTJ"],
+    "ENTJ": ["ISFJ", "INFP", "INTP"],
+    "ENTP": ["ISFP", "ESTP", "ENFP"],
+    "INFJ": ["ESTJ", "INFP", "ENFP"],
+    "INFP": ["ESTP", "ENFJ", "INFJ"],
+    "ENFJ": ["ISTJ", "INFP", "ESTP"],
+    "ENFP": ["ISTP", "ESTJ", "INFJ"],
+    "ISTJ": ["ENFJ", "ESTP", "ESFJ"],
+    "ISFJ": ["ENTJ", "INTP", "INFP"],
+    "ESTJ": ["INFJ", "ISFJ", "ESFJ"],
+    "ESFJ": ["INTJ", "ENTP", "ISFP"],
+    "ISTP": ["ENFP", "INFJ", "ESTJ"],
+    "ISFP": ["ENTP", "INTJ", "ESFP"],
+    "ESTP": ["INFP", "ENTP", "ESFJ"],
+    "ESFP": ["INTP", "ENTJ", "ISFJ"],
+}
+
+# MBTI が完全一致なら 0.8、相性が良い組み合わせなら 1.0
+MBTI_SAME_SCORE = 0.8
+MBTI_BEST_MATCH_SCORE = 1.0
+
+# preference（重視する点）に指定された項目の重み
+PREFERENCE_WEIGHT = 1.5
+
+
+def build_mbti_compatibility(mbti_vocab: list) -> np.ndarray:
+    """MBTI の語彙（先頭16個は MBTI_TYPES）に対する相性表を作成"""
+    size = len(mbti_vocab)
+    table = np.zeros((size, size))
+    for i, mbti1 in enumerate(mbti_vocab):
+        for j, mbti2 in enumerate(mbti_vocab):
+            if i == j:
+                table[i, j] = MBTI_SAME_SCORE
+            elif mbti2 in BEST_MATCHES.get(mbti1, []):
+                table[i, j] = MBTI_BEST_MATCH_SCORE
+    return table
+
+
+# 16×16 の相性表（語彙が MBTI_TYPES だけの場合はこれをそのまま使う）
+MBTI_COMPATIBILITY = build_mbti_compatibility(MBTI_TYPES)
+
+
+def preference_weights(preferences) -> np.ndarray:
+    """preferences から SCORE_COLUMNS の順に並んだ重みベクトルを作成"""
+    weights = np.ones(len(SCORE_COLUMNS))
+    if not preferences:
+        return weights
+
+    # 文字列の場合、リスト化（calculate_match_score と同じく "," で区切る）
+    if isinstance(preferences, str):
+        preferences = preferences.split(",")
+
+    for preference in preferences:
+        if preference in SCORE_COLUMNS:
+            weights[SCORE_COLUMNS.index(preference)] *= PREFERENCE_WEIGHT
+    return weights
+
+
+class EncodedUsers:
+    """user_attributes の行を列ごとの配列にエンコードしたもの（エンコード自体は feature_store が行いキャッシュする）"""
+
+    def __init__(self, users: list):
+        batch = feature_store.encode_many(users)
+        self.user_ids = batch.user_ids
+
+        # 属性ごとの 値 → 整数コード（作成時点の語彙）とコード配列（値が無い場合は -1）
+        self.vocabularies = batch.vocabularies
+        self.codes = batch.codes
+
+        if len(self.vocabularies["mbti"]) == len(MBTI_TYPES):
+            self.mbti_compatibility = MBTI_COMPATIBILITY
+        else:
+            self.mbti_compatibility = build_mbti_compatibility(list(self.vocabularies["mbti"]))
+
+        # 各ユーザーが対象側になったときの重み（ユーザー×SCORE_COLUMNS）
+        self.preference_weights = np.array(
+            [preference_weights(user.get("preferences", [])) for user in users]
+        ).reshape(len(users), len(SCORE_COLUMNS))
+
+        # 趣味はユーザー×語彙の出現回数行列
+        self.hobby_counts = hobby_counts(batch)
+        self.hobby_present = self.hobby_counts > 0
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def code(self, column: str, value) -> int:
+        """値のコード（None は -1、語彙にない値はどのユーザーとも一致しない -2）"""
+        if value is None:
+            return -1
+        return self.vocabularies[column].get(value, -2)
+
+
+def score_users(target_user: dict, encoded: EncodedUsers, rows=None) -> np.ndarray:
+    """target_user と encoded の全ユーザー（rows 指定時はその行だけ）のマッチ度（丸め前）をまとめて計算"""
+    if rows is None:
+        rows = slice(None)
+    codes = {column: encoded.codes[column][rows] for column in CATEGORICAL_COLUMNS}
+    components = np.zeros((len(codes["mbti"]), len(SCORE_COLUMNS)))
+
+    for column in CATEGORICAL_COLUMNS:
+        # 語彙にない値はどのユーザーとも一致しないコードになる
+        target_code = encoded.code(column, target_user[column])
+        if column == "mbti":
+            if target_code >= 0:
+                components[:, SCORE_COLUMNS.index("mbti")] = encoded.mbti_compatibility[target_code, codes["mbti"]]
+            continue
+        components[:, SCORE_COLUMNS.index(column)] = codes[column] == target_code
+
+    # 趣味: Σ_i Σ_j sim(target_i, other_j) = (target の類似度ベクトル) · (other の出現回数)
+    target_hobby_similarity = hobby_similarity.matrix[hobby_similarity.to_indices(target_user["hobby_ids"])].sum(axis=0)
+    components[:, SCORE_COLUMNS.index("hobbies")] = encoded.hobby_counts[rows] @ target_hobby_similarity / 3.0
+
+    weights = preference_weights(target_user.get("preferences", []))
+    return (components * weights).sum(axis=1)
+
+
+def candidate_mask(encoded: EncodedUsers, filters: dict, exclude_rows=()) -> np.ndarray:
+    """スコアリングの対象にする行の真偽値配列（filters は 属性名 -> 値、None は絞り込みなし）"""
+    mask = np.ones(len(encoded), dtype=bool)
+    for column, value in filters.items():
+        if value is not None:
+            mask &= encoded.codes[column] == encoded.code(column, value)
+    mask[list(exclude_rows)] = False
+    return mask
+
+
+def score_block(encoded: EncodedUsers, rows: np.ndarray) -> np.ndarray:
+    """encoded の rows 行目のユーザーそれぞれを対象に、全ユーザーとのマッチ度（len(rows)×N）を計算"""
+    weights = encoded.preference_weights[rows]
+    scores = np.zeros((len(rows), len(encoded)))
+
+    for column in CATEGORICAL_COLUMNS:
+        codes = encoded.codes[column]
+        weight = weights[:, SCORE_COLUMNS.index(column), None]
+        if column == "mbti":
+            scores += encoded.mbti_compatibility[np.ix_(codes[rows], codes)] * weight
+        else:
+            # one-hot 同士の内積と同じ（一致していれば 1）
+            scores += (codes[rows, None] == codes[None, :]) * weight
+
+    # 趣味: (出現回数 @ 類似度行列) @ 出現回数^T
+    hobby_scores = (encoded.hobby_counts[rows] @ hobby_similarity.matrix) @ encoded.hobby_counts.T / 3.0
+    scores += hobby_scores * weights[:, SCORE_COLUMNS.index("hobbies"), None]
+    return scores
+
+
+def score_as_candidate(encoded: EncodedUsers, row: int) -> np.ndarray:
+    """全ユーザーをそれぞれ対象にしたときの、row 行目のユーザーのマッチ度（N）を計算"""
+    weights = encoded.preference_weights
+    scores = np.zeros(len(encoded))
+
+    for column in CATEGORICAL_COLUMNS:
+        codes = encoded.codes[column]
+        weight = weights[:, SCORE_COLUMNS.index(column)]
+        if column == "mbti":
+            scores += encoded.mbti_compatibility[codes, codes[row]] * weight
+        else:
+            scores += (codes == codes[row]) * weight
+
+    hobby_scores = encoded.hobby_counts @ (hobby_similarity.matrix @ encoded.hobby_counts[row]) / 3.0
+    scores += hobby_scores * weights[:, SCORE_COLUMNS.index("hobbies")]
+    return scores
+
+
+def common_attributes(encoded: EncodedUsers, user: dict, other_rows: np.ndarray) -> list:
+    """user と other_rows 行目の各ユーザーとの共通の属性を返す（趣味は user の並び順）"""
+    common = [{} for _ in other_rows]
+    for column in CATEGORICAL_COLUMNS:
+        if user[column] is None:
+            continue
+        code = encoded.code(column, user[column])
+        for result, same in zip(common, encoded.codes[column][other_rows] == code):
+            if same:
+                result[column] = user[column]
+
+    # 相手が持っている趣味かどうかを、user の趣味の並び順のまま判定
+    hobbies = hobby_similarity.names(user["hobby_ids"])
+    shared = encoded.hobby_present[np.ix_(other_rows, hobby_similarity.to_indices(user["hobby_ids"]))]
+    for result, flags in zip(common, shared):
+        result["hobbies"] = [hobby for hobby, flag in zip(hobbies, flags) if flag]
+    return common
+
+
+def top_k_matches(user_ids: list, scores: np.ndarray, k: int, exclude=()) -> list:
+    """スコア上位 k 人を返す（同点は元の並び順を優先、exclude の行番号は除く）"""
+    rounded = np.round(scores, 2)
+    rounded[list(exclude)] = -np.inf
+    k = min(k, len(rounded) - len(exclude))
+    if k <= 0:
+        return []
+
+    if k < len(rounded):
+        # k 番目のスコア以上のものだけを候補にし、候補内だけをソートする
+        kth_score = rounded[np.argpartition(-rounded, k - 1)[k - 1]]
+        candidates = np.flatnonzero(rounded >= kth_score)
+    else:
+        candidates = np.arange(len(rounded))
+
+    order = candidates[np.lexsort((candidates, -rounded[candidates]))][:k]
+    return [{"user_id": user_ids[i], "match_score": float(round(scores[i], 2))} for i in order]
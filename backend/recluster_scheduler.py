@@ -0,0 +1,141 @@
+import threading
+import time
+from attribute_store import attribute_store
+from cluster_model import get_cluster_model
+from config import (
+    RECLUSTER_CHECK_SECONDS,
+    RECLUSTER_INTERVAL_SECONDS,
+    RECLUSTER_MIN_NEW_USERS,
+)
+
+
+class ReclusterScheduler:
+    """新規ユーザー数か経過時間が閾値を超えたら、バックグラウンドのスレッドで再クラスタリングする
+
+    job は update_clustering_result（結果の保存とモデルの差し替えまで行う関数）
+    リクエストを処理するスレッドでは実行しないので、API の応答は待たされない
+    差し替えはこのプロセスの中だけなので、API を1インスタンスで動かす場合にだけ使う
+    """
+
+    def __init__(
+        self,
+        job,
+        min_new_users: int = RECLUSTER_MIN_NEW_USERS,
+        interval_seconds: float = RECLUSTER_INTERVAL_SECONDS,
+        check_seconds: float = RECLUSTER_CHECK_SECONDS,
+    ):
+        self.job = job
+        self.min_new_users = min_new_users
+        self.interval_seconds = interval_seconds
+        self.check_seconds = check_seconds
+
+        self.lock = threading.Lock()
+        self.running = False
+        self._thread = None
+        self._stop = threading.Event()
+
+        # 計測用
+        self.runs = 0
+        self.failures = 0
+        self.last_reason = None
+        self.last_started_at = None
+        self.last_duration_seconds = None
+        self.last_result = None
+        self.last_error = None
+
+    def new_users(self) -> int:
+        """今のモデルの学習後に登録されたユーザー数"""
+        model = get_cluster_model()
+        trained = set(model.user_ids) if model is not None else set()
+        return sum(1 for row in attribute_store.all() if row["user_id"] not in trained)
+
+    def due(self):
+        """再クラスタリングが必要ならその理由を返す（不要なら None）"""
+        model = get_cluster_model()
+        if model is None:
+            return "no_model" if attribute_store.all() else None
+        if self.new_users() >= self.min_new_users:
+            return "new_users"
+        if time.time() - model.created_at >= self.interval_seconds:
+            return "interval"
+        return None
+
+    def run_once(self, reason: str = "manual", measure_memory: bool = False):
+        """再クラスタリングを1回実行（既に実行中なら何もせず None）
+
+        measure_memory=True ならメモリ使用量のピークも計測する（計測中は全スレッドの割り当てが遅くなる）
+        """
+        with self.lock:
+            if self.running:
+                return None
+            self.running = True
+            self.last_reason = reason
+            self.last_started_at = time.time()
+
+        started = time.perf_counter()
+        try:
+            result = self.job(measure_memory=measure_memory)
+            error = result.get("error") if isinstance(result, dict) else None
+        except Exception as e:
+            result, error = None, str(e)
+
+        with self.lock:
+            self.running = False
+            self.runs += 1
+            self.last_duration_seconds = time.perf_counter() - started
+            self.last_result = result
+            self.last_error = error
+            if error is not None:
+                self.failures += 1
+        return result
+
+    def trigger(self, reason: str = "manual", measure_memory: bool = False) -> bool:
+        """別スレッドで再クラスタリングを始める（既に実行中なら False）"""
+        if self.running:
+            return False
+        threading.Thread(target=self.run_once, args=(reason, measure_memory), daemon=True).start()
+        return True
+
+    def run_forever(self):
+        """check_seconds ごとに判定し、必要なら再クラスタリングする"""
+        while not self._stop.wait(self.check_seconds):
+            try:
+                reason = self.due()
+                if reason is not None:
+                    self.run_once(reason)
+            except Exception as e:
+                with self.lock:
+                    self.failures += 1
+                    self.last_error = str(e)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def metrics(self) -> dict:
+        model = get_cluster_model()
+        with self.lock:
+            return {
+                "scheduler_running": self._thread is not None and self._thread.is_alive(),
+                "clustering_running": self.running,
+                "runs": self.runs,
+                "failures": self.failures,
+                "last_reason": self.last_reason,
+                "last_started_at": self.last_started_at,
+                "last_duration_seconds": self.last_duration_seconds,
+                "last_error": self.last_error,
+                # 前回の結果（学習時間 fit_seconds、メモリ使用量のピーク peak_memory_mb など）
+                "last_result": self.last_result,
+                "model_version": None if model is None else model.version,
+                # モデルの古さ（学習からの経過秒数と、その後に登録されたユーザー数）
+                "model_age_seconds": None if model is None else time.time() - model.created_at,
+                "new_users_since_model": self.new_users(),
+                "min_new_users": self.min_new_users,
+                "interval_seconds": self.interval_seconds,
+            }
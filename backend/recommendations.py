@@ -0,0 +1,314 @@
+import threading
+import time
+import numpy as np
+from postgrest.exceptions import APIError
+from repository import repository
+from attribute_store import attribute_store
+from config import RECOMMENDATIONS_MAX_AGE_SECONDS, RECOMMENDATIONS_TABLE_CHECK_SECONDS
+from match_scoring import score_block, score_as_candidate, top_k_matches
+
+
+class TopKLists:
+    """事前計算したおすすめ（ユーザーごとの上位 k 人）をメモリ上に保持する"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.k = 0
+        self.lists = {}     # user_id -> [{"user_id": ..., "match_score": ...}, ...]
+        self.reverse = {}   # user_id -> そのユーザーをおすすめに含んでいる user_id の集合
+        self.synced_at = 0.0
+        self.synced_changes = -1  # 属性と一致していることを確認した時点の attribute_store.changes
+        self.generation = 0  # 一括計算で丸ごと入れ替えるたびに増やす
+
+    def replace(self, results: dict, k: int, synced_changes: int):
+        with self.lock:
+            self.k = k
+            self.lists = {}
+            self.reverse = {}
+            for user_id, matches in results.items():
+                self.set_list(user_id, matches)
+            self.synced_at = time.time()
+            self.synced_changes = synced_changes
+            self.generation += 1
+
+    def set_list(self, user_id: str, matches: list):
+        with self.lock:
+            for match in self.lists.get(user_id, []):
+                self.reverse.get(match["user_id"], set()).discard(user_id)
+            self.lists[user_id] = matches
+            for match in matches:
+                self.reverse.setdefault(match["user_id"], set()).add(user_id)
+
+    def remove_list(self, user_id: str):
+        with self.lock:
+            if user_id in self.lists:
+                self.set_list(user_id, [])
+                del self.lists[user_id]
+
+    def clear(self):
+        """メモリ上のおすすめを捨てる（次の一括計算までは recommendations テーブルから返す）"""
+        with self.lock:
+            self.k = 0
+            self.lists = {}
+            self.reverse = {}
+            self.synced_changes = -1
+            self.generation += 1
+
+    def insert(self, user_id: str, candidate_id: str, score: float, k: int, positions: dict):
+        """user_id のリストに candidate_id を差し込んだ上位 k 人を返す（変わらなければ None）"""
+        with self.lock:
+            current = self.lists.get(user_id)
+            if current is None:
+                return None
+            merged = [match for match in current if match["user_id"] != candidate_id]
+            merged.append({"user_id": candidate_id, "match_score": score})
+            merged.sort(key=lambda match: (-match["match_score"], positions.get(match["user_id"], len(positions))))
+            return merged[:k] if merged[:k] != current else None
+
+    def is_fresh(self) -> bool:
+        return (
+            bool(self.lists)
+            and self.synced_changes == attribute_store.changes
+            and time.time() - self.synced_at <= RECOMMENDATIONS_MAX_AGE_SECONDS
+        )
+
+
+top_k_lists = TopKLists()
+
+
+class RecommendationTable:
+    """recommendations テーブルを読んでよいかを覚えておく
+
+    - 一括計算の前（行が無い）やテーブルを作っていない間は、/matching_result のたびに問い合わせない
+    - 行があるかは check_seconds ごとに1回だけ確かめる（他のインスタンスが一括計算した場合に気づけるように）
+    """
+
+    def __init__(self, repository, check_seconds: float = RECOMMENDATIONS_TABLE_CHECK_SECONDS):
+        self.repository = repository
+        self.check_seconds = check_seconds
+        self.lock = threading.Lock()
+        self.has_rows = None
+        self.checked_at = 0.0
+
+    def available(self) -> bool:
+        with self.lock:
+            if self.has_rows is not None and time.monotonic() - self.checked_at <= self.check_seconds:
+                return self.has_rows
+        try:
+            has_rows = self.repository.has_recommendations()
+        except APIError:
+            # /create-recommendations をまだ実行していない
+            has_rows = False
+        self.mark(has_rows)
+        return has_rows
+
+    def mark(self, has_rows):
+        """一括計算・削除の後に呼ぶ（None なら次の available で確かめ直す）"""
+        with self.lock:
+            self.has_rows = has_rows
+            self.checked_at = time.monotonic()
+
+    def read(self, user_id: str, k: int):
+        """user_id のおすすめの行（読めなければ None）"""
+        if not self.available():
+            return None
+        try:
+            return self.repository.recommendations(user_id, k)
+        except APIError:
+            self.mark(False)
+            return None
+
+    def forget_user(self, user_id: str):
+        """このプロセスにリストが無いときの更新：本人と、本人を含むおすすめの行を消す（他のインスタンスが古い行を返さないように）"""
+        if not self.available():
+            return
+        try:
+            self.repository.delete_recommendations(user_id)
+            self.repository.delete_recommendations(target_user_id=user_id)
+        except APIError:
+            self.mark(False)
+
+
+recommendation_table = RecommendationTable(repository)
+
+
+def compute_top_k(encoded, k: int = 5, chunk_size: int = 1000, rows=None) -> dict:
+    """全ユーザー（rows 指定時はその行だけ）の上位 k 人を計算（メモリは chunk_size×ユーザー数 に抑える）"""
+    if rows is None:
+        rows = np.arange(len(encoded))
+    results = {}
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        block = score_block(encoded, chunk)
+        for offset, row in enumerate(chunk):
+            results[encoded.user_ids[row]] = top_k_matches(encoded.user_ids, block[offset], k, exclude=[row])
+    return results
+
+
+def write_recommendations(results: dict, computed_at: float, k: int, batch_size: int = 1000) -> int:
+    """計算結果を recommendations テーブルにまとめて書き込み、書き込んだ行数を返す"""
+    rows = [
+        {
+            "user_id": user_id,
+            "rank": rank,
+            "target_user_id": match["user_id"],
+            "match_score": match["match_score"],
+            "computed_at": computed_at,
+        }
+        for user_id, matches in results.items()
+        for rank, match in enumerate(matches, start=1)
+    ]
+    for start in range(0, len(rows), batch_size):
+        repository.upsert_recommendations(rows[start:start + batch_size])
+
+    # 候補が k 人に満たないユーザーは、前回の余分な順位を消す
+    for user_id, matches in results.items():
+        if len(matches) < k:
+            repository.delete_recommendations(user_id, after_rank=len(matches))
+    return len(rows)
+
+
+def precompute_recommendations(k: int = 5, chunk_size: int = 1000, batch_size: int = 1000) -> dict:
+    """全ユーザーのおすすめを一括で計算して recommendations テーブルに保存"""
+    computed_at = time.time()
+    changes = attribute_store.changes
+    encoded, _ = attribute_store.encoded()
+
+    started = time.perf_counter()
+    results = compute_top_k(encoded, k, chunk_size)
+    compute_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    written = write_recommendations(results, computed_at, k, batch_size)
+    # k を小さくして再計算した場合に、前回の余分な順位を消す
+    repository.delete_recommendations(after_rank=k)
+    write_seconds = time.perf_counter() - started
+
+    top_k_lists.replace(results, k, changes)
+    recommendation_table.mark(written > 0)
+
+    return {
+        "users": len(encoded),
+        "rows": written,
+        "compute_seconds": compute_seconds,
+        "write_seconds": write_seconds,
+        "rows_per_second": written / write_seconds if write_seconds > 0 else None,
+    }
+
+
+def update_recommendations_for_user(user_id: str, changes_before: int):
+    """1ユーザーの登録・更新・削除をおすすめに反映する（全件の再計算はしない）
+
+    - 本人のおすすめを計算し直す
+    - 他の全ユーザーから見た本人のマッチ度を一度だけ計算し、k 位より上になったユーザーのリストにだけ差し込む
+    - 本人がリストに入っていて、スコアが下がった（または削除された）ユーザーはそのユーザーだけ再計算する
+    - このプロセスにリストが無ければ、recommendations テーブルから本人に関わる行を消すだけにする
+    changes_before は呼び出し側が attribute_store を更新する前の attribute_store.changes
+    """
+    # 計算に使うリストの写しだけをロックの中で取り、計算と書き込みはロックの外で行う
+    # （fresh_recommendations が同じロックで待たされないように）
+    with top_k_lists.lock:
+        has_lists = bool(top_k_lists.lists)
+        # 属性が変わっていなければ何もしない（リストが無いときは、このプロセスの
+        # スナップショットが書き込みより後に読まれたこともあるので下で必ず消す）
+        if has_lists and attribute_store.changes == changes_before:
+            return {"changed_users": 0}
+
+        k = top_k_lists.k
+        generation = top_k_lists.generation
+        lists = dict(top_k_lists.lists)
+        holders = set(top_k_lists.reverse.get(user_id, ()))
+        changes_after = attribute_store.changes
+
+    if not has_lists:
+        # 差分で直せないので、テーブルからこのユーザーに関わる行を消して、その分は計算し直させる
+        recommendation_table.forget_user(user_id)
+        return None
+
+    started = time.perf_counter()
+    encoded, positions = attribute_store.encoded()
+    changed = {}
+    inserts = {}  # other -> 本人のマッチ度（入れ替えるときに最新のリストへ差し込む）
+    repair = set()
+    deleted = user_id not in positions
+
+    if not deleted:
+        row = positions[user_id]
+        changed.update(compute_top_k(encoded, k, rows=np.array([row])))
+
+        # 本人が候補になったときの、全ユーザーから見たマッチ度
+        scores = score_as_candidate(encoded, row)
+        kth_scores = np.array([
+            lists[other][-1]["match_score"] if other in lists and len(lists[other]) >= k else -np.inf
+            for other in encoded.user_ids
+        ])
+        affected = set(np.flatnonzero(np.round(scores, 2) >= kth_scores).tolist())
+        affected |= {positions[other] for other in holders if other in positions}
+        affected.discard(row)
+
+        for other_row in affected:
+            other = encoded.user_ids[other_row]
+            current = lists.get(other)
+            score = float(round(scores[other_row], 2))
+            previous = next((match for match in current or [] if match["user_id"] == user_id), None)
+            if current is None or (previous is not None and score < previous["match_score"]):
+                repair.add(other_row)
+            else:
+                inserts[other] = score
+    else:
+        # 削除：本人のリストを消し、本人を含んでいたユーザーだけ再計算
+        repair = {positions[other] for other in holders if other in positions}
+
+    if repair:
+        changed.update(compute_top_k(encoded, k, rows=np.array(sorted(repair))))
+
+    # 計算している間に一括計算で入れ替わっていたら、古いリストを元にした結果は捨てる
+    with top_k_lists.lock:
+        if top_k_lists.generation != generation:
+            return {"changed_users": 0, "repaired_users": 0, "seconds": time.perf_counter() - started}
+
+        for other, score in inserts.items():
+            merged = top_k_lists.insert(other, user_id, score, k, positions)
+            if merged is not None:
+                changed[other] = merged
+        if deleted:
+            top_k_lists.remove_list(user_id)
+            top_k_lists.reverse.pop(user_id, None)
+        for other, matches in changed.items():
+            top_k_lists.set_list(other, matches)
+
+        # 他の変更を取りこぼしていたら、反映はしても「最新」とはみなさない（次回の一括計算を待つ）
+        if top_k_lists.synced_changes == changes_before:
+            top_k_lists.synced_at = time.time()
+            top_k_lists.synced_changes = changes_after
+
+    if deleted:
+        repository.delete_recommendations(user_id)
+    write_recommendations(changed, time.time(), k)
+
+    return {
+        "changed_users": len(changed),
+        "repaired_users": len(repair),
+        "seconds": time.perf_counter() - started,
+    }
+
+
+def fresh_recommendations(user_id: str, k: int = 5):
+    """事前計算が新しければそのおすすめを返す（古い・無い場合は None）"""
+    # このプロセスで計算・差分更新したものがあればそれを使う
+    with top_k_lists.lock:
+        if top_k_lists.is_fresh() and top_k_lists.k >= k and user_id in top_k_lists.lists:
+            return top_k_lists.lists[user_id][:k]
+
+    # 一括計算の後だけテーブルを読む（テーブルが無い・読めないときはその場で計算する）
+    rows = recommendation_table.read(user_id, k)
+    if rows is None or len(rows) < k:
+        return None
+
+    # 他のインスタンスでの変更は update_recommendations_for_user が行を書き直す・消すので、
+    # ここではこのプロセスで計算後に属性が変わっていたり、一定時間が過ぎていたら使わない
+    computed_at = min(row["computed_at"] for row in rows)
+    if computed_at < attribute_store.changed_at or time.time() - computed_at > RECOMMENDATIONS_MAX_AGE_SECONDS:
+        return None
+
+    return [{"user_id": row["target_user_id"], "match_score": row["match_score"]} for row in rows]
@@ -0,0 +1,504 @@
+import json
+import sqlite3
+import threading
+from postgrest import CountMethod, ReturnMethod
+from postgrest.exceptions import APIError
+from hobby_similarity import encode_hobbies
+from config import DATA_BACKEND, REPOSITORY_IN_CHUNK_SIZE, REPOSITORY_PAGE_SIZE, SQLITE_PATH
+
+# users / user_attributes / likes / recommendations の読み書きはこのモジュールを通す
+#   DATA_BACKEND=supabase: Supabase（PostgREST）
+#   DATA_BACKEND=sqlite:   ローカルの SQLite（SQLITE_PATH=":memory:" ならメモリ上だけ）。Supabase 無しで負荷試験できる
+# どちらも同じメソッドを持ち、戻り値は Supabase の .data と同じ形（行の dict のリスト）にする
+# 全件の読み出しは主キー順のキーセット方式で REPOSITORY_PAGE_SIZE 件ずつ取得する
+# （PostgREST は1回の応答を max-rows 件で打ち切るので、ページに分けないと大きなテーブルは途中までしか読めない）
+
+# いいねを問い合わせるときの列
+LIKE_COLUMNS = ("user_id", "target_user_id")
+# おすすめを読み出すときの列
+RECOMMENDATION_COLUMNS = ("rank", "target_user_id", "match_score", "computed_at")
+
+
+def is_missing_hobby_ids(error: APIError) -> bool:
+    """/migrate-hobby-ids をまだ実行していない DB で hobby_ids 列を読んだときのエラーか"""
+    return error.code == "42703" and "hobby_ids" in (error.message or "")
+
+
+def with_key(columns: tuple, key: str) -> tuple:
+    """キーセット方式で読むときは、キーの列も取得する"""
+    return columns if "*" in columns or key in columns else (key, *columns)
+
+
+def uuid_prefix_range(prefix: str) -> tuple:
+    """prefix で始まる UUID の最小値と最大値（UUID 型の列は LIKE できないので範囲で絞る）"""
+    template = "00000000-0000-0000-0000-000000000000"
+    if len(prefix) > len(template):
+        raise ValueError(f"prefix is longer than a UUID: {prefix}")
+    rest = template[len(prefix):]
+    return prefix + rest, prefix + rest.replace("0", "f")
+
+
+class SupabaseRepository:
+    """Supabase（PostgREST）でのデータアクセス"""
+
+    def __init__(self, client, page_size: int = REPOSITORY_PAGE_SIZE, in_chunk_size: int = REPOSITORY_IN_CHUNK_SIZE):
+        self.client = client
+        self.page_size = page_size
+        self.in_chunk_size = in_chunk_size
+        # user_attributes.hobby_ids 列があるか（None は未確認、False なら hobbies を読んでここで趣味 ID にする）
+        self.has_hobby_ids = None
+
+    # ---------- 共通 ----------
+
+    def pages(self, table: str, columns: tuple, key: str, page_size: int = None):
+        """table を key の順に page_size 件ずつ返す（キーセット方式、columns の列だけ取得する）"""
+        page_size = page_size or self.page_size
+        columns = with_key(columns, key)
+        last_key = None
+        while True:
+            query = self.client.table(table).select(*columns).order(key).limit(page_size)
+            if last_key is not None:
+                query = query.gt(key, last_key)
+            rows = query.execute().data
+            if not rows:
+                return
+            yield rows
+            if len(rows) < page_size:
+                return
+            last_key = rows[-1][key]
+
+    def select_in(self, table: str, columns: tuple, key: str, values) -> list:
+        """key が values のいずれかの行（URL が長くなりすぎないよう in_chunk_size 件ずつ問い合わせる）"""
+        values = list(values)
+        rows = []
+        for start in range(0, len(values), self.in_chunk_size):
+            rows += self.client.table(table).select(*columns).in_(key, values[start:start + self.in_chunk_size]).execute().data
+        return rows
+
+    # ---------- users ----------
+
+    def user_clusters(self, user_ids: list = None) -> dict:
+        """user_id -> cluster（未割り当ては None）。user_ids を省略すると全員分"""
+        if user_ids is None:
+            users = [user for page in self.pages("users", ("id", "cluster"), "id") for user in page]
+        else:
+            users = self.select_in("users", ("id", "cluster"), "id", user_ids)
+        return {user["id"]: user["cluster"] for user in users}
+
+    def users_by_ids(self, user_ids: list, columns: tuple = ("*",)) -> list:
+        return self.select_in("users", columns, "id", user_ids)
+
+    def user_by_slack_id(self, slack_id: str, columns: tuple = ("*",)):
+        rows = self.client.table("users").select(*columns).eq("slack_id", slack_id).execute().data
+        return rows[0] if rows else None
+
+    def delete_users_with_prefix(self, prefix: str) -> int:
+        """ID が prefix で始まるユーザーを属性ごと消し、消したユーザー数を返す（いいね・おすすめは CASCADE で消える）"""
+        lower, upper = uuid_prefix_range(prefix)
+        self.client.table("user_attributes").delete(returning=ReturnMethod.minimal).gte("user_id", lower).lte("user_id", upper).execute()
+        response = (
+            self.client.table("users")
+            .delete(count=CountMethod.exact, returning=ReturnMethod.minimal)
+            .gte("id", lower)
+            .lte("id", upper)
+            .execute()
+        )
+        return response.count or 0
+
+    def insert_users(self, rows: list):
+        self.client.table("users").insert(rows, returning=ReturnMethod.minimal).execute()
+
+    # ---------- user_attributes ----------
+
+    def attributes(self, user_ids: list = None, columns: tuple = ("*",)) -> list:
+        """属性の行（user_ids を省略すると全員分）"""
+        if user_ids is None:
+            return [row for page in self.attribute_pages(columns=columns) for row in page]
+        try:
+            rows = self.select_in("user_attributes", self.attribute_columns(columns), "user_id", user_ids)
+        except APIError as e:
+            if not is_missing_hobby_ids(e):
+                raise
+            self.has_hobby_ids = False
+            rows = self.select_in("user_attributes", self.attribute_columns(columns), "user_id", user_ids)
+        return self.with_hobby_ids(rows, columns)
+
+    def attribute_pages(self, page_size: int = None, columns: tuple = ("*",)):
+        """属性を user_id 順に page_size 件ずつ返す（全件をメモリに載せずに処理する場合に使う）"""
+        pages = self.pages("user_attributes", self.attribute_columns(columns), "user_id", page_size)
+        try:
+            first = next(pages, None)
+        except APIError as e:
+            if not is_missing_hobby_ids(e):
+                raise
+            self.has_hobby_ids = False
+            pages = self.pages("user_attributes", self.attribute_columns(columns), "user_id", page_size)
+            first = next(pages, None)
+        if first is None:
+            return
+        yield self.with_hobby_ids(first, columns)
+        for page in pages:
+            yield self.with_hobby_ids(page, columns)
+
+    def attribute_columns(self, columns: tuple) -> tuple:
+        """hobby_ids 列が無い DB では、代わりに hobbies を読む"""
+        if self.has_hobby_ids is not False or "hobby_ids" not in columns:
+            return columns
+        return tuple(dict.fromkeys("hobbies" if column == "hobby_ids" else column for column in columns))
+
+    def with_hobby_ids(self, rows: list, columns: tuple) -> list:
+        """hobby_ids 列が無い DB から読んだ行に、hobbies から作った hobby_ids を付ける（語彙にない趣味は読み飛ばす）"""
+        if self.has_hobby_ids is None and rows and ("*" in columns or "hobby_ids" in columns):
+            self.has_hobby_ids = "hobby_ids" in rows[0]
+        if self.has_hobby_ids is not False or not ("*" in columns or "hobby_ids" in columns):
+            return rows
+        for row in rows:
+            row["hobby_ids"] = encode_hobbies(row["hobbies"], skip_unknown=True)
+            if "*" not in columns and "hobbies" not in columns:
+                del row["hobbies"]
+        return rows
+
+    def insert_attributes(self, rows: list):
+        """属性をまとめて追加（hobby_ids はトリガーが hobbies から作る）"""
+        self.client.table("user_attributes").insert(rows, returning=ReturnMethod.minimal).execute()
+
+    def write_hobby_ids(self, assignments: list) -> int:
+        """[{"user_id": ..., "hobby_ids": [...]}] を1回の呼び出しで user_attributes.hobby_ids に書き込み、更新した行数を返す"""
+        response = self.client.rpc("update_hobby_ids", {"assignments": assignments}).execute()
+        return response.data if isinstance(response.data, int) else len(assignments)
+
+    # ---------- likes ----------
+
+    def likes(self) -> list:
+        """全てのいいね（user_id, target_user_id）"""
+        return [like for page in self.pages("likes", LIKE_COLUMNS, "id") for like in page]
+
+    def liked_targets(self, user_id: str) -> set:
+        """user_id がいいねした相手"""
+        rows = self.client.table("likes").select("target_user_id").eq("user_id", user_id).execute().data
+        return {row["target_user_id"] for row in rows}
+
+    def likers_among(self, user_id: str, user_ids) -> set:
+        """user_ids のうち user_id をいいねした相手"""
+        user_ids = list(user_ids)
+        likers = set()
+        for start in range(0, len(user_ids), self.in_chunk_size):
+            chunk = user_ids[start:start + self.in_chunk_size]
+            rows = self.client.table("likes").select("user_id").eq("target_user_id", user_id).in_("user_id", chunk).execute().data
+            likers.update(row["user_id"] for row in rows)
+        return likers
+
+    def likes_between(self, user_id: str, other_user_ids: list) -> list:
+        """user_id と other_user_ids の間の両方向のいいね（in_chunk_size 人ごとに1回の問い合わせ）"""
+        other_user_ids = list(other_user_ids)
+        likes = []
+        for start in range(0, len(other_user_ids), self.in_chunk_size):
+            ids = ",".join(other_user_ids[start:start + self.in_chunk_size])
+            likes += (
+                self.client.table("likes")
+                .select(*LIKE_COLUMNS)
+                .or_(f"and(user_id.eq.{user_id},target_user_id.in.({ids})),and(target_user_id.eq.{user_id},user_id.in.({ids}))")
+                .execute()
+                .data
+            )
+        return likes
+
+    def insert_likes(self, rows: list):
+        """いいねをまとめて追加（既にある組は無視する）"""
+        self.client.table("likes").upsert(
+            rows, on_conflict="user_id,target_user_id", ignore_duplicates=True, returning=ReturnMethod.minimal
+        ).execute()
+
+    # ---------- clusters ----------
+
+    def write_clusters(self, assignments: list) -> int:
+        """[{"id": ..., "cluster": ...}] を1回の呼び出しで users.cluster に書き込み、更新した行数を返す"""
+        response = self.client.rpc("update_user_clusters", {"assignments": assignments}).execute()
+        return response.data if isinstance(response.data, int) else len(assignments)
+
+    # ---------- recommendations ----------
+
+    def has_recommendations(self) -> bool:
+        """recommendations テーブルに1行でもあるか（テーブルが無ければ APIError）"""
+        return bool(self.client.table("recommendations").select("rank").limit(1).execute().data)
+
+    def recommendations(self, user_id: str, k: int) -> list:
+        return (
+            self.client.table("recommendations")
+            .select(*RECOMMENDATION_COLUMNS)
+            .eq("user_id", user_id)
+            .order("rank")
+            .limit(k)
+            .execute()
+            .data
+        )
+
+    def upsert_recommendations(self, rows: list):
+        self.client.table("recommendations").upsert(rows, on_conflict="user_id,rank").execute()
+
+    def delete_recommendations(self, user_id: str = None, after_rank: int = None, target_user_id: str = None):
+        """user_id のおすすめ（省略すると全員分）のうち after_rank より後の順位（省略すると全て）を消す
+
+        target_user_id を指定すると、そのユーザーを含むおすすめの行を消す
+        """
+        if user_id is None and after_rank is None and target_user_id is None:
+            raise ValueError("user_id, after_rank or target_user_id is required")
+        query = self.client.table("recommendations").delete()
+        if user_id is not None:
+            query = query.eq("user_id", user_id)
+        if target_user_id is not None:
+            query = query.eq("target_user_id", target_user_id)
+        if after_rank is not None:
+            query = query.gt("rank", after_rank)
+        query.execute()
+
+
+# SQLite 用のテーブル（Supabase 側は routes/database.py のクエリで作成する）
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    email TEXT UNIQUE NOT NULL,
+    slack_id TEXT NOT NULL,
+    password TEXT NOT NULL,
+    cluster INTEGER,
+    created_at TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS users_slack_id_idx ON users(slack_id);
+
+CREATE TABLE IF NOT EXISTS user_attributes (
+    user_id TEXT PRIMARY KEY REFERENCES users(id),
+    hobbies TEXT NOT NULL,
+    hobby_ids TEXT NOT NULL,
+    hometown TEXT,
+    field TEXT NOT NULL,
+    role TEXT NOT NULL,
+    mbti TEXT NOT NULL,
+    alma_mater TEXT NOT NULL,
+    preferences TEXT NOT NULL,
+    self_introductions TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS likes (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT REFERENCES users(id) ON DELETE CASCADE,
+    target_user_id TEXT REFERENCES users(id) ON DELETE CASCADE,
+    reasons TEXT NOT NULL,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE UNIQUE INDEX IF NOT EXISTS likes_user_id_target_user_id_idx ON likes(user_id, target_user_id);
+CREATE INDEX IF NOT EXISTS likes_target_user_id_idx ON likes(target_user_id);
+
+CREATE TABLE IF NOT EXISTS recommendations (
+    user_id TEXT REFERENCES users(id) ON DELETE CASCADE,
+    rank INTEGER NOT NULL,
+    target_user_id TEXT REFERENCES users(id) ON DELETE CASCADE,
+    match_score REAL NOT NULL,
+    computed_at REAL NOT NULL,
+    PRIMARY KEY (user_id, rank)
+);
+CREATE INDEX IF NOT EXISTS recommendations_target_user_id_idx ON recommendations(target_user_id);
+"""
+
+# SQLite の1文あたりのパラメータ数の上限より小さくする
+SQLITE_MAX_PARAMS = 900
+
+
+class SQLiteRepository:
+    """ローカルの SQLite でのデータアクセス（SupabaseRepository と同じメソッド）
+
+    接続は1つをロックで守って使い回す。path=":memory:" ならメモリ上だけに置く
+    """
+
+    def __init__(self, path: str = SQLITE_PATH, page_size: int = REPOSITORY_PAGE_SIZE):
+        self.path = path
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute("PRAGMA foreign_keys = ON")
+            if path != ":memory:":
+                self.connection.execute("PRAGMA journal_mode = WAL")
+                self.connection.execute("PRAGMA synchronous = NORMAL")
+            self.connection.executescript(SQLITE_SCHEMA)
+            # hobby_ids が無かった頃のファイルには列を追加する（/migrate-hobby-ids で埋める）
+            columns = {row[1] for row in self.connection.execute("PRAGMA table_info(user_attributes)")}
+            if "hobby_ids" not in columns:
+                self.connection.execute("ALTER TABLE user_attributes ADD COLUMN hobby_ids TEXT")
+
+    # ---------- 共通 ----------
+
+    @staticmethod
+    def _columns(columns: tuple) -> str:
+        return ", ".join(column if column == "*" else f'"{column}"' for column in columns)
+
+    def _query(self, sql: str, params=()) -> list:
+        with self.lock:
+            rows = [dict(row) for row in self.connection.execute(sql, params)]
+        # hobby_ids は JSON の配列で保存している
+        if rows and "hobby_ids" in rows[0]:
+            for row in rows:
+                if row["hobby_ids"] is not None:
+                    row["hobby_ids"] = json.loads(row["hobby_ids"])
+        return rows
+
+    def _query_in(self, sql: str, values, params=()) -> list:
+        """sql の {in} を (?, ?, ...) に置き換えて、values を分割しながら問い合わせる"""
+        values = list(values)
+        rows = []
+        for start in range(0, len(values), SQLITE_MAX_PARAMS):
+            chunk = values[start:start + SQLITE_MAX_PARAMS]
+            rows += self._query(sql.format(**{"in": "(" + ", ".join("?" * len(chunk)) + ")"}), (*params, *chunk))
+        return rows
+
+    def _insert(self, table: str, rows: list, conflict: str = ""):
+        if not rows:
+            return
+        columns = list(rows[0])
+        sql = (
+            f"INSERT {conflict} INTO {table} ({self._columns(columns)}) "
+            f"VALUES ({', '.join(':' + column for column in columns)})"
+        )
+        with self.lock:
+            self.connection.executemany(sql, rows)
+            self.connection.commit()
+
+    # ---------- users ----------
+
+    def user_clusters(self, user_ids: list = None) -> dict:
+        if user_ids is None:
+            rows = self._query("SELECT id, cluster FROM users")
+        else:
+            rows = self._query_in("SELECT id, cluster FROM users WHERE id IN {in}", user_ids)
+        return {user["id"]: user["cluster"] for user in rows}
+
+    def users_by_ids(self, user_ids: list, columns: tuple = ("*",)) -> list:
+        return self._query_in(f"SELECT {self._columns(columns)} FROM users WHERE id IN {{in}}", user_ids)
+
+    def user_by_slack_id(self, slack_id: str, columns: tuple = ("*",)):
+        rows = self._query(f"SELECT {self._columns(columns)} FROM users WHERE slack_id = ?", (slack_id,))
+        return rows[0] if rows else None
+
+    def delete_users_with_prefix(self, prefix: str) -> int:
+        lower, upper = uuid_prefix_range(prefix)
+        with self.lock:
+            self.connection.execute("DELETE FROM user_attributes WHERE user_id BETWEEN ? AND ?", (lower, upper))
+            deleted = self.connection.execute("DELETE FROM users WHERE id BETWEEN ? AND ?", (lower, upper)).rowcount
+            self.connection.commit()
+        return deleted
+
+    def insert_users(self, rows: list):
+        self._insert("users", rows)
+
+    # ---------- user_attributes ----------
+
+    def attributes(self, user_ids: list = None, columns: tuple = ("*",)) -> list:
+        sql = f"SELECT {self._columns(columns)} FROM user_attributes"
+        if user_ids is None:
+            return self._query(sql)
+        return self._query_in(sql + " WHERE user_id IN {in}", user_ids)
+
+    def attribute_pages(self, page_size: int = None, columns: tuple = ("*",)):
+        page_size = page_size or self.page_size
+        sql = f"SELECT {self._columns(with_key(columns, 'user_id'))} FROM user_attributes WHERE user_id > ? ORDER BY user_id LIMIT ?"
+        last_user_id = ""
+        while True:
+            rows = self._query(sql, (last_user_id, page_size))
+            if not rows:
+                return
+            yield rows
+            if len(rows) < page_size:
+                return
+            last_user_id = rows[-1]["user_id"]
+
+    def insert_attributes(self, rows: list):
+        """hobby_ids は書き込み時に hobbies から作る（Supabase のトリガーと同じく、語彙にない趣味は ValueError）"""
+        self._insert("user_attributes", [{**row, "hobby_ids": json.dumps(encode_hobbies(row["hobbies"]))} for row in rows])
+
+    def write_hobby_ids(self, assignments: list) -> int:
+        with self.lock:
+            cursor = self.connection.executemany(
+                "UPDATE user_attributes SET hobby_ids = ? WHERE user_id = ?",
+                [(json.dumps(row["hobby_ids"]), row["user_id"]) for row in assignments],
+            )
+            self.connection.commit()
+            return cursor.rowcount
+
+    # ---------- likes ----------
+
+    def likes(self) -> list:
+        return self._query(f"SELECT {self._columns(LIKE_COLUMNS)} FROM likes")
+
+    def liked_targets(self, user_id: str) -> set:
+        rows = self._query("SELECT target_user_id FROM likes WHERE user_id = ?", (user_id,))
+        return {row["target_user_id"] for row in rows}
+
+    def likers_among(self, user_id: str, user_ids) -> set:
+        rows = self._query_in("SELECT user_id FROM likes WHERE target_user_id = ? AND user_id IN {in}", user_ids, (user_id,))
+        return {row["user_id"] for row in rows}
+
+    def likes_between(self, user_id: str, other_user_ids: list) -> list:
+        outbound = self._query_in(
+            f"SELECT {self._columns(LIKE_COLUMNS)} FROM likes WHERE user_id = ? AND target_user_id IN {{in}}", other_user_ids, (user_id,)
+        )
+        inbound = self._query_in(
+            f"SELECT {self._columns(LIKE_COLUMNS)} FROM likes WHERE target_user_id = ? AND user_id IN {{in}}", other_user_ids, (user_id,)
+        )
+        return outbound + inbound
+
+    def insert_likes(self, rows: list):
+        self._insert("likes", rows, conflict="OR IGNORE")
+
+    # ---------- clusters ----------
+
+    def write_clusters(self, assignments: list) -> int:
+        with self.lock:
+            before = self.connection.total_changes
+            self.connection.executemany("UPDATE users SET cluster = :cluster WHERE id = :id", assignments)
+            self.connection.commit()
+            return self.connection.total_changes - before
+
+    # ---------- recommendations ----------
+
+    def has_recommendations(self) -> bool:
+        return bool(self._query("SELECT rank FROM recommendations LIMIT 1"))
+
+    def recommendations(self, user_id: str, k: int) -> list:
+        return self._query(
+            f"SELECT {self._columns(RECOMMENDATION_COLUMNS)} FROM recommendations WHERE user_id = ? ORDER BY rank LIMIT ?",
+            (user_id, k),
+        )
+
+    def upsert_recommendations(self, rows: list):
+        self._insert("recommendations", rows, conflict="OR REPLACE")
+
+    def delete_recommendations(self, user_id: str = None, after_rank: int = None, target_user_id: str = None):
+        if user_id is None and after_rank is None and target_user_id is None:
+            raise ValueError("user_id, after_rank or target_user_id is required")
+        conditions, params = [], []
+        if user_id is not None:
+            conditions.append("user_id = ?")
+            params.append(user_id)
+        if target_user_id is not None:
+            conditions.append("target_user_id = ?")
+            params.append(target_user_id)
+        if after_rank is not None:
+            conditions.append("rank > ?")
+            params.append(after_rank)
+        with self.lock:
+            self.connection.execute(f"DELETE FROM recommendations WHERE {' AND '.join(conditions)}", params)
+            self.connection.commit()
+
+
+def create_repository(backend: str = DATA_BACKEND):
+    if backend == "supabase":
+        from supabase_client import supabase
+
+        return SupabaseRepository(supabase)
+    if backend == "sqlite":
+        return SQLiteRepository(SQLITE_PATH)
+    raise ValueError(f"unknown DATA_BACKEND: {backend}")
+
+
+repository = create_repository()
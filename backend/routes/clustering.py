@@ -1,21 +1,35 @@
 from fastapi import APIRouter
-from supabase_client import supabase
+from attribute_store import attribute_store
+from recommendations import update_recommendations_for_user
+from cluster_writer import write_cluster_assignments
+from cluster_model import (
+    ClusterModel,
+    assign_user,
+    get_cluster_model,
+    next_model_version,
+    publish_cluster_model,
+    swap_cluster_snapshot,
+)
+from sparse_clustering import cluster_sparse
+from feature_store import feature_store, one_hot
+from config import CLUSTERING_MODE
+from recluster_scheduler import ReclusterScheduler
+import time
+import tracemalloc
 import pandas as pd
 from sklearn.cluster import KMeans
-from sklearn.preprocessing import MultiLabelBinarizer, OneHotEncoder
-from sklearn.neighbors import NearestCentroid
 
 router = APIRouter()
 
 def fetch_user_attributes():
     """user_attributes テーブルのデータを取得して DataFrame に変換"""
-    user_attributes = supabase.table("user_attributes").select("*").execute()
+    # メモリ上のスナップショットから取得（Supabase には TTL 切れのときだけ問い合わせる）
+    data = attribute_store.all()
 
-    if not user_attributes:
+    if not data:
         return {"error": "User not found"}
 
-    # Supabase からのレスポンスを Pandas DataFrame に変換
-    data = user_attributes.data
+    # Pandas DataFrame に変換
     df = pd.DataFrame(data)
 
     return df
@@ -23,46 +37,76 @@ def fetch_user_attributes():
 def clustering(df_user_attributes):
     """ユーザー属性データをクラスタリング"""
     # データの前処理
-    # ラベルエンコーディング
-    mlb = MultiLabelBinarizer()
-    df_user_attributes["hobbies"] = df_user_attributes["hobbies"].apply(lambda x: x.split(", "))
-    hobby_features = pd.DataFrame(mlb.fit_transform(df_user_attributes["hobbies"]), columns=mlb.classes_)
-    df_processed = pd.concat([df_user_attributes.drop("hobbies", axis=1), hobby_features], axis=1)
-
-    # One-hot エンコーディングを適用するカラム
-    categorical_columns = ["hometown", "field", "role", "mbti", "alma_mater"]
-    encoder = OneHotEncoder(sparse_output=False)
-    encoded_features = pd.DataFrame(encoder.fit_transform(df_processed[categorical_columns]), 
-                                    columns=encoder.get_feature_names_out(categorical_columns))
-
-    # 元のデータと統合
-    df_processed = pd.concat([df_processed.drop(categorical_columns, axis=1), encoded_features], axis=1)
+    # 趣味の multi-hot と属性ごとの one-hot（語彙とエンコード結果は feature_store で共有）
+    batch = feature_store.encode_many(df_user_attributes.to_dict("records"))
 
     # クラスタリング
     # クラスタリングに使用する特徴量
-    X = df_processed.drop(["user_id", "preferences", "self_introductions"], axis=1)  # user_id は除外
+    X = one_hot(batch).toarray()
 
     # K-means クラスタリング
-    kmeans = KMeans(n_clusters=len(df_processed)//3, random_state=42)
+    kmeans = KMeans(n_clusters=len(df_user_attributes)//3, random_state=42)
+    df_processed = df_user_attributes[["user_id"]].copy()
     df_processed["cluster"] = kmeans.fit_predict(X)
 
     return df_processed
 
-def update_clustering_result():
-    # ユーザー属性データを取得
-    df_user_attributes = fetch_user_attributes()
-
-    # クラスタリング
-    df_clustered = clustering(df_user_attributes)
+def update_clustering_result(mode: str = CLUSTERING_MODE, measure_memory: bool = True):
+    """クラスタリングを実行して結果を保存（mode は "dense" か "sparse"）"""
+    # クラスタリング中のメモリ使用量のピークと所要時間を計測
+    # （tracemalloc は全スレッドの割り当てを遅くするので、バックグラウンド実行では使わない）
+    # 失敗しても計測を止めるよう finally で stop する（他で計測中なら、ここでは開始も停止もしない）
+    tracing = measure_memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    peak_memory = None
+    started = time.perf_counter()
+    try:
+        if mode == "sparse":
+            # 疎行列 + MiniBatchKMeans（DataFrame を作らない）
+            result = cluster_sparse()
+            assignments = result["assignments"]
+            model = result["model"]
+            quality = {"algorithm": result["algorithm"], "inertia": result["inertia"], "nonzeros": result["nonzeros"]}
+        else:
+            # ユーザー属性データを取得
+            df_user_attributes = fetch_user_attributes()
+
+            # クラスタリング
+            df_clustered = clustering(df_user_attributes)
+            assignments = dict(zip(df_clustered["user_id"], df_clustered["cluster"].astype(int)))
+            # 新規ユーザーの割り当てに使う語彙と重心
+            model = ClusterModel.fit(attribute_store.all(), assignments, version=next_model_version())
+            quality = {}
+
+        fit_seconds = time.perf_counter() - started
+        if tracing:
+            _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        if tracing:
+            tracemalloc.stop()
 
     try:
-        # クラスタリング結果を Supabase に保存
-        for index, row in df_clustered.iterrows():
-            update_query = f"UPDATE users SET cluster = {row['cluster']} WHERE id = '{row['user_id']}';"
-            response = supabase.rpc("execute_sql", {"sql": update_query}).execute()
+        # クラスタリング結果を Supabase にまとめて保存（この間もメモリ上は前の版のまま）
+        stats = write_cluster_assignments(assignments, update_snapshot=False)
+
+        # モデルと割り当てを新しい版にまとめて差し替え、実行中に登録されたユーザーは新しいモデルで割り当て直す
+        late = swap_cluster_snapshot(model, assignments)
+        if late:
+            write_cluster_assignments(late, update_snapshot=False)
+
+        return {
+            "message": "Clustering completed",
+            "mode": mode,
+            "model_version": model.version,
+            "clusters": len(model.cluster_ids),
+            "fit_seconds": fit_seconds,
+            "peak_memory_mb": None if peak_memory is None else peak_memory / 1024 / 1024,
+            "late_users": len(late),
+            **quality,
+            **stats,
+        }
 
-        return {"message": "Clustering completed"}
-    
     except Exception as e:
         return {"error": str(e)}
     
@@ -72,65 +116,41 @@ def update_clustering_result():
 def assign_new_user_to_cluster(user_id: str):
     """新規ユーザーを最も近いクラスタに追加し、Slack チャンネルに招待"""
 
-    # 既存ユーザー情報を取得
-    df_users = supabase.table("users").select("id", "cluster").execute()
-    df_users = pd.DataFrame(df_users.data)
-    df_users.dropna(subset=["cluster"], inplace=True)
-
-    # ユーザー属性情報を取得
-    df_user_attributes = supabase.table("user_attributes").select('*').neq("user_id", user_id).execute()
-    df_user_attributes = pd.DataFrame(df_user_attributes.data)
-    df_user_attributes.dropna(inplace=True)
+    # 新規ユーザーは登録直後なので、スナップショットに取り込み直す
+    changes_before = attribute_store.changes
+    new_user_row = attribute_store.refresh_user(user_id)
+    # 事前計算したおすすめにも新規ユーザーを反映
+    update_recommendations_for_user(user_id, changes_before)
+    if new_user_row is None:
+        return {"error": "User not found"}
 
-    # usersテーブルとuser_attributesテーブルを結合
-    df_users = df_users.merge(df_user_attributes, left_on="id", right_on="user_id", how="left")
+    # クラスタリング時に保存した語彙と重心を使う（無ければ現在の割り当てから一度だけ作る）
+    if get_cluster_model() is None:
+        publish_cluster_model(attribute_store.others(user_id), attribute_store.cluster_assignments())
 
-    # 新規ユーザーの情報を取得
-    new_user_data = supabase.table("user_attributes").select("*").eq("user_id", user_id).execute()
-    new_user = pd.DataFrame(new_user_data.data)
+    # 近いクラスタを予測（スナップショット側のクラスタにも記録される）
+    assigned_cluster = assign_user(new_user_row)
+    if assigned_cluster is None:
+        return {"error": "Clustering has not been run"}
 
-    # 特徴量の前処理
-    categorical_columns = ["hometown", "field", "role", "mbti", "alma_mater"]
+    # データベースを更新
+    write_cluster_assignments({user_id: assigned_cluster}, update_snapshot=False)
 
-    # Hobbies の MultiLabelBinarizer
-    mlb = MultiLabelBinarizer()
-    df_users["hobbies"] = df_users["hobbies"].apply(lambda x: x.split(", ") if isinstance(x, str) else [])
-    hobby_features = pd.DataFrame(mlb.fit_transform(df_users["hobbies"]), columns=mlb.classes_)
+    return {"message": "User assigned to cluster", "cluster_id": assigned_cluster}
 
-    # One-Hot Encoding
-    encoder = OneHotEncoder(sparse_output=False, handle_unknown="ignore")
-    encoded_features = pd.DataFrame(encoder.fit_transform(df_users[categorical_columns]), 
-                                    columns=encoder.get_feature_names_out(categorical_columns))
+# 再クラスタリングのスケジューラ（main.py の起動時に RECLUSTER_ENABLED なら開始する）
+recluster_scheduler = ReclusterScheduler(update_clustering_result)
 
-    df_processed = pd.concat([df_users.drop(["hobbies"] + categorical_columns, axis=1, errors='ignore'), 
-                              hobby_features, encoded_features], axis=1)
-    
-    # クラスタの重心を計算
-    # クラスタリング用の特徴量を作成（id, user_id, cluster, preferences, self_introductions は削除）
-    X = df_processed.drop(["id", "user_id", "cluster", "preferences", "self_introductions"], axis=1)
-    y = df_users["cluster"]
-
-    # 既存のクラスタ中心を計算
-    clf = NearestCentroid()
-    clf.fit(X, y)
-
-    # 新規ユーザーの特徴量変換（同じエンコーダを使用）
-    new_user["hobbies"] = new_user["hobbies"].apply(lambda x: x.split(", ") if isinstance(x, str) else [])
-    new_hobby_features = pd.DataFrame(mlb.transform(new_user["hobbies"]), columns=mlb.classes_)
-    new_encoded_features = pd.DataFrame(encoder.transform(new_user[categorical_columns]), 
-                                        columns=encoder.get_feature_names_out(categorical_columns))
-
-    new_processed = pd.concat([new_user.drop(["hobbies"] + categorical_columns, axis=1, errors='ignore'),
-                               new_hobby_features, new_encoded_features], axis=1)
-    
-    # 新規ユーザーの特徴量をCSVに保存
-    new_processed.to_csv(f"new_user.csv", index=False)
 
-    # 近いクラスタを予測
-    new_user_features = new_processed.drop(["user_id", "preferences", "self_introductions"], axis=1, errors='ignore')
-    assigned_cluster = int(clf.predict(new_user_features)[0])
+# 再クラスタリングをバックグラウンドで開始（完了は待たない）
+# measure_memory=true ならメモリ使用量のピークも計測する（結果は /recluster/status の last_result）
+@router.post("/recluster")
+def recluster(measure_memory: bool = False):
+    started = recluster_scheduler.trigger("manual", measure_memory)
+    return {"started": started, **recluster_scheduler.metrics()}
 
-    # データベースを更新
-    supabase.table("users").update({"cluster": assigned_cluster}).eq("id", user_id).execute()
 
-    return {"message": "User assigned to cluster", "cluster_id": assigned_cluster}
\ No newline at end of file
+# 再クラスタリングの実行時間とモデルの古さを確認
+@router.get("/recluster/status")
+def recluster_status():
+    return recluster_scheduler.metrics()
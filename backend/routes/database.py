@@ -1,8 +1,22 @@
 from fastapi import APIRouter
 from supabase_client import supabase
+from repository import repository
+from recommendations import precompute_recommendations
+from attribute_store import attribute_store
+from feature_store import FIELD_VALUES, ROLE_VALUES, MBTI_TYPES
+from hobby_similarity import HOBBY_VALUES
+from hobby_backfill import backfill_hobby_ids
+from synthetic_data import SYNTHETIC_ID_PREFIX, SyntheticData, invalidate_caches, synthetic_loader
+from config import DATA_BACKEND, SYNTHETIC_MAX_LIKES, SYNTHETIC_MAX_USERS
 
 router = APIRouter()
 
+
+def sql_values(values: list) -> str:
+    """CHECK 制約用に 'A', 'B', ... の形式にする"""
+    return ", ".join(f"'{value}'" for value in values)
+
+
 # 各テーブルの作成クエリ
 
 # ユーザの個人情報を格納するテーブル
@@ -19,22 +33,82 @@ CREATE TABLE IF NOT EXISTS users (
 );
 """
 
+# hobbies（"A, B, C"）を趣味 ID の配列 hobby_ids に変換するトリガー
+# 使用目的：フロントエンドからの書き込みも含めて書き込み時に1回だけ変換し、読み出し側で文字列を解析しなくて済むようにする。
+# 趣味 ID は hobby_similarity.HOBBY_VALUES の並び順（0始まり）。語彙にない趣味は書き込みをエラーにする
+ENCODE_HOBBY_IDS_SQL = f"""
+CREATE OR REPLACE FUNCTION encode_hobby_ids()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    vocabulary TEXT[] := ARRAY[{sql_values(HOBBY_VALUES)}];
+    hobby TEXT;
+    hobby_id INTEGER;
+    ids SMALLINT[] := '{{}}';
+BEGIN
+    FOREACH hobby IN ARRAY string_to_array(NEW.hobbies, ', ') LOOP
+        hobby_id := array_position(vocabulary, hobby);
+        IF hobby_id IS NULL THEN
+            RAISE EXCEPTION 'unknown hobby: %', hobby;
+        END IF;
+        ids := ids || (hobby_id - 1)::SMALLINT;
+    END LOOP;
+    NEW.hobby_ids := ids;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS user_attributes_encode_hobby_ids ON user_attributes;
+CREATE TRIGGER user_attributes_encode_hobby_ids
+BEFORE INSERT OR UPDATE OF hobbies ON user_attributes
+FOR EACH ROW EXECUTE FUNCTION encode_hobby_ids();
+"""
+
+# hobby_ids に入れてよい値（CHECK 制約用）
+HOBBY_IDS_CHECK = f"hobby_ids <@ ARRAY[{', '.join(str(i) for i in range(len(HOBBY_VALUES)))}]::SMALLINT[]"
+
 # ユーザの属性情報を格納するテーブル
 # 使用目的：ユーザーの属性情報を保存し、マッチングの際に利用する。
-CREATE_USER_ATTRIBUTES_SQL = """
+# field / role / mbti の選択肢は feature_store の語彙と共通
+CREATE_USER_ATTRIBUTES_SQL = f"""
 CREATE TABLE IF NOT EXISTS user_attributes (
     user_id UUID PRIMARY KEY,
     hobbies TEXT NOT NULL,
+    hobby_ids SMALLINT[] NOT NULL CHECK ({HOBBY_IDS_CHECK}), -- 趣味 ID の配列（hobbies からトリガーで作る）
     hometown VARCHAR(50),
-    field VARCHAR(10) CHECK (field IN ('公共', '法人', '金融', 'TC&S', '技統本')) NOT NULL,
-    role VARCHAR(10) CHECK (role IN ('SE', '営業', 'コンサル', 'スタッフ')) NOT NULL,
-    mbti VARCHAR(4) CHECK (mbti IN ('INTJ', 'INTP', 'ENTJ', 'ENTP', 'INFJ', 'INFP', 'ENFJ', 'ENFP', 'ISTJ', 'ISFJ', 'ESTJ', 'ESFJ', 'ISTP', 'ISFP', 'ESTP', 'ESFP')) NOT NULL,
+    field VARCHAR(10) CHECK (field IN ({sql_values(FIELD_VALUES)})) NOT NULL,
+    role VARCHAR(10) CHECK (role IN ({sql_values(ROLE_VALUES)})) NOT NULL,
+    mbti VARCHAR(4) CHECK (mbti IN ({sql_values(MBTI_TYPES)})) NOT NULL,
     alma_mater VARCHAR(100) NOT NULL,
     preferences TEXT NOT NULL,
     self_introductions TEXT NOT NULL, -- 「自己紹介文」の列
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
-"""
+""" + ENCODE_HOBBY_IDS_SQL
+
+# hobby_ids 列が無い既存の user_attributes に列・トリガー・書き込み用の関数を追加する
+# 使用目的：/migrate-hobby-ids で既存の行を埋める（埋め終わったら HOBBY_IDS_NOT_NULL_SQL で NOT NULL にする）
+MIGRATE_HOBBY_IDS_SQL = f"""
+ALTER TABLE user_attributes ADD COLUMN IF NOT EXISTS hobby_ids SMALLINT[] CHECK ({HOBBY_IDS_CHECK});
+
+CREATE OR REPLACE FUNCTION update_hobby_ids(assignments JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    updated INTEGER;
+BEGIN
+    UPDATE user_attributes AS u
+    SET hobby_ids = a.hobby_ids
+    FROM jsonb_to_recordset(assignments) AS a(user_id UUID, hobby_ids SMALLINT[])
+    WHERE u.user_id = a.user_id;
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    RETURN updated;
+END;
+$$;
+""" + ENCODE_HOBBY_IDS_SQL
+HOBBY_IDS_NOT_NULL_SQL = "ALTER TABLE user_attributes ALTER COLUMN hobby_ids SET NOT NULL;"
 
 # ユーザのいいね履歴を格納するテーブル
 # 使用目的：ユーザーが相手に「いいね」した記録を保存し、マッチングの成立を判定する。
@@ -47,6 +121,111 @@ CREATE_LIKES_SQL = """
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         UNIQUE(user_id, target_user_id) -- 1人につき1回だけ「いいね」できる
     );
+    -- 「誰にいいねされたか」の検索用（user_id 側は UNIQUE 制約のインデックスが使える）
+    CREATE INDEX IF NOT EXISTS likes_target_user_id_idx ON likes(target_user_id);
+"""
+
+# ユーザごとのおすすめ（マッチ度上位）を事前計算して格納するテーブル
+# 使用目的：全ユーザー分を一括計算しておき、/matching_result で再計算せずに返す。
+CREATE_RECOMMENDATIONS_SQL = """
+CREATE TABLE IF NOT EXISTS recommendations (
+    user_id UUID REFERENCES users(id) ON DELETE CASCADE,
+    rank SMALLINT NOT NULL, -- 1始まりの順位
+    target_user_id UUID REFERENCES users(id) ON DELETE CASCADE,
+    match_score REAL NOT NULL,
+    computed_at DOUBLE PRECISION NOT NULL, -- 計算した時刻（UNIX 秒）
+    PRIMARY KEY (user_id, rank)
+);
+CREATE INDEX IF NOT EXISTS recommendations_target_user_id_idx ON recommendations(target_user_id);
+"""
+
+# クラスタ ID と Slack チャンネル ID の対応を格納するテーブル
+# 使用目的：/invite で毎回 Slack のチャンネル一覧を取得しなくて済むようにする。
+CREATE_CLUSTER_CHANNELS_SQL = """
+CREATE TABLE IF NOT EXISTS cluster_channels (
+    cluster INTEGER PRIMARY KEY,
+    channel_id VARCHAR(50) NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# クラスタリング結果をまとめて users.cluster に書き込む関数
+# 使用目的：割り当てを JSON（[{"id": ..., "cluster": ...}, ...]）で受け取り、1回の UPDATE で反映する。
+CREATE_CLUSTER_WRITER_SQL = """
+CREATE OR REPLACE FUNCTION update_user_clusters(assignments JSONB)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    updated INTEGER;
+BEGIN
+    UPDATE users AS u
+    SET cluster = a.cluster
+    FROM jsonb_to_recordset(assignments) AS a(id UUID, cluster INTEGER)
+    WHERE u.id = a.id;
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    RETURN updated;
+END;
+$$;
+"""
+
+# Slack への送信キューを保存するテーブル（SLACK_OUTBOX_DURABLE=true のときだけ使う）
+# 使用目的：挨拶・チャンネルへの投稿を送信前に保存し、再起動しても未送信のものを送る。
+# 送信中（sending）の行は owner のインスタンスが leased_until まで受け持ち、期限が切れた行だけ他のインスタンスが取り出す。
+CREATE_SLACK_OUTBOX_SQL = """
+CREATE TABLE IF NOT EXISTS slack_outbox (
+    id UUID PRIMARY KEY,
+    kind VARCHAR(20) NOT NULL CHECK (kind IN ('dm', 'channel')),
+    dedup_key TEXT NOT NULL,
+    payload JSONB NOT NULL,
+    status VARCHAR(10) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP
+);
+
+-- 以前のテーブルにも送信中の状態と受け持ちの列を足す
+ALTER TABLE slack_outbox ADD COLUMN IF NOT EXISTS owner TEXT;
+ALTER TABLE slack_outbox ADD COLUMN IF NOT EXISTS leased_until TIMESTAMPTZ;
+ALTER TABLE slack_outbox DROP CONSTRAINT IF EXISTS slack_outbox_status_check;
+ALTER TABLE slack_outbox ADD CONSTRAINT slack_outbox_status_check CHECK (status IN ('pending', 'sending', 'sent', 'failed'));
+
+DROP INDEX IF EXISTS slack_outbox_pending_idx;
+CREATE INDEX IF NOT EXISTS slack_outbox_unsent_idx ON slack_outbox (created_at) WHERE status IN ('pending', 'sending');
+
+-- 未送信の行と受け持ちの期限が切れた行を、最大 max_rows 件まで owner のものにして返す
+-- （FOR UPDATE SKIP LOCKED で、同時に呼んだ他のインスタンスと同じ行を取り合わない）
+CREATE OR REPLACE FUNCTION claim_slack_outbox(claimer TEXT, lease_seconds DOUBLE PRECISION, max_rows INTEGER)
+RETURNS SETOF slack_outbox
+LANGUAGE sql
+AS $$
+    UPDATE slack_outbox AS o
+    SET status = 'sending',
+        owner = claimer,
+        leased_until = now() + make_interval(secs => lease_seconds)
+    WHERE o.id IN (
+        SELECT id FROM slack_outbox
+        WHERE status = 'pending' OR (status = 'sending' AND leased_until < now())
+        ORDER BY created_at
+        LIMIT max_rows
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING o.*;
+$$;
+"""
+
+# 2人の Slack ID と DM のチャンネル ID の対応（SLACK_DM_CHANNELS_DURABLE=true のときだけ使う）
+# 使用目的：一度開いた DM を再起動後も使い回し、conversations.open を呼び直さない。（slack_id1 < slack_id2 の順で保存する）
+CREATE_DM_CHANNELS_SQL = """
+CREATE TABLE IF NOT EXISTS dm_channels (
+    slack_id1 VARCHAR(50) NOT NULL,
+    slack_id2 VARCHAR(50) NOT NULL,
+    channel_id VARCHAR(50) NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (slack_id1, slack_id2),
+    CHECK (slack_id1 <= slack_id2)
+);
 """
 
 
@@ -54,6 +233,14 @@ CREATE_LIKES_SQL = """
 DROP_USERS_SQL = "DROP TABLE IF EXISTS users CASCADE;"
 DROP_USER_ATTRIBUTES_SQL = "DROP TABLE IF EXISTS user_attributes CASCADE;"
 DROP_LIKES_SQL = "DROP TABLE IF EXISTS likes CASCADE;"
+DROP_RECOMMENDATIONS_SQL = "DROP TABLE IF EXISTS recommendations CASCADE;"
+DROP_CLUSTER_CHANNELS_SQL = "DROP TABLE IF EXISTS cluster_channels CASCADE;"
+DROP_CLUSTER_WRITER_SQL = "DROP FUNCTION IF EXISTS update_user_clusters(JSONB);"
+DROP_SLACK_OUTBOX_SQL = """
+DROP FUNCTION IF EXISTS claim_slack_outbox(TEXT, DOUBLE PRECISION, INTEGER);
+DROP TABLE IF EXISTS slack_outbox CASCADE;
+"""
+DROP_DM_CHANNELS_SQL = "DROP TABLE IF EXISTS dm_channels CASCADE;"
 
 
 # 各テーブルの架空データ挿入クエリ
@@ -295,6 +482,26 @@ def create_user_attributes():
 def create_likes():
     return execute_sql(CREATE_LIKES_SQL)
 
+@router.post("/create-recommendations")
+def create_recommendations():
+    return execute_sql(CREATE_RECOMMENDATIONS_SQL)
+
+@router.post("/create-cluster-channels")
+def create_cluster_channels():
+    return execute_sql(CREATE_CLUSTER_CHANNELS_SQL)
+
+@router.post("/create-cluster-writer")
+def create_cluster_writer():
+    return execute_sql(CREATE_CLUSTER_WRITER_SQL)
+
+@router.post("/create-slack-outbox")
+def create_slack_outbox():
+    return execute_sql(CREATE_SLACK_OUTBOX_SQL)
+
+@router.post("/create-dm-channels")
+def create_dm_channels():
+    return execute_sql(CREATE_DM_CHANNELS_SQL)
+
 
 # 各テーブルの削除API
 @router.post("/drop-users")
@@ -309,6 +516,26 @@ def drop_user_attributes():
 def drop_likes():
     return execute_sql(DROP_LIKES_SQL)
 
+@router.post("/drop-recommendations")
+def drop_recommendations():
+    return execute_sql(DROP_RECOMMENDATIONS_SQL)
+
+@router.post("/drop-cluster-channels")
+def drop_cluster_channels():
+    return execute_sql(DROP_CLUSTER_CHANNELS_SQL)
+
+@router.post("/drop-cluster-writer")
+def drop_cluster_writer():
+    return execute_sql(DROP_CLUSTER_WRITER_SQL)
+
+@router.post("/drop-slack-outbox")
+def drop_slack_outbox():
+    return execute_sql(DROP_SLACK_OUTBOX_SQL)
+
+@router.post("/drop-dm-channels")
+def drop_dm_channels():
+    return execute_sql(DROP_DM_CHANNELS_SQL)
+
 
 # 各テーブルの架空データ挿入API
 @router.post("/insert-users")
@@ -321,4 +548,56 @@ def insert_user_attributes():
 
 @router.post("/insert-likes")
 def insert_likes():
-    return execute_sql(INSERT_LIKES_SQL)
\ No newline at end of file
+    return execute_sql(INSERT_LIKES_SQL)
+
+
+# 負荷試験用に大量の架空データ（users / user_attributes / likes）を生成して書き込むAPI（完了は待たない）
+@router.post("/insert-synthetic-data")
+def insert_synthetic_data(users: int = 10000, seed: int = 42, max_likes: int = SYNTHETIC_MAX_LIKES):
+    if not 1 <= users <= SYNTHETIC_MAX_USERS:
+        return {"error": f"users must be between 1 and {SYNTHETIC_MAX_USERS}"}
+    if not synthetic_loader.start(SyntheticData(users, seed=seed, max_likes=max_likes)):
+        return {"error": "Synthetic data is already being inserted"}
+    return {"message": "Synthetic data insertion started", "users": users, "seed": seed}
+
+# 架空データの書き込みの進み具合（テーブルごとの行数・行数/秒）
+@router.get("/insert-synthetic-data/status")
+def insert_synthetic_data_status():
+    return synthetic_loader.status()
+
+# 架空データの削除API（いいね・おすすめは users の削除に合わせて消える）
+@router.post("/delete-synthetic-data")
+def delete_synthetic_data():
+    try:
+        deleted = repository.delete_users_with_prefix(SYNTHETIC_ID_PREFIX)
+    except Exception as e:
+        return {"error": str(e)}
+    # 消したユーザーがスナップショット・いいね・おすすめに残らないようにする
+    invalidate_caches()
+    return {"message": "Synthetic data deleted successfully", "deleted_users": deleted}
+
+
+# 既存の user_attributes に hobby_ids を追加して埋めるAPI（何度実行してもよい）
+# 語彙にない趣味を含む行は埋めずに invalid として返す（hobbies を直してから再実行する）
+@router.post("/migrate-hobby-ids")
+def migrate_hobby_ids(page_size: int = 1000):
+    if DATA_BACKEND == "supabase":
+        migrated = execute_sql(MIGRATE_HOBBY_IDS_SQL)
+        if "error" in migrated:
+            return migrated
+        # 列ができたので、hobbies から作る読み方をやめる
+        repository.has_hobby_ids = None
+    result = backfill_hobby_ids(page_size=page_size)
+    if DATA_BACKEND == "supabase" and not result["invalid"]:
+        result["not_null"] = execute_sql(HOBBY_IDS_NOT_NULL_SQL)
+    attribute_store.invalidate()
+    return result
+
+
+# 全ユーザーのおすすめを一括計算して recommendations テーブルに保存するAPI
+@router.post("/precompute-recommendations")
+def precompute_recommendations_api(k: int = 5, chunk_size: int = 1000):
+    try:
+        return precompute_recommendations(k=k, chunk_size=chunk_size)
+    except Exception as e:
+        return {"error": str(e)}
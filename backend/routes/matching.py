@@ -1,30 +1,94 @@
-from fastapi import APIRouter
-from supabase_client import supabase
+from fastapi import APIRouter, Query
+from typing import List
 import numpy as np
+from repository import repository
+from attribute_store import attribute_store
+from hobby_similarity import hobby_similarity
+from recommendations import fresh_recommendations
+from candidate_index import search_matches, recall_check
+from like_graph import like_graph, fetch_like_status
+from config import CANDIDATE_INDEX_ENABLED, CANDIDATE_INDEX_N_PROBE, LIKE_GRAPH_ENABLED
+from match_scoring import (
+    BEST_MATCHES, MBTI_SAME_SCORE, MBTI_BEST_MATCH_SCORE, PREFERENCE_WEIGHT,
+    candidate_mask, common_attributes, score_users, top_k_matches,
+)
 
 router = APIRouter()
 
 @router.get("/matching_result")
-def get_matching_result(user_id: str):
-    # リクエストされたユーザー情報を取得
-    target_user_data = supabase.table("user_attributes").select("*").eq("user_id", user_id).single().execute()
-    if not target_user_data:
+def get_matching_result(
+    user_id: str,
+    k: int = Query(5, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    field: str = None,
+    role: str = None,
+    exclude_liked: bool = False,
+    exclude_matched: bool = False,
+):
+    # リクエストされたユーザー情報を取得（メモリ上のスナップショットから）
+    target_user = attribute_store.get(user_id)
+    if not target_user:
         return {"error": "User not found"}
 
-    target_user = target_user_data.data
+    filters = {"field": field, "role": role}
 
-    # その人以外の全ユーザーを取得
-    other_users_data = supabase.table("user_attributes").select("*").neq("user_id", user_id).execute()
-    other_users = other_users_data.data
+    # いいね済み・マッチ済みのユーザー
+    excluded_user_ids = set()
+    if exclude_liked or exclude_matched:
+        excluded_user_ids = fetch_excluded_user_ids(user_id, exclude_liked, exclude_matched)
 
-    # すべてのユーザーとマッチ度を計算
-    match_results = [calculate_match_score(target_user, other_user) for other_user in other_users]
+    # 属性の絞り込みが無ければ、事前計算したおすすめが新しいときはそこから除外して返す
+    # （除外される人数分だけ多めに取るので、足りなければ None になって下で計算し直す）
+    if all(value is None for value in filters.values()):
+        recommended = fresh_recommendations(user_id, offset + k + len(excluded_user_ids))
+        if recommended is not None:
+            recommended = [match for match in recommended if match["user_id"] not in excluded_user_ids]
+            matches = recommended[offset:offset + k]
+            return {"matches": matches, "next_offset": offset + len(matches)}
 
-    # スコア順にソート
-    match_results = sorted(match_results, key=lambda x: x["match_score"], reverse=True)
+    # ユーザー数が多い場合は、候補を近似最近傍インデックスで絞り込んでから厳密に計算
+    # （絞り込み・除外はインデックス側のスナップショットに対して行う）
+    if CANDIDATE_INDEX_ENABLED:
+        matches = search_matches(
+            target_user, offset + k, CANDIDATE_INDEX_N_PROBE, filters=filters, exclude_user_ids=excluded_user_ids,
+        )[offset:]
+        return {"matches": matches, "next_offset": offset + len(matches)}
 
-    # 上位5人を返す
-    return {"matches": match_results[:5]}
+    # 全ユーザーのエンコード済み属性（変更があったときだけ作り直される）
+    encoded_users, positions = attribute_store.encoded()
+
+    # スコアリングする前に、本人・いいね済み・マッチ済み・条件に合わないユーザーを除外
+    exclude_rows = [positions[excluded] for excluded in excluded_user_ids | {user_id} if excluded in positions]
+    mask = candidate_mask(encoded_users, filters, exclude_rows)
+
+    # 残った候補だけマッチ度を計算
+    rows = np.flatnonzero(mask)
+    scores = score_users(target_user, encoded_users, rows)
+
+    # 上位 offset+k 人のうち offset 番目以降を返す
+    candidate_ids = [encoded_users.user_ids[row] for row in rows]
+    matches = top_k_matches(candidate_ids, scores, offset + k)[offset:]
+    return {"matches": matches, "next_offset": offset + len(matches)}
+
+
+def fetch_excluded_user_ids(user_id: str, exclude_liked: bool, exclude_matched: bool) -> set:
+    """いいね済み（exclude_liked）またはマッチ済み（exclude_matched）のユーザーIDを取得"""
+    if LIKE_GRAPH_ENABLED:
+        liked_ids = like_graph.liked_by(user_id)
+        return liked_ids if exclude_liked else liked_ids & like_graph.likers_of(user_id)
+
+    liked_ids = repository.liked_targets(user_id)
+    if exclude_liked or not liked_ids:
+        return liked_ids
+
+    # マッチ済み = 自分がいいねし、相手からもいいねされている
+    return repository.likers_among(user_id, liked_ids)
+
+
+# 近似最近傍インデックスの再現率を全件スコアリングと比べて確認
+@router.get("/candidate_index/recall")
+def candidate_index_recall(k: int = 5, n_probe: int = CANDIDATE_INDEX_N_PROBE, sample_size: int = 100):
+    return recall_check(k=k, n_probe=n_probe, sample_size=sample_size)
 
 
 # マッチ度計算用の関数
@@ -55,29 +119,10 @@ def calculate_match_score(target_user, other_user):
     #MBTIが完全一致なら+0.8、
     #相性が良い組み合わせなら+1.0。
     
-    best_matches = {
-        "INTJ": ["ESFJ", "ISFP", "INTP"],
-        "INTP": ["ESFP", "ISFJ", "ENTJ"],
-        "ENTJ": ["ISFJ", "INFP", "INTP"],
-        "ENTP": ["ISFP", "ESTP", "ENFP"],
-        "INFJ": ["ESTJ", "INFP", "ENFP"],
-        "INFP": ["ESTP", "ENFJ", "INFJ"],
-        "ENFJ": ["ISTJ", "INFP", "ESTP"],
-        "ENFP": ["ISTP", "ESTJ", "INFJ"],
-        "ISTJ": ["ENFJ", "ESTP", "ESFJ"],
-        "ISFJ": ["ENTJ", "INTP", "INFP"],
-        "ESTJ": ["INFJ", "ISFJ", "ESFJ"],
-        "ESFJ": ["INTJ", "ENTP", "ISFP"],
-        "ISTP": ["ENFP", "INFJ", "ESTJ"],
-        "ISFP": ["ENTP", "INTJ", "ESFP"],
-        "ESTP": ["INFP", "ENTP", "ESFJ"],
-        "ESFP": ["INTP", "ENTJ", "ISFJ"],
-    }
-    
     if mbti1 == mbti2:
-        match_scores["mbti"] += 0.8
-    elif mbti2 in best_matches.get(mbti1, []):
-        match_scores["mbti"] += 1.0
+        match_scores["mbti"] += MBTI_SAME_SCORE
+    elif mbti2 in BEST_MATCHES.get(mbti1, []):
+        match_scores["mbti"] += MBTI_BEST_MATCH_SCORE
     else:
         match_scores["mbti"] += 0.0
 
@@ -86,33 +131,16 @@ def calculate_match_score(target_user, other_user):
         match_scores["alma_mater"] += 1.0    
 
     # 趣味のマッチ度を単語のベクトルで類似度を計算する(担当：shibarin)
-    target_user_hobbies = target_user["hobbies"].split(", ")
-    other_user_hobbies = other_user["hobbies"].split(", ")
-
-    hobby_vectors = np.load("hobby_vectors.npz")
-    for tuh in target_user_hobbies:
-        tuh_vec = hobby_vectors[tuh]
-        for ouh in other_user_hobbies:
-            ouh_vec = hobby_vectors[ouh]
-            # コサイン類似度を計算
-            match_scores["hobbies"] += np.dot(tuh_vec, ouh_vec) / (np.linalg.norm(tuh_vec) * np.linalg.norm(ouh_vec))
+    # 類似度行列は起動時に一度だけ計算済みなので、インデックス参照と合計だけで済む
+    match_scores["hobbies"] += hobby_similarity.score(target_user["hobby_ids"], other_user["hobby_ids"])
 
     match_scores["hobbies"] /= 3.0
 
     # preference（重視する点）を考慮し、該当項目のスコアに重みをつける（担当：しんや）
     # 例：target_userが「hometown」を重視している場合（つまり target_user["preferences"] == hometown"）、match_scores["hometown"]に重みをつける
 
-    # 重み(何倍にするか)を設定
-    # とりあえず一律で1.5倍
+    # 重み(何倍にするか)は match_scoring.PREFERENCE_WEIGHT（とりあえず一律で1.5倍）
     # preferenceを選ぶ際に、押した回数分だけ重みを倍増させるようにしても面白いかもしれません
-    preference_weights = {
-        "hometown": 1.5,
-        "field": 1.5,
-        "role": 1.5,
-        "mbti": 1.5,
-        "alma_mater": 1.5,
-        "hobbies": 1.5,
-    }
 
     # target_user["preferences"]をリストにし、複数のpreferenceを選べることを想定
     target_user_preferences = target_user.get("preferences", [])
@@ -123,7 +151,7 @@ def calculate_match_score(target_user, other_user):
     # target_user["preferences"]に指定された項目のスコアを重み付け
     for target_user_preference in target_user_preferences:
         if target_user_preference in match_scores:
-            match_scores[target_user_preference] *= preference_weights.get(target_user_preference, 1)
+            match_scores[target_user_preference] *= PREFERENCE_WEIGHT
 
     # スコアを合計
     score = round(sum(match_scores.values()), 2)
@@ -138,35 +166,49 @@ def check_matching(user_id1: str, user_id2: str):
     # 両方likeしている場合はマッチング成立として、Trueを返す
     # いずれかがlikeしていない場合はマッチング成立していないとして、Falseを返す（デフォルトはFalse）
 
-    # user_id1 -> user_id2 の like を確認
-    like1 = supabase.table("likes").select("*").eq("user_id", user_id1).eq("target_user_id", user_id2).execute()
-    
-    # user_id2 -> user_id1 の like を確認
-    like2 = supabase.table("likes").select("*").eq("user_id", user_id2).eq("target_user_id", user_id1).execute()
-    
+    # 両方向の like をまとめて確認（1回の問い合わせ）
+    status = fetch_like_status(user_id1, [user_id2])[user_id2]
+
     # 両方の like が存在する場合はマッチング成立
-    is_match = bool(like1.data) and bool(like2.data)
+    is_match = status["match"]
 
     return {"match": is_match}
 
+# 1人のユーザーと複数の相手について、マッチング状況をまとめて取得
+@router.get("/check_matching_batch")
+def check_matching_batch(user_id: str, target_user_ids: List[str] = Query(...)):
+    return {"results": fetch_like_status(user_id, target_user_ids)}
+
+
+# いいねを追加したときに呼び出し、メモリ上の likes グラフ（LIKE_GRAPH_ENABLED=true の場合）に反映する
+@router.post("/like_graph/add")
+def add_like_to_graph(user_id: str, target_user_id: str):
+    like_graph.add_like(user_id, target_user_id)
+    return {"message": "Like added"}
+
+
 @router.get("/common_attributes")
 def get_common_attributes(user_id1: str, user_id2: str):
-    # user_id1の属性を取得
-    user1_data = supabase.table("user_attributes").select("*").eq("user_id", user_id1).single().execute()
-    user1 = user1_data.data
+    # 共通の属性を取得
+    common_attribute = fetch_common_attributes(user_id1, [user_id2]).get(user_id2, {})
+    return {"common_attribute": common_attribute}
 
-    # user_id2の属性を取得
-    user2_data = supabase.table("user_attributes").select("*").eq("user_id", user_id2).single().execute()
-    user2 = user2_data.data
 
-    # 共通の属性を取得
-    common_attributes = {
-        "hometown": user1["hometown"] if user1["hometown"] == user2["hometown"] else None,
-        "field": user1["field"] if user1["field"] == user2["field"] else None,
-        "role": user1["role"] if user1["role"] == user2["role"] else None,
-        "mbti": user1["mbti"] if user1["mbti"] == user2["mbti"] else None,
-        "alma_mater": user1["alma_mater"] if user1["alma_mater"] == user2["alma_mater"] else None,
-        "hobbies": [hobby for hobby in user1["hobbies"].split(", ") if hobby in user2["hobbies"].split(", ")]
-    }
-    common_attribute = {k: v for k, v in common_attributes.items() if v is not None}
-    return {"common_attribute": common_attribute}
\ No newline at end of file
+# 1人のユーザーと複数の相手について、共通の属性をまとめて取得
+@router.get("/common_attributes_batch")
+def get_common_attributes_batch(user_id: str, other_user_ids: List[str] = Query(...)):
+    return {"results": fetch_common_attributes(user_id, other_user_ids)}
+
+
+def fetch_common_attributes(user_id: str, other_user_ids: list) -> dict:
+    """user_id と各相手の共通の属性を other_user_id -> 共通の属性 で返す"""
+    # 属性を取得（スナップショットに無い分だけ1回の問い合わせで取得）
+    users = attribute_store.get_many([user_id] + list(other_user_ids))
+    if user_id not in users:
+        return {}
+
+    encoded_users, positions = attribute_store.encoded()
+    found_ids = [other_user_id for other_user_id in other_user_ids if other_user_id in positions]
+    other_rows = np.array([positions[other_user_id] for other_user_id in found_ids], dtype=np.intp)
+    common = common_attributes(encoded_users, users[user_id], other_rows)
+    return dict(zip(found_ids, common))
@@ -1,119 +1,166 @@
 from fastapi import APIRouter, HTTPException
-from supabase_client import supabase
-import requests
+from repository import repository
+import asyncio
 from urllib.parse import urlencode
-from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
-from config import SLACK_BOT_TOKEN
+from routes.matching import fetch_common_attributes
+from attribute_store import attribute_store
+from slack_directory import slack_directory, channel_directory, cluster_channels, dm_channels
+from slack_transport import slack_transport
+from slack_outbox import slack_outbox
 
 router = APIRouter()
-client = WebClient(token=SLACK_BOT_TOKEN)
 
 @router.get("/check_email")
 def check_email(email: str):
-    url = "https://slack.com/api/users.list"
-    headers = {
-        "Authorization": f"Bearer {SLACK_BOT_TOKEN}"
+    # メモリ上の一覧から探す（一覧に無い場合だけ Slack に1件問い合わせる）
+    try:
+        slack_id = slack_directory.lookup(email)
+    except SlackApiError as e:
+        raise HTTPException(status_code=500, detail="Slack API Error: " + str(e.response.data))
+
+    if slack_id is None:
+        raise HTTPException(status_code=400, detail="このメールアドレスはSlackに登録されていません")
+
+    return {"message": "登録を確認", "slack_id": slack_id}
+
+
+# Slack のメールアドレス・チャンネル一覧のキャッシュの状態を確認
+@router.get("/slack_directory/stats")
+def slack_directory_stats():
+    return {
+        **slack_directory.stats(),
+        "channel_directory": channel_directory.stats(),
+        "dm_channels": dm_channels.stats(),
     }
-    response = requests.get(url, headers=headers)
-    data = response.json()
 
-    if not data.get("ok"):
-        raise HTTPException(status_code=500, detail="Slack API Error: " + str(data))
 
-    # 全ユーザのメールアドレスとSlack_IDを取得
-    slack_users = {user["profile"].get("email"): user["id"] for user in data["members"] if "email" in user["profile"]}
+# Slack API の呼び出し回数・再試行・レート制限による待ち時間・応答時間を確認
+@router.get("/slack_transport/stats")
+def slack_transport_stats():
+    return slack_transport.stats()
 
-    if email not in slack_users:
-        raise HTTPException(status_code=400, detail="このメールアドレスはSlackに登録されていません")
 
-    return {"message": "登録を確認", "slack_id": slack_users[email]}
+# Slack への送信キューの状態（キューの長さ・送信までの時間・失敗数）を確認
+@router.get("/slack_outbox/stats")
+def slack_outbox_stats():
+    return slack_outbox.metrics()
 
 
-@router.get("/connect_dm")
-def connect_dm(slack_id1: str, slack_id2: str):
-    url = "https://slack.com/api/conversations.open"
-    headers = {
-        "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    payload = {"users": [slack_id1, slack_id2]}
-    
-    response = requests.post(url, headers=headers, json=payload)
-    data = response.json()
+async def open_dm(slack_id1: str, slack_id2: str) -> str:
+    """2人の DM チャネルを開き、チャネル ID を返す（一度開いた組は Slack に問い合わせない）"""
+    return await dm_channels.channel_id(slack_id1, slack_id2)
 
-    if not data.get("ok"):
-        raise HTTPException(status_code=500, detail=f"Slack API Error: {data.get('error')}")
 
-    channel_id = data["channel"]["id"]
-    slack_dm_url = f"https://slack.com/app_redirect?{urlencode({'channel': channel_id})}"
+def dm_url(channel_id: str) -> str:
+    return f"https://slack.com/app_redirect?{urlencode({'channel': channel_id})}"
 
-    return {"URL": slack_dm_url}
 
+def greeting_message(user2_name: str, common_point: str) -> str:
+    return f"こんにちは！あなたと{user2_name}さんには{common_point}の共通点があります。まずは挨拶してみましょう"
 
-@router.get("/send-greeting")
-def send_greeting(user1_slack_id: str, user2_slack_id: str, common_point: str):
+
+@router.get("/connect_dm")
+async def connect_dm(slack_id1: str, slack_id2: str):
     try:
-        # DMチャネルを開く
-        response = client.conversations_open(users=[user1_slack_id, user2_slack_id])
-        channel_id = response["channel"]["id"]
+        channel_id = await open_dm(slack_id1, slack_id2)
+    except SlackApiError as e:
+        raise HTTPException(status_code=500, detail=f"Slack API Error: {e.response['error']}")
+
+    return {"URL": dm_url(channel_id)}
+
 
-        user2_name = supabase.table("users").select("name").eq("slack_id", user2_slack_id).execute().data[0]["name"]
+async def fetch_user_name(slack_id: str) -> str:
+    user = await asyncio.to_thread(repository.user_by_slack_id, slack_id, ("name",))
+    return user["name"]
 
-        # メッセージ内容
-        message = f"こんにちは！あなたと{user2_name}さんには{common_point}の共通点があります。まずは挨拶してみましょう"
 
-        # メッセージを送信
-        client.chat_postMessage(channel=channel_id, text=message)
-        
-        return {"message": "メッセージが送信されました。", "channel_id": channel_id}
+@router.get("/send-greeting")
+async def send_greeting(user1_slack_id: str, user2_slack_id: str, common_point: str):
+    user2_name = await fetch_user_name(user2_slack_id)
+
+    # DM を開いてメッセージを送るのは送信キューのワーカーが行う（Slack の応答は待たない）
+    queued = await slack_outbox.enqueue("dm", {
+        "users": [user1_slack_id, user2_slack_id],
+        "text": greeting_message(user2_name, common_point),
+    })
+
+    return {"message": "メッセージの送信を受け付けました。", **queued}
+
+
+# 共通点として表示する属性名
+COMMON_POINT_LABELS = {
+    "hometown": "出身地",
+    "field": "志望分野",
+    "role": "志望職種",
+    "mbti": "MBTI",
+    "alma_mater": "出身大学",
+    "hobbies": "趣味",
+}
+
+
+def describe_common_points(common_attribute: dict) -> str:
+    """共通の属性を「出身地（東京都）、趣味（旅行・映画鑑賞）」のような文字列にする"""
+    points = []
+    for column, label in COMMON_POINT_LABELS.items():
+        value = common_attribute.get(column)
+        if isinstance(value, list):
+            value = "・".join(value)
+        if value:
+            points.append(f"{label}（{value}）")
+    return "、".join(points)
+
+
+@router.get("/on_match")
+async def on_match(user_id1: str, user_id2: str, slack_id1: str = None, slack_id2: str = None, common_point: str = None):
+    """マッチング成立時の処理（DM 作成・共通点の計算・挨拶メッセージ送信）をまとめて行う"""
+    async def fetch_users():
+        users = await asyncio.to_thread(repository.users_by_ids, [user_id1, user_id2], ("id", "name", "slack_id"))
+        return {user["id"]: user for user in users}
+
+    async def open_dm_when_known():
+        # Slack ID が渡されていれば、ユーザー情報の取得を待たずに DM を開く
+        if slack_id1 and slack_id2:
+            return await open_dm(slack_id1, slack_id2)
+        return None
+
+    try:
+        users, common, channel_id = await asyncio.gather(
+            fetch_users(),
+            asyncio.to_thread(fetch_common_attributes, user_id1, [user_id2]),
+            open_dm_when_known(),
+        )
+        if user_id1 not in users or user_id2 not in users:
+            raise HTTPException(status_code=404, detail="User not found")
+        if channel_id is None:
+            channel_id = await open_dm(users[user_id1]["slack_id"], users[user_id2]["slack_id"])
 
     except SlackApiError as e:
-        return {"error": f"Slack APIエラー: {e.response['error']}"}
+        raise HTTPException(status_code=500, detail=f"Slack API Error: {e.response['error']}")
 
+    # 共通点を添えた挨拶メッセージは送信キューに積む（同じ DM チャネルに送る）
+    common_attribute = common.get(user_id2, {})
+    point = common_point or describe_common_points(common_attribute) or "同期"
+    await slack_outbox.enqueue("dm", {"channel": channel_id, "text": greeting_message(users[user_id2]["name"], point)})
 
-def get_channel_id():
-    headers = {
-        "Authorization": f"Bearer {SLACK_BOT_TOKEN}"
-    }
-    
-    # Slack APIでチャンネルリストを取得
-    response = requests.get(
-        "https://slack.com/api/conversations.list",
-        headers=headers
-    )
-    
-    # Slack APIのレスポンスが正常か確認
-    if response.status_code != 200:
-        raise HTTPException(status_code=500, detail="Slack API request failed")
-
-    data = response.json()
-    
-    # チャンネルが正常に取得できたか確認
-    if not data.get("ok"):
-        raise HTTPException(status_code=500, detail="Failed to retrieve channels from Slack")
-
-    channel_name2id = {}
-    # チャンネルリストをループして指定されたチャンネル名を探す
-    for channel in data.get("channels", []):
-        channel_name2id[channel["name"]] = channel["id"]
-
-    return channel_name2id
+    return {"URL": dm_url(channel_id), "channel_id": channel_id, "common_attribute": common_attribute}
 
 
 @router.get("/invite")
 def invite_user_to_slack(user_id: str):
-    # Supabase から `cluster_id` を取得
-    response = supabase.table("users").select("cluster").eq("id", user_id).execute()
-    if not response.data:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    cluster_id = str(response.data[0]["cluster"])
-    
-    # クラスタ ID から Slack チャンネル ID を取得
-    channel_name2id = get_channel_id()
-    print(channel_name2id)
-    channel_id = channel_name2id[cluster_id]
+    # クラスタはメモリ上のスナップショットから取得（再クラスタリング中も、新規ユーザーの割り当てと同じ版を見る）
+    cluster_id = attribute_store.cluster_assignments().get(user_id)
+    if cluster_id is None:
+        # スナップショットに無ければデータベースから `cluster_id` を取得
+        clusters = repository.user_clusters([user_id])
+        if user_id not in clusters:
+            raise HTTPException(status_code=404, detail="User not found")
+        cluster_id = clusters[user_id]
+        if cluster_id is None:
+            raise HTTPException(status_code=400, detail="Cluster ID is not mapped to a Slack channel")
+
+    # クラスタ ID から Slack チャンネル ID を取得（メモリ上か cluster_channels テーブルにあれば Slack には問い合わせない）
+    channel_id = cluster_channels.channel_id(int(cluster_id))
     if not channel_id:
         raise HTTPException(status_code=400, detail="Cluster ID is not mapped to a Slack channel")
 
@@ -123,40 +170,20 @@ def invite_user_to_slack(user_id: str):
 
 
 @router.get("/join_slack_bot")
-def join_slack_bot(id: str, common_point: str):
-    headers = {"Authorization": f"Bearer {SLACK_BOT_TOKEN}"}
-    
-    # チャンネル名を指定してチャンネルIDを取得
-    channel_id = get_channel_id()[id]  # チャンネル名 "general" を使用（変更可能）
-    
-    # チャンネルに参加
-    join_response = requests.post(
-        "https://slack.com/api/conversations.join",
-        headers=headers,
-        json={"channel": channel_id}
-    )
-    
-    # 参加できたか確認
-    if not join_response.json().get("ok"):
-        raise HTTPException(status_code=500, detail="Failed to join the channel")
-
-    # メッセージを送信
-    message_payload = {
-        "channel": channel_id,
-        "text": f"""
+async def join_slack_bot(id: str, common_point: str):
+    # チャンネル名を指定してチャンネルIDを取得（キャッシュした一覧から探す）
+    try:
+        channel_id = await asyncio.to_thread(channel_directory.channel_id, id)  # チャンネル名 "general" を使用（変更可能）
+    except SlackApiError as e:
+        raise HTTPException(status_code=500, detail=f"Slack API Error: {e.response['error']}")
+    if channel_id is None:
+        raise HTTPException(status_code=400, detail="Channel not found")
+
+    # チャンネルへの参加とメッセージの送信は送信キューのワーカーが行う
+    text = f"""
         こんにちは！このグループには{common_point}の似ている人が集まっています。
 まずはお互いに挨拶してみましょう！
         """
-    }
-    
-    send_message_response = requests.post(
-        "https://slack.com/api/chat.postMessage",
-        headers=headers,
-        json=message_payload
-    )
-    
-    # メッセージ送信が成功したか確認
-    if not send_message_response.json().get("ok"):
-        raise HTTPException(status_code=500, detail="Failed to send message to the channel")
-
-    return {"status": "success", "message": "Bot joined the channel and sent a message"}
\ No newline at end of file
+    queued = await slack_outbox.enqueue("channel", {"channel": channel_id, "text": text, "join": True})
+
+    return {"status": queued["status"], "id": queued["id"], "message": "Bot will join the channel and send a message"}
\ No newline at end of file
@@ -1,5 +1,7 @@
 from fastapi import APIRouter
 from supabase_client import supabase
+from attribute_store import attribute_store
+from recommendations import update_recommendations_for_user
 
 router = APIRouter()
 
@@ -16,4 +18,21 @@ router = APIRouter()
 # @router.get("/likes")
 # def likes():
 #     response = supabase.table("likes").select("*").execute()
-#     return response
\ No newline at end of file
+#     return response
+
+# ユーザー属性スナップショットの状態（ヒット数・ミス数・再取得時間）
+@router.get("/attribute_store/stats")
+def attribute_store_stats():
+    return attribute_store.stats()
+
+# 属性を更新したときに呼び出し、スナップショットの該当ユーザーを取り直す
+@router.post("/attribute_store/invalidate")
+def invalidate_attribute_store(user_id: str = None):
+    if user_id is None:
+        attribute_store.invalidate()
+    else:
+        changes_before = attribute_store.changes
+        attribute_store.refresh_user(user_id)
+        # 事前計算したおすすめにも反映（削除されていればそのユーザーを取り除く）
+        update_recommendations_for_user(user_id, changes_before)
+    return {"message": "Attribute store invalidated"}
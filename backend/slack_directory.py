@@ -0,0 +1,331 @@
+import asyncio
+import threading
+import time
+from slack_sdk.errors import SlackApiError
+from supabase_client import supabase, get_async_supabase
+from slack_transport import slack_transport
+from config import (
+    SLACK_CHANNEL_MISS_RELOAD_SECONDS,
+    SLACK_CHANNEL_TTL_SECONDS,
+    SLACK_DIRECTORY_MISS_TTL_SECONDS,
+    SLACK_DIRECTORY_TTL_SECONDS,
+    SLACK_DM_CHANNELS_DURABLE,
+)
+
+
+class SlackDirectory:
+    """Slack ワークスペースの メールアドレス -> Slack ID をメモリ上に保持する
+
+    - users.list をカーソルで最後のページまでたどって作る
+    - TTL が切れたら古い内容を返しつつ、バックグラウンドのスレッドで取り直す
+    - 見つからないメールアドレスは users.lookupByEmail で1件だけ問い合わせる
+      （見つからなかった結果も SLACK_DIRECTORY_MISS_TTL_SECONDS の間は覚えておく）
+    """
+
+    def __init__(
+        self,
+        client,
+        ttl_seconds: float = SLACK_DIRECTORY_TTL_SECONDS,
+        miss_ttl_seconds: float = SLACK_DIRECTORY_MISS_TTL_SECONDS,
+        page_size: int = 200,
+    ):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.miss_ttl_seconds = miss_ttl_seconds
+        self.page_size = page_size
+        self.lock = threading.Lock()
+
+        self.emails = {}        # email -> slack_id
+        self.not_found = {}     # email -> 見つからなかった時刻（monotonic）
+        self.loaded_at = None
+        self.refreshing = False
+
+        # 計測用カウンタ
+        self.hits = 0
+        self.lookups = 0
+        self.refreshes = 0
+        self.last_refresh_seconds = 0.0
+        self.last_error = None
+
+    def fetch_all(self) -> dict:
+        """users.list を全ページ取得して email -> slack_id を作る"""
+        emails = {}
+        cursor = None
+        while True:
+            response = self.client.call("users.list", limit=self.page_size, cursor=cursor)
+            for user in response["members"]:
+                email = user.get("profile", {}).get("email")
+                if email:
+                    emails[email] = user["id"]
+            cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                return emails
+
+    def reload(self):
+        started = time.perf_counter()
+        emails = self.fetch_all()
+        with self.lock:
+            self.emails = emails
+            self.not_found = {}
+            self.loaded_at = time.monotonic()
+            self.refreshes += 1
+            self.last_refresh_seconds = time.perf_counter() - started
+            self.last_error = None
+
+    def _refresh_in_background(self):
+        try:
+            self.reload()
+        except Exception as e:
+            with self.lock:
+                self.last_error = str(e)
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def _ensure_loaded(self):
+        with self.lock:
+            if self.loaded_at is not None:
+                expired = time.monotonic() - self.loaded_at > self.ttl_seconds
+                if not expired or self.refreshing:
+                    return
+                # 期限切れでも古い内容で応答し、取り直しは別スレッドで行う
+                self.refreshing = True
+                threading.Thread(target=self._refresh_in_background, daemon=True).start()
+                return
+        # 初回だけはその場で取得する
+        self.reload()
+
+    def lookup(self, email: str):
+        """メールアドレスから Slack ID を返す（ワークスペースにいなければ None）"""
+        self._ensure_loaded()
+        with self.lock:
+            slack_id = self.emails.get(email)
+            if slack_id is not None:
+                self.hits += 1
+                return slack_id
+            missed_at = self.not_found.get(email)
+            if missed_at is not None and time.monotonic() - missed_at <= self.miss_ttl_seconds:
+                self.hits += 1
+                return None
+            self.lookups += 1
+
+        # 一覧を取った後に参加したユーザーかもしれないので、1件だけ問い合わせる
+        try:
+            slack_id = self.client.call("users.lookupByEmail", email=email)["user"]["id"]
+        except SlackApiError as e:
+            if e.response.get("error") != "users_not_found":
+                raise
+            slack_id = None
+
+        with self.lock:
+            if slack_id is None:
+                self.not_found[email] = time.monotonic()
+            else:
+                self.emails[email] = slack_id
+        return slack_id
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "emails": len(self.emails),
+                "hits": self.hits,
+                "lookups": self.lookups,
+                "refreshes": self.refreshes,
+                "last_refresh_seconds": self.last_refresh_seconds,
+                "last_error": self.last_error,
+                "age_seconds": None if self.loaded_at is None else time.monotonic() - self.loaded_at,
+            }
+
+
+class ChannelDirectory:
+    """Slack のチャンネル名 -> チャンネル ID をメモリ上に保持する
+
+    conversations.list をカーソルで最後のページまでたどって作り、TTL が切れたときか
+    見つからない名前を聞かれたとき（前回の取得から SLACK_CHANNEL_MISS_RELOAD_SECONDS 以上経っていれば）に取り直す
+    """
+
+    def __init__(
+        self,
+        client,
+        ttl_seconds: float = SLACK_CHANNEL_TTL_SECONDS,
+        miss_reload_seconds: float = SLACK_CHANNEL_MISS_RELOAD_SECONDS,
+        page_size: int = 200,
+    ):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.miss_reload_seconds = miss_reload_seconds
+        self.page_size = page_size
+        self.lock = threading.Lock()
+
+        self.channels = {}  # チャンネル名 -> チャンネル ID
+        self.loaded_at = None
+
+        # 計測用カウンタ
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def fetch_all(self) -> dict:
+        """conversations.list を全ページ取得して チャンネル名 -> ID を作る"""
+        channels = {}
+        cursor = None
+        while True:
+            response = self.client.call("conversations.list", limit=self.page_size, cursor=cursor, exclude_archived=True)
+            for channel in response["channels"]:
+                channels[channel["name"]] = channel["id"]
+            cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                return channels
+
+    def reload(self):
+        channels = self.fetch_all()
+        with self.lock:
+            self.channels = channels
+            self.loaded_at = time.monotonic()
+            self.refreshes += 1
+
+    def _age(self):
+        return None if self.loaded_at is None else time.monotonic() - self.loaded_at
+
+    def channel_id(self, name: str):
+        """チャンネル名から ID を返す（見つからなければ None）"""
+        age = self._age()
+        if age is None or age > self.ttl_seconds:
+            self.reload()
+        with self.lock:
+            channel_id = self.channels.get(name)
+            if channel_id is not None:
+                self.hits += 1
+                return channel_id
+            self.misses += 1
+
+        # 一覧を取った後に作られたチャンネルかもしれないので取り直す（連続で取り直さないよう間隔を空ける）
+        if self._age() > self.miss_reload_seconds:
+            self.reload()
+            with self.lock:
+                return self.channels.get(name)
+        return None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "channels": len(self.channels),
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "age_seconds": self._age(),
+            }
+
+
+class ClusterChannels:
+    """クラスタ ID -> Slack チャンネル ID の対応（cluster_channels テーブルに保存し、メモリ上にも保持する）
+
+    チャンネル名はクラスタ ID と同じなので、初めて聞かれたクラスタだけ ChannelDirectory で探して保存する
+    """
+
+    def __init__(self, client, channels: ChannelDirectory):
+        self.client = client
+        self.channels = channels
+        self.lock = threading.Lock()
+        self.mapping = {}  # cluster_id -> channel_id
+
+    def channel_id(self, cluster_id: int):
+        """クラスタのチャンネル ID を返す（チャンネルが無ければ None）"""
+        with self.lock:
+            channel_id = self.mapping.get(cluster_id)
+        if channel_id is not None:
+            return channel_id
+
+        # Supabase を使わない場合（DATA_BACKEND=sqlite）はメモリ上だけに保持する
+        rows = []
+        if self.client is not None:
+            rows = self.client.table("cluster_channels").select("channel_id").eq("cluster", cluster_id).execute().data
+        if rows:
+            channel_id = rows[0]["channel_id"]
+        else:
+            channel_id = self.channels.channel_id(str(cluster_id))
+            if channel_id is None:
+                return None
+            if self.client is not None:
+                self.client.table("cluster_channels").upsert(
+                    {"cluster": cluster_id, "channel_id": channel_id}, on_conflict="cluster"
+                ).execute()
+
+        with self.lock:
+            self.mapping[cluster_id] = channel_id
+        return channel_id
+
+
+class DMChannels:
+    """2人の Slack ID -> DM のチャンネル ID（メモリ上に保持し、durable=True なら dm_channels テーブルにも保存する）
+
+    キーは Slack ID を並べ替えた組なので、どちらから開いても同じ DM を使う
+    conversations.open は初めての組のときだけ呼び出す（同じ組を同時に開こうとしても1回にまとめる）
+    """
+
+    def __init__(self, transport, durable: bool = SLACK_DM_CHANNELS_DURABLE):
+        self.transport = transport
+        self.durable = durable
+        self.channels = {}  # (slack_id1, slack_id2) -> channel_id
+        self.opening = {}   # 開いている最中の組 -> asyncio.Task
+
+        # 計測用カウンタ
+        self.hits = 0
+        self.table_hits = 0
+        self.opens = 0
+
+    @staticmethod
+    def key(slack_id1: str, slack_id2: str) -> tuple:
+        return tuple(sorted((slack_id1, slack_id2)))
+
+    async def channel_id(self, slack_id1: str, slack_id2: str) -> str:
+        """2人の DM のチャンネル ID を返す（無ければ conversations.open で開く）"""
+        key = self.key(slack_id1, slack_id2)
+        channel_id = self.channels.get(key)
+        if channel_id is not None:
+            self.hits += 1
+            return channel_id
+
+        task = self.opening.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load_or_open(key))
+            self.opening[key] = task
+            task.add_done_callback(lambda _: self.opening.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _load_or_open(self, key: tuple) -> str:
+        if self.durable:
+            client = await get_async_supabase()
+            rows = (await client.table("dm_channels").select("channel_id")
+                    .eq("slack_id1", key[0]).eq("slack_id2", key[1]).execute()).data
+            if rows:
+                self.table_hits += 1
+                self.channels[key] = rows[0]["channel_id"]
+                return rows[0]["channel_id"]
+
+        response = await self.transport.acall("conversations.open", users=list(key))
+        self.opens += 1
+        channel_id = response["channel"]["id"]
+        self.channels[key] = channel_id
+
+        if self.durable:
+            client = await get_async_supabase()
+            await client.table("dm_channels").upsert(
+                {"slack_id1": key[0], "slack_id2": key[1], "channel_id": channel_id},
+                on_conflict="slack_id1,slack_id2",
+            ).execute()
+        return channel_id
+
+    def stats(self) -> dict:
+        return {
+            "pairs": len(self.channels),
+            "hits": self.hits,
+            "table_hits": self.table_hits,
+            "opens": self.opens,
+        }
+
+
+slack_directory = SlackDirectory(slack_transport)
+channel_directory = ChannelDirectory(slack_transport)
+cluster_channels = ClusterChannels(supabase, channel_directory)
+dm_channels = DMChannels(slack_transport)
@@ -0,0 +1,372 @@
+import asyncio
+import json
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from slack_sdk.errors import SlackApiError
+from supabase_client import get_async_supabase
+from slack_transport import slack_transport
+from slack_directory import dm_channels
+from config import (
+    SLACK_OUTBOX_BATCH_SIZE,
+    SLACK_OUTBOX_DEDUP_SECONDS,
+    SLACK_OUTBOX_DURABLE,
+    SLACK_OUTBOX_LEASE_SECONDS,
+    SLACK_OUTBOX_MAX_ATTEMPTS,
+    SLACK_OUTBOX_RETRY_SECONDS,
+    SLACK_OUTBOX_WORKERS,
+)
+
+# 送信するメッセージの種類
+#   dm:      payload = {"users": [slack_id1, slack_id2], "text": ...}（DM を開いて送る）
+#            または {"channel": DM のチャンネル ID, "text": ...}（開いた DM に送る）
+#   channel: payload = {"channel": チャンネル ID, "text": ..., "join": True}（ボットが参加してから送る）
+MESSAGE_KINDS = ("dm", "channel")
+
+
+def dedup_key(kind: str, payload: dict) -> str:
+    """宛先と本文が同じメッセージは同じキーになる（2人の Slack ID の順番は問わない）"""
+    payload = dict(payload)
+    if "users" in payload:
+        payload["users"] = sorted(payload["users"])
+    return kind + ":" + json.dumps(payload, ensure_ascii=False, sort_keys=True)
+
+
+def lease_until(seconds: float) -> str:
+    """今から seconds 秒後の時刻（slack_outbox.leased_until に入れる形式）"""
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat()
+
+
+class SlackOutbox:
+    """Slack への送信（挨拶・チャンネルへの投稿）をキューに積み、バックグラウンドのワーカーで送る
+
+    - ルートは enqueue するだけで、Slack の応答を待たずに返す
+    - ワーカーは最大 batch_size 件ずつ取り出し、同じ宛先への送信は DM を開く・チャンネルに参加するのを1回にまとめる
+    - 同時に Slack へ送るのはワーカー数まで。失敗したら間隔を空けて max_attempts 回まで送り直す
+    - 宛先と本文が同じメッセージは、送信待ちの間と送信後 dedup_seconds の間は1回しか送らない
+    - durable=True なら slack_outbox テーブルにも保存し、起動時に未送信のものを読み込んで送る
+      - 行は owner（このインスタンス）が leased_until まで受け持ち、起動時には未送信の行と期限が切れた行だけを取り出す
+      - 送る前に受け持ちを延ばし、延ばせなかった（他のインスタンスが取り出した）行は送らない
+    """
+
+    def __init__(
+        self,
+        transport,
+        dm_channels,
+        workers: int = SLACK_OUTBOX_WORKERS,
+        batch_size: int = SLACK_OUTBOX_BATCH_SIZE,
+        max_attempts: int = SLACK_OUTBOX_MAX_ATTEMPTS,
+        retry_seconds: float = SLACK_OUTBOX_RETRY_SECONDS,
+        dedup_seconds: float = SLACK_OUTBOX_DEDUP_SECONDS,
+        durable: bool = SLACK_OUTBOX_DURABLE,
+        lease_seconds: float = SLACK_OUTBOX_LEASE_SECONDS,
+    ):
+        self.transport = transport
+        self.dm_channels = dm_channels
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.dedup_seconds = dedup_seconds
+        self.durable = durable
+        self.lease_seconds = lease_seconds
+        self.owner = str(uuid.uuid4())  # slack_outbox の行を受け持つときの、このインスタンスの ID
+
+        self.queue = None
+        self._tasks = []
+        self.pending = {}  # dedup_key -> 送信待ち・送信中のメッセージ
+        self.recent = {}   # dedup_key -> 送信した時刻（monotonic）
+        self.waiting_retry = 0
+        self.retry_timers = {}  # メッセージID -> (call_later のハンドル, 送り直し待ちのメッセージ)
+
+        # 計測用
+        self.enqueued = 0
+        self.deduplicated = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.batches = 0
+        self.lost_leases = 0  # 送る前に他のインスタンスに取り出されていた数
+        self.in_flight = 0
+        self.latencies = deque(maxlen=1000)  # キューに積んでから送信できるまでの秒数
+        self.last_error = None
+
+    # ---------- 起動・停止 ----------
+
+    @property
+    def started(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self):
+        if self.started:
+            return
+        self.queue = asyncio.Queue()
+        self._tasks = [asyncio.ensure_future(self.worker()) for _ in range(self.workers)]
+        if self.durable:
+            await self.load_pending()
+
+    async def stop(self, timeout_seconds: float = 5.0):
+        """キューに残っている分を送り切るまで少し待ってからワーカーを止める（送れなかった分はテーブルに残る）
+
+        送り直し待ちのメッセージも、待ち時間を切り上げてキューに戻してから送る
+        """
+        if not self.started:
+            return
+        deadline = time.monotonic() + timeout_seconds
+        while True:
+            for handle, message in list(self.retry_timers.values()):
+                handle.cancel()
+                self._requeue(message)
+            try:
+                await asyncio.wait_for(self.queue.join(), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                break
+            # 送っている間にまた失敗したものがあれば、時間の許す限り繰り返す
+            if not self.retry_timers or time.monotonic() >= deadline:
+                break
+        for handle, _ in self.retry_timers.values():
+            handle.cancel()
+        self.retry_timers = {}
+        self.waiting_retry = 0
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.durable:
+            try:
+                await self.release_pending()
+            except Exception as e:
+                # 外せなくても、受け持ちの期限が切れれば他のインスタンスが取り出す
+                self.last_error = str(e)
+
+    # ---------- 積む ----------
+
+    async def enqueue(self, kind: str, payload: dict) -> dict:
+        """メッセージをキューに積む（重複していれば既存のメッセージを返す）"""
+        if kind not in MESSAGE_KINDS:
+            raise ValueError(f"unknown message kind: {kind}")
+        await self.start()
+
+        key = dedup_key(kind, payload)
+        existing = self.pending.get(key)
+        sent_at = self.recent.get(key)
+        if existing is not None or (sent_at is not None and time.monotonic() - sent_at <= self.dedup_seconds):
+            self.deduplicated += 1
+            return {"id": existing["id"] if existing else None, "status": "duplicate"}
+
+        message = {
+            "id": str(uuid.uuid4()),
+            "kind": kind,
+            "dedup_key": key,
+            "payload": payload,
+            "attempts": 0,
+            "enqueued_at": time.time(),
+        }
+        self.pending[key] = message
+        if self.durable:
+            try:
+                client = await get_async_supabase()
+                await client.table("slack_outbox").insert({
+                    "id": message["id"], "kind": kind, "dedup_key": key, "payload": payload,
+                    "status": "sending", "owner": self.owner, "leased_until": lease_until(self.lease_seconds),
+                }).execute()
+            except Exception:
+                # 保存できなかったメッセージは積まないので、同じメッセージを重複扱いにしない
+                self.pending.pop(key, None)
+                raise
+
+        self.enqueued += 1
+        self.queue.put_nowait(message)
+        return {"id": message["id"], "status": "queued"}
+
+    async def load_pending(self, chunk_size: int = 1000):
+        """slack_outbox テーブルの未送信メッセージと受け持ちの期限が切れたメッセージを取り出してキューに戻す
+
+        取り出しは claim_slack_outbox 関数で行い、同時に起動した他のインスタンスと同じ行は取らない
+        """
+        client = await get_async_supabase()
+        rows = []
+        while True:
+            chunk = (await client.rpc("claim_slack_outbox", {
+                "claimer": self.owner, "lease_seconds": self.lease_seconds, "max_rows": chunk_size,
+            }).execute()).data or []
+            rows += chunk
+            if len(chunk) < chunk_size:
+                break
+        for row in sorted(rows, key=lambda row: row["created_at"]):
+            if row["dedup_key"] in self.pending:
+                continue
+            message = {
+                "id": row["id"],
+                "kind": row["kind"],
+                "dedup_key": row["dedup_key"],
+                "payload": row["payload"],
+                "attempts": row["attempts"],
+                "enqueued_at": time.time(),
+            }
+            self.pending[message["dedup_key"]] = message
+            self.queue.put_nowait(message)
+
+    async def release_pending(self):
+        """停止時に送り切れなかった行の受け持ちを外し、すぐに他のインスタンスが取り出せるようにする"""
+        ids = [message["id"] for message in self.pending.values()]
+        if not ids:
+            return
+        client = await get_async_supabase()
+        await client.table("slack_outbox").update({
+            "status": "pending", "owner": None, "leased_until": None,
+        }).in_("id", ids).eq("owner", self.owner).eq("status", "sending").execute()
+
+    async def renew_leases(self, batch: list) -> list:
+        """batch の受け持ちを延ばし、まだこのインスタンスが受け持っているメッセージだけを返す"""
+        client = await get_async_supabase()
+        rows = (await client.table("slack_outbox").update({
+            "leased_until": lease_until(self.lease_seconds),
+        }).in_("id", [message["id"] for message in batch]).eq("owner", self.owner).eq("status", "sending").execute()).data
+        owned = {row["id"] for row in rows}
+        for message in batch:
+            if message["id"] not in owned:
+                self.lost_leases += 1
+                self.pending.pop(message["dedup_key"], None)
+        return [message for message in batch if message["id"] in owned]
+
+    def _requeue(self, message: dict):
+        self.retry_timers.pop(message["id"], None)
+        self.waiting_retry -= 1
+        self.queue.put_nowait(message)
+
+    # ---------- 送る ----------
+
+    async def worker(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            self.in_flight += len(batch)
+            try:
+                await self.deliver_batch(batch)
+            except Exception as e:
+                # 送信結果の記録に失敗しても、ワーカーは止めない
+                self.last_error = str(e)
+            finally:
+                self.in_flight -= len(batch)
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def deliver_batch(self, batch: list):
+        """宛先ごとにまとめて送り、送信済みの分をまとめて記録する"""
+        self.batches += 1
+        if self.durable:
+            batch = await self.renew_leases(batch)
+        groups = {}
+        for message in batch:
+            payload = message["payload"]
+            target = payload.get("channel") or tuple(sorted(payload["users"]))
+            groups.setdefault(target, []).append(message)
+
+        sent = []
+        for messages in groups.values():
+            sent += await self.deliver_group(messages)
+
+        now = time.time()
+        for message in sent:
+            self.pending.pop(message["dedup_key"], None)
+            self.recent[message["dedup_key"]] = time.monotonic()
+            self.latencies.append(now - message["enqueued_at"])
+        self.sent += len(sent)
+        self._prune_recent()
+
+        if self.durable and sent:
+            client = await get_async_supabase()
+            await client.table("slack_outbox").update({
+                "status": "sent",
+                "sent_at": datetime.now(timezone.utc).isoformat(),
+                "owner": None,
+                "leased_until": None,
+            }).in_("id", [message["id"] for message in sent]).eq("owner", self.owner).execute()
+
+    async def deliver_group(self, messages: list) -> list:
+        """同じ宛先のメッセージを送る（DM を開く・チャンネルに参加するのは1回だけ）"""
+        payload = messages[0]["payload"]
+        try:
+            channel_id = payload.get("channel")
+            if channel_id is None:
+                channel_id = await self.dm_channels.channel_id(*payload["users"])
+            if any(message["payload"].get("join") for message in messages):
+                await self.transport.acall("conversations.join", channel=channel_id)
+        except Exception as e:
+            for message in messages:
+                await self.retry_or_fail(message, e)
+            return []
+
+        sent = []
+        for message in messages:
+            try:
+                await self.transport.acall("chat.postMessage", channel=channel_id, text=message["payload"]["text"])
+            except SlackApiError as e:
+                # 送信後にタイムアウトした投稿は届いているかもしれないので、二重投稿しないよう送り直さない
+                await self.retry_or_fail(message, e, retry=not e.response.get("request_sent"))
+                continue
+            except Exception as e:
+                await self.retry_or_fail(message, e)
+                continue
+            sent.append(message)
+        return sent
+
+    async def retry_or_fail(self, message: dict, error: Exception, retry: bool = True):
+        message["attempts"] += 1
+        self.last_error = str(error)
+        final = not retry or message["attempts"] >= self.max_attempts
+        delay = self.retry_seconds * 2 ** (message["attempts"] - 1)
+
+        if final:
+            self.failed += 1
+            self.pending.pop(message["dedup_key"], None)
+        else:
+            self.retries += 1
+            self.waiting_retry += 1
+            handle = asyncio.get_running_loop().call_later(delay, self._requeue, message)
+            self.retry_timers[message["id"]] = (handle, message)
+
+        if self.durable:
+            client = await get_async_supabase()
+            # 送り直すまでの間も、このインスタンスが受け持ったままにする
+            await client.table("slack_outbox").update({
+                "status": "failed" if final else "sending",
+                "attempts": message["attempts"],
+                "last_error": str(error),
+                "leased_until": None if final else lease_until(delay + self.lease_seconds),
+            }).eq("id", message["id"]).eq("owner", self.owner).execute()
+
+    def _prune_recent(self):
+        expired_before = time.monotonic() - self.dedup_seconds
+        for key in [key for key, sent_at in self.recent.items() if sent_at < expired_before]:
+            del self.recent[key]
+
+    # ---------- 計測 ----------
+
+    def metrics(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "workers": len(self._tasks),
+            "queue_depth": (self.queue.qsize() if self.queue is not None else 0) + self.waiting_retry,
+            "waiting_retry": self.waiting_retry,
+            "in_flight": self.in_flight,
+            "enqueued": self.enqueued,
+            "deduplicated": self.deduplicated,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "batches": self.batches,
+            "lost_leases": self.lost_leases,
+            "latency_average_seconds": sum(latencies) / len(latencies) if latencies else None,
+            "latency_p95_seconds": latencies[int(len(latencies) * 0.95)] if latencies else None,
+            "latency_max_seconds": latencies[-1] if latencies else None,
+            "last_error": self.last_error,
+            "durable": self.durable,
+        }
+
+
+slack_outbox = SlackOutbox(slack_transport, dm_channels)
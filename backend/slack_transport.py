@@ -0,0 +1,317 @@
+import asyncio
+import json
+import random
+import threading
+import time
+import httpx
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web import SlackResponse
+from config import SLACK_BOT_TOKEN, SLACK_MAX_RETRIES, SLACK_POOL_SIZE, SLACK_TIMEOUT_SECONDS
+
+SLACK_API_URL = "https://slack.com/api/"
+
+# Slack の Web API のレート制限（1分あたりの回数）
+# https://api.slack.com/docs/rate-limits の Tier 1〜4
+TIER_RATES = {1: 1, 2: 20, 3: 50, 4: 100}
+METHOD_RATES = {
+    "users.list": TIER_RATES[2],
+    "users.lookupByEmail": TIER_RATES[3],
+    "conversations.list": TIER_RATES[2],
+    "conversations.open": TIER_RATES[3],
+    "conversations.join": TIER_RATES[3],
+    # chat.postMessage の制限はチャンネルごとなので、ここはワークスペース全体の大まかな上限
+    "chat.postMessage": 600,
+}
+DEFAULT_RATE = TIER_RATES[3]
+
+# チャンネルごとのレート制限（1分あたりの回数）と、瞬間的に送ってよい回数
+# chat.postMessage はおおむね1チャンネルに1秒1回
+CHANNEL_RATES = {"chat.postMessage": 60}
+CHANNEL_BURST = 3
+
+# チャンネルごとのバケットをこの数より多く持ったら、使っていないものを捨てる
+MAX_CHANNEL_BUCKETS = 1000
+
+# 同じ呼び出しを2回送ると結果が変わるメソッド（送信後のタイムアウトや 5xx では再試行しない）
+NON_IDEMPOTENT_METHODS = {"chat.postMessage"}
+
+# リクエストを送る前に失敗したことが確かなエラー（どのメソッドでも再試行してよい）
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class TokenBucket:
+    """1分あたり rate 回まで（瞬間的には capacity 回まで）に呼び出しを抑える"""
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, rate_per_minute / 5)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """1回分を予約し、呼び出してよくなるまでの待ち時間（秒）を返す"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1.0
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(wait, self.blocked_until - now)
+
+    def block(self, seconds: float):
+        """Retry-After を受け取ったら、その間は他の呼び出しも待たせる"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        """満タンまで戻っていて、待たせてもいない（捨てても呼び出しの間隔が変わらない）"""
+        with self.lock:
+            now = time.monotonic()
+            tokens = self.tokens + (now - self.updated_at) * self.rate
+            return tokens >= self.capacity and self.blocked_until <= now
+
+
+class SlackTransport:
+    """Slack の Web API をまとめて呼び出す（slack.py・slack_directory.py からはこれだけを使う）
+
+    - 同期・非同期ともに keep-alive の接続プールを使い回す
+    - メソッドごとのトークンバケットで Slack の Tier に合わせて呼び出しを間引く
+      （chat.postMessage はチャンネルごとのバケットと、全体の上限のバケットの両方で間引く）
+    - 429 のときは Retry-After だけ待って、接続エラーや 5xx のときは指数バックオフで再試行する
+      （chat.postMessage は二重投稿にならないよう、送信前の接続エラーのときだけ再試行する）
+    """
+
+    def __init__(
+        self,
+        token: str,
+        max_retries: int = SLACK_MAX_RETRIES,
+        timeout_seconds: float = SLACK_TIMEOUT_SECONDS,
+        pool_size: int = SLACK_POOL_SIZE,
+    ):
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.max_retries = max_retries
+        self.timeout = httpx.Timeout(timeout_seconds)
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+        self._client = None
+        self._async_client = None
+        self._async_loop = None
+
+        # 計測用カウンタ（メソッドごと）
+        self.counters = {}
+
+    # ---------- 接続 ----------
+
+    @property
+    def client(self) -> httpx.Client:
+        with self.lock:
+            if self._client is None:
+                self._client = httpx.Client(base_url=SLACK_API_URL, headers=self.headers, timeout=self.timeout, limits=self.limits)
+            return self._client
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        # 接続はイベントループごとに作る（FastAPI では1つのループを使い続ける）
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            self._async_client = httpx.AsyncClient(base_url=SLACK_API_URL, headers=self.headers, timeout=self.timeout, limits=self.limits)
+            self._async_loop = loop
+        return self._async_client
+
+    # ---------- レート制限・計測 ----------
+
+    def bucket(self, method: str, channel: str = None) -> TokenBucket:
+        """メソッドのバケット（channel を渡すと、チャンネルごとに制限されるメソッドはそのチャンネルのバケット）"""
+        if channel is None or method not in CHANNEL_RATES:
+            key = method
+        else:
+            key = (method, channel)
+        with self.lock:
+            if key not in self.buckets:
+                if key != method:
+                    self._prune_channel_buckets()
+                    self.buckets[key] = TokenBucket(CHANNEL_RATES[method], CHANNEL_BURST)
+                else:
+                    self.buckets[key] = TokenBucket(METHOD_RATES.get(method, DEFAULT_RATE))
+            return self.buckets[key]
+
+    def _prune_channel_buckets(self):
+        """使っていないチャンネルのバケットを捨てる（self.lock の中で呼ぶ）"""
+        channel_keys = [key for key in self.buckets if isinstance(key, tuple)]
+        if len(channel_keys) < MAX_CHANNEL_BUCKETS:
+            return
+        for key in channel_keys:
+            if self.buckets[key].idle():
+                del self.buckets[key]
+
+    def reserve(self, method: str, channel: str = None) -> float:
+        """呼び出し1回分をメソッドとチャンネルのバケットから予約し、長いほうの待ち時間（秒）を返す"""
+        wait = self.bucket(method).reserve()
+        if channel is not None and method in CHANNEL_RATES:
+            wait = max(wait, self.bucket(method, channel).reserve())
+        return wait
+
+    def record(self, method: str, **values):
+        with self.lock:
+            counter = self.counters.setdefault(method, {
+                "requests": 0, "errors": 0, "retries": 0, "throttled": 0,
+                "wait_seconds": 0.0, "total_seconds": 0.0, "max_seconds": 0.0,
+            })
+            for key, value in values.items():
+                if key == "max_seconds":
+                    counter[key] = max(counter[key], value)
+                else:
+                    counter[key] += value
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                method: {
+                    **counter,
+                    "average_seconds": counter["total_seconds"] / counter["requests"] if counter["requests"] else None,
+                }
+                for method, counter in self.counters.items()
+            }
+
+    # ---------- 呼び出し ----------
+
+    @staticmethod
+    def encode(params: dict) -> dict:
+        """フォーム形式に変換（リストはカンマ区切り、辞書は JSON、None は送らない）"""
+        data = {}
+        for key, value in params.items():
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple)):
+                value = ",".join(str(item) for item in value)
+            elif isinstance(value, dict):
+                value = json.dumps(value, ensure_ascii=False)
+            elif isinstance(value, bool):
+                value = "true" if value else "false"
+            data[key] = value
+        return data
+
+    def retry_delay(self, method: str, response, attempt: int, sent: bool = True, channel: str = None):
+        """再試行するなら待ち時間（秒）を、しないなら None を返す（sent はリクエストを送り終えたかどうか）"""
+        if attempt >= self.max_retries:
+            return None
+        if response is not None and response.status_code == 429:
+            retry_after = float(response.headers.get("Retry-After", 1))
+            # チャンネルごとに制限されるメソッドは、そのチャンネルへの呼び出しだけを待たせる
+            self.bucket(method, channel).block(retry_after)
+            self.record(method, throttled=1)
+            return retry_after
+        if response is None or response.status_code >= 500:
+            if sent and method in NON_IDEMPOTENT_METHODS:
+                return None
+            return min(0.5 * 2 ** attempt, 8.0) * (0.5 + random.random())
+        return None
+
+    def error(self, method: str, message: str, data: dict, response=None) -> SlackApiError:
+        """routes/slack.py などが e.response["error"] を読めるよう、SlackResponse を付けたエラーを作る"""
+        self.record(method, errors=1)
+        return SlackApiError(
+            f"{message} (method: {method})",
+            SlackResponse(
+                client=self,
+                http_verb="POST",
+                api_url=SLACK_API_URL + method,
+                req_args={},
+                data=data,
+                headers=dict(response.headers) if response is not None else {},
+                status_code=response.status_code if response is not None else 0,
+            ),
+        )
+
+    def result(self, method: str, response) -> dict:
+        try:
+            data = response.json()
+        except ValueError:
+            # 5xx やプロキシのエラーページなど JSON でない応答
+            raise self.error(
+                method, "The Slack API returned a non-JSON response.",
+                {"ok": False, "error": f"http_{response.status_code}", "request_sent": response.status_code >= 500}, response,
+            )
+        if not isinstance(data, dict) or not data.get("ok"):
+            raise self.error(
+                method, "The request to the Slack API failed.",
+                data if isinstance(data, dict) else {"ok": False, "error": "invalid_response"}, response,
+            )
+        return data
+
+    def call(self, method: str, **params) -> dict:
+        """Web API を呼び出してレスポンスの JSON を返す（ok でなければ SlackApiError）"""
+        data = self.encode(params)
+        channel = params.get("channel")
+        attempt = 0
+        while True:
+            wait = self.reserve(method, channel)
+            if wait > 0:
+                self.record(method, wait_seconds=wait)
+                time.sleep(wait)
+
+            started = time.perf_counter()
+            sent = True
+            try:
+                response = self.client.post(method, data=data)
+            except UNSENT_ERRORS:
+                response, sent = None, False
+            except httpx.TransportError:
+                response = None
+            elapsed = time.perf_counter() - started
+            self.record(method, requests=1, total_seconds=elapsed, max_seconds=elapsed)
+
+            delay = self.retry_delay(method, response, attempt, sent, channel)
+            if delay is None:
+                if response is None:
+                    # request_sent: 送信後のタイムアウトなど、Slack 側で処理されたかもしれない
+                    raise self.error(
+                        method, "Failed to connect to the Slack API.",
+                        {"ok": False, "error": "connection_error", "request_sent": sent},
+                    )
+                return self.result(method, response)
+            self.record(method, retries=1)
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(self, method: str, **params) -> dict:
+        """call の非同期版"""
+        data = self.encode(params)
+        channel = params.get("channel")
+        attempt = 0
+        while True:
+            wait = self.reserve(method, channel)
+            if wait > 0:
+                self.record(method, wait_seconds=wait)
+                await asyncio.sleep(wait)
+
+            started = time.perf_counter()
+            sent = True
+            try:
+                response = await self.async_client.post(method, data=data)
+            except UNSENT_ERRORS:
+                response, sent = None, False
+            except httpx.TransportError:
+                response = None
+            elapsed = time.perf_counter() - started
+            self.record(method, requests=1, total_seconds=elapsed, max_seconds=elapsed)
+
+            delay = self.retry_delay(method, response, attempt, sent, channel)
+            if delay is None:
+                if response is None:
+                    # request_sent: 送信後のタイムアウトなど、Slack 側で処理されたかもしれない
+                    raise self.error(
+                        method, "Failed to connect to the Slack API.",
+                        {"ok": False, "error": "connection_error", "request_sent": sent},
+                    )
+                return self.result(method, response)
+            self.record(method, retries=1)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+slack_transport = SlackTransport(SLACK_BOT_TOKEN)
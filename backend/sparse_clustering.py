@@ -0,0 +1,45 @@
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from repository import repository
+from feature_store import FEATURE_FIELDS, feature_store, feature_vocabularies, one_hot
+from cluster_model import ClusterModel, next_model_version
+from config import CLUSTERING_PAGE_SIZE, CLUSTERING_BATCH_SIZE, CLUSTERING_MINIBATCH_MIN_USERS
+
+
+def fetch_attribute_pages(page_size: int = CLUSTERING_PAGE_SIZE):
+    """user_attributes を user_id 順に page_size 件ずつ取得する（キーセット方式）"""
+    return repository.attribute_pages(page_size, FEATURE_FIELDS)
+
+
+def cluster_sparse(page_size: int = CLUSTERING_PAGE_SIZE, batch_size: int = CLUSTERING_BATCH_SIZE) -> dict:
+    """ページごとに取得した行を feature_store でエンコードして疎行列を作り、クラスタリングする
+
+    ユーザー数が CLUSTERING_MINIBATCH_MIN_USERS 以上なら MiniBatchKMeans、それ未満なら疎行列のまま KMeans
+    （クラスタ数が多いと MiniBatchKMeans は精度が落ちるため、少人数では従来と同じ KMeans を使う）
+    """
+    user_ids = []
+    encoded = []
+    for rows in fetch_attribute_pages(page_size):
+        user_ids.extend(row["user_id"] for row in rows)
+        encoded.extend(feature_store.encode(row) for row in rows)
+    batch = feature_store.batch(user_ids, encoded)
+    features = one_hot(batch)
+    hobbies, vocabularies = feature_vocabularies(batch)
+
+    # クラスタ数は従来どおり「3人に1クラスタ」
+    n_clusters = max(len(user_ids) // 3, 1)
+    if len(user_ids) >= CLUSTERING_MINIBATCH_MIN_USERS:
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, random_state=42, n_init=1)
+    else:
+        kmeans = KMeans(n_clusters=n_clusters, random_state=42)
+    labels = kmeans.fit_predict(features)
+
+    model = ClusterModel.from_features(
+        features, labels, hobbies, vocabularies, version=next_model_version(), user_ids=user_ids
+    )
+    return {
+        "assignments": dict(zip(user_ids, labels.astype(int).tolist())),
+        "model": model,
+        "algorithm": type(kmeans).__name__,
+        "inertia": float(kmeans.inertia_),
+        "nonzeros": int(features.nnz),
+    }
@@ -1,4 +1,14 @@
-from supabase import create_client, Client
-from config import SUPABASE_URL, SUPABASE_KEY
+from supabase import create_client, acreate_client, Client, AsyncClient
+from config import DATA_BACKEND, SUPABASE_URL, SUPABASE_KEY
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
\ No newline at end of file
+# DATA_BACKEND=sqlite でローカルだけで動かす場合は、Supabase の設定が無くてもよい
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY) if DATA_BACKEND == "supabase" or SUPABASE_URL else None
+
+# 非同期クライアント（イベントループ上で初めて使うときに作成）
+_async_supabase = None
+
+async def get_async_supabase() -> AsyncClient:
+    global _async_supabase
+    if _async_supabase is None:
+        _async_supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+    return _async_supabase
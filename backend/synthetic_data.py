@@ -0,0 +1,303 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta
+import numpy as np
+from repository import repository
+from attribute_store import attribute_store
+from like_graph import like_graph
+from recommendations import recommendation_table, top_k_lists
+from feature_store import FIELD_VALUES, MBTI_TYPES, ROLE_VALUES
+from hobby_similarity import hobby_similarity
+from config import SYNTHETIC_BATCH_SIZE, SYNTHETIC_CONCURRENCY, SYNTHETIC_MAX_LIKES
+
+# 負荷試験用の架空データ（users / user_attributes / likes）を生成して一括で書き込む
+# 架空ユーザーの ID は SYNTHETIC_ID_PREFIX で始まるので、まとめて削除できる（repository.delete_users_with_prefix）
+
+SYNTHETIC_ID_PREFIX = "5eed0000-0000-4000-8000-"
+SYNTHETIC_EMAIL_DOMAIN = "synthetic.example.com"
+
+# 人口の多い順（出身地の偏りに使う）
+PREFECTURES = [
+    "東京都", "神奈川県", "大阪府", "愛知県", "埼玉県", "千葉県", "兵庫県", "北海道", "福岡県", "静岡県",
+    "茨城県", "広島県", "京都府", "宮城県", "新潟県", "長野県", "岐阜県", "群馬県", "栃木県", "岡山県",
+    "福島県", "三重県", "熊本県", "鹿児島県", "沖縄県", "滋賀県", "山口県", "愛媛県", "奈良県", "長崎県",
+    "青森県", "岩手県", "石川県", "大分県", "宮崎県", "山形県", "富山県", "秋田県", "香川県", "和歌山県",
+    "佐賀県", "山梨県", "福井県", "徳島県", "高知県", "島根県", "鳥取県",
+]
+
+UNIVERSITIES = [
+    "早稲田大学", "慶應義塾大学", "東京大学", "京都大学", "大阪大学", "東北大学", "名古屋大学", "九州大学",
+    "北海道大学", "東京工業大学", "一橋大学", "神戸大学", "筑波大学", "横浜国立大学", "千葉大学", "広島大学",
+    "明治大学", "同志社大学", "立命館大学", "関西学院大学", "中央大学", "法政大学", "青山学院大学", "立教大学",
+    "上智大学", "東京理科大学", "関西大学", "日本大学", "東洋大学", "近畿大学", "岡山大学", "金沢大学",
+    "新潟大学", "熊本大学", "電気通信大学", "芝浦工業大学", "東京都立大学", "大阪公立大学", "名城大学", "福岡大学",
+]
+
+# 重視する属性（登録画面と同じ選択肢、1つだけ選ぶ）
+PREFERENCES = ["mbti", "hobbies", "hometown", "field", "role", "alma_mater"]
+
+LIKE_REASONS = [
+    "趣味が同じだったので、ぜひお話ししてみたいです。",
+    "出身地が近いので、地元の話ができたら嬉しいです。",
+    "MBTIが同じだったので、気が合うかもと思い、いいねしました。",
+    "志望分野が同じなので、情報交換できたら嬉しいです。",
+    "自己紹介を読んで、一度お話ししてみたいと思いました。",
+]
+
+# 乱数の系列（テーブルごとに分ける）
+RANDOM_STREAMS = {"vocab": 0, "popularity": 1, "users": 2, "attributes": 3, "likes": 4}
+
+# 趣味の数（登録画面では最大3つ）
+HOBBY_COUNTS = [1, 2, 3]
+HOBBY_COUNT_WEIGHTS = [0.15, 0.25, 0.6]
+
+
+def zipf_weights(n: int, exponent: float = 1.0) -> np.ndarray:
+    """先頭ほど選ばれやすい確率（順位の -exponent 乗に比例）"""
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def synthetic_user_id(i: int) -> str:
+    return f"{SYNTHETIC_ID_PREFIX}{i:012x}"
+
+
+class SyntheticData:
+    """n_users 人分の架空データを chunk_size 人ずつ生成する（同じ seed なら同じデータになる）
+
+    - 出身地・大学・趣味・志望分野などは Zipf 分布で偏らせる
+    - いいねの数は Zipf 分布（ほとんどの人は数件、一部の人が多い）、いいねされやすさはパレート分布にする
+    - いいねの一部（reciprocity の割合）はお返しのいいねを付けてマッチングを成立させる
+    """
+
+    def __init__(
+        self,
+        n_users: int,
+        seed: int = 42,
+        max_likes: int = SYNTHETIC_MAX_LIKES,
+        reciprocity: float = 0.3,
+        chunk_size: int = SYNTHETIC_BATCH_SIZE,
+    ):
+        self.n_users = n_users
+        self.seed = seed
+        self.max_likes = max_likes
+        self.reciprocity = reciprocity
+        self.chunk_size = chunk_size
+
+        # 趣味の人気順は seed ごとに並べ替える
+        rng = self.rng("vocab")
+        self.hobbies = np.array(hobby_similarity.vocab, dtype=object)[rng.permutation(len(hobby_similarity.vocab))]
+        self.universities = np.array(UNIVERSITIES, dtype=object)[rng.permutation(len(UNIVERSITIES))]
+
+    def rng(self, name: str, chunk: int = 0) -> np.random.Generator:
+        """テーブル・チャンクごとに独立した乱数（生成の順番によらず同じ結果になる）"""
+        return np.random.default_rng([self.seed, RANDOM_STREAMS[name], chunk])
+
+    def chunks(self):
+        """(チャンク番号, 開始位置, 人数) を返す"""
+        for number, start in enumerate(range(0, self.n_users, self.chunk_size)):
+            yield number, start, min(self.chunk_size, self.n_users - start)
+
+    def users(self):
+        today = date.today()
+        for number, start, size in self.chunks():
+            rng = self.rng("users", number)
+            days = rng.integers(0, 365, size)
+            yield [
+                {
+                    "id": synthetic_user_id(i),
+                    "name": f"テスト ユーザー{i}",
+                    "email": f"user{i}@{SYNTHETIC_EMAIL_DOMAIN}",
+                    "slack_id": f"S{i:010d}",
+                    "password": "synthetic",
+                    "created_at": (today - timedelta(days=int(day))).isoformat(),
+                }
+                for i, day in zip(range(start, start + size), days)
+            ]
+
+    def attributes(self):
+        hobby_weights = np.log(zipf_weights(len(self.hobbies), 0.8))
+        for number, start, size in self.chunks():
+            rng = self.rng("attributes", number)
+
+            # 重み付きの非復元抽出（Gumbel-top-k）で趣味を選ぶ
+            keys = hobby_weights + rng.gumbel(size=(size, len(self.hobbies)))
+            order = np.argsort(-keys, axis=1)[:, :max(HOBBY_COUNTS)]
+            counts = rng.choice(HOBBY_COUNTS, size=size, p=HOBBY_COUNT_WEIGHTS)
+
+            hometowns = rng.choice(PREFECTURES, size=size, p=zipf_weights(len(PREFECTURES), 1.0)).tolist()
+            universities = rng.choice(self.universities, size=size, p=zipf_weights(len(self.universities), 0.7)).tolist()
+            fields = rng.choice(FIELD_VALUES, size=size, p=zipf_weights(len(FIELD_VALUES), 0.5)).tolist()
+            roles = rng.choice(ROLE_VALUES, size=size, p=zipf_weights(len(ROLE_VALUES), 0.8)).tolist()
+            mbtis = rng.choice(MBTI_TYPES, size=size, p=zipf_weights(len(MBTI_TYPES), 0.3)).tolist()
+            preferences = rng.choice(PREFERENCES, size=size).tolist()
+
+            yield [
+                {
+                    "user_id": synthetic_user_id(start + row),
+                    "hobbies": ", ".join(self.hobbies[order[row, :counts[row]]]),
+                    "hometown": hometowns[row],
+                    "field": fields[row],
+                    "role": roles[row],
+                    "mbti": mbtis[row],
+                    "alma_mater": universities[row],
+                    "preferences": preferences[row],
+                    "self_introductions": f"はじめまして、テスト ユーザー{start + row}です。{hometowns[row]}出身で、{universities[row]}を卒業しました。",
+                }
+                for row in range(size)
+            ]
+
+    def likes(self):
+        # いいねされやすさ（全ユーザー分の累積分布から相手を選ぶ）
+        popularity = self.rng("popularity").pareto(1.2, self.n_users) + 1.0
+        cumulative = np.cumsum(popularity)
+        cumulative /= cumulative[-1]
+        now = datetime.now()
+
+        for number, start, size in self.chunks():
+            rng = self.rng("likes", number)
+            degrees = np.minimum(rng.zipf(2.0, size) - 1, self.max_likes)
+            sources = np.repeat(np.arange(start, start + size), degrees)
+            targets = np.minimum(np.searchsorted(cumulative, rng.random(len(sources))), self.n_users - 1)
+
+            # お返しのいいね
+            back = rng.random(len(sources)) < self.reciprocity
+            sources, targets = np.concatenate([sources, targets[back]]), np.concatenate([targets, sources[back]])
+
+            # 自分へのいいねと重複を除く（お返しのいいねは他のチャンクと重複することがあるので、書き込み時にも無視する）
+            keep = sources != targets
+            pairs = np.unique(sources[keep].astype(np.int64) * self.n_users + targets[keep])
+            reasons = rng.integers(0, len(LIKE_REASONS), len(pairs))
+            minutes = rng.integers(0, 60 * 24 * 90, len(pairs))
+
+            yield [
+                {
+                    "user_id": synthetic_user_id(int(pair // self.n_users)),
+                    "target_user_id": synthetic_user_id(int(pair % self.n_users)),
+                    "reasons": LIKE_REASONS[reason],
+                    "created_at": (now - timedelta(minutes=int(minute))).isoformat(timespec="seconds"),
+                }
+                for pair, reason, minute in zip(pairs, reasons, minutes)
+            ]
+
+
+def invalidate_caches():
+    """架空データを入れた・消した後に、メモリ上のスナップショット・いいね・おすすめを次のアクセスで取り直させる"""
+    attribute_store.invalidate()
+    like_graph.invalidate()
+    top_k_lists.clear()
+    recommendation_table.mark(None)
+
+
+class SyntheticLoader:
+    """SyntheticData をテーブルごとに複数行の INSERT でまとめて書き込む（進み具合と行数/秒を記録する）"""
+
+    def __init__(self, repository, concurrency: int = SYNTHETIC_CONCURRENCY):
+        self.repository = repository
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.running = False
+        self.progress = {}
+
+    def insert(self, table: str, rows: list) -> int:
+        if table == "users":
+            self.repository.insert_users(rows)
+        elif table == "user_attributes":
+            self.repository.insert_attributes(rows)
+        else:
+            # お返しのいいねが他のチャンクと重複した場合は無視する
+            self.repository.insert_likes(rows)
+        return len(rows)
+
+    def load_table(self, table: str, chunks, total=None) -> dict:
+        """チャンクを concurrency 個ずつ並列に書き込む（生成は書き込みに合わせて進めるので、全件をメモリに載せない）"""
+        started = time.perf_counter()
+        with self.lock:
+            self.progress["table"] = table
+            self.progress["tables"][table] = {"rows": 0, "total": total, "seconds": 0.0, "rows_per_second": None}
+        stats = self.progress["tables"][table]
+
+        def done(futures):
+            for future in futures:
+                rows = future.result()
+                with self.lock:
+                    stats["rows"] += rows
+                    stats["seconds"] = time.perf_counter() - started
+                    stats["rows_per_second"] = stats["rows"] / stats["seconds"]
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            in_flight = set()
+            for rows in chunks:
+                if len(in_flight) >= self.concurrency * 2:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    done(finished)
+                in_flight.add(executor.submit(self.insert, table, rows))
+            done(wait(in_flight).done)
+        return dict(stats)
+
+    def load(self, data: SyntheticData) -> dict:
+        """users → user_attributes → likes の順に書き込む（外部キーの順）"""
+        with self.lock:
+            self.progress = {"state": "running", "users": data.n_users, "seed": data.seed, "table": None, "tables": {}, "error": None}
+        started = time.perf_counter()
+        try:
+            self.load_table("users", data.users(), data.n_users)
+            self.load_table("user_attributes", data.attributes(), data.n_users)
+            self.load_table("likes", data.likes())
+        except Exception as e:
+            with self.lock:
+                self.progress["state"] = "failed"
+                self.progress["error"] = str(e)
+            raise
+        finally:
+            invalidate_caches()
+            with self.lock:
+                self.progress["seconds"] = time.perf_counter() - started
+        with self.lock:
+            self.progress["state"] = "done"
+        return self.status()
+
+    def start(self, data: SyntheticData) -> bool:
+        """別スレッドで書き込みを始める（既に実行中なら False）"""
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+
+        def run():
+            try:
+                self.load(data)
+            except Exception:
+                pass  # エラーは progress に記録済み
+            finally:
+                with self.lock:
+                    self.running = False
+
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+    def status(self) -> dict:
+        with self.lock:
+            return {**self.progress, "tables": {table: dict(stats) for table, stats in self.progress.get("tables", {}).items()}}
+
+
+synthetic_loader = SyntheticLoader(repository)
+
+
+if __name__ == "__main__":
+    # API を通さずに書き込む場合: python synthetic_data.py 100000 [seed]
+    import sys
+
+    n_users = int(sys.argv[1])
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 42
+    loader = threading.Thread(target=synthetic_loader.load, args=(SyntheticData(n_users, seed),), daemon=True)
+    loader.start()
+    while loader.is_alive():
+        loader.join(5)
+        status = synthetic_loader.status()
+        table = status.get("table")
+        if table is not None:
+            stats = status["tables"][table]
+            print(f"{table}: {stats['rows']}/{stats['total'] or '?'} 行（{stats['rows_per_second'] or 0:.0f} 行/秒）")
+    print(synthetic_loader.status())
@@ -0,0 +1,21 @@
+import os
+import sys
+import pytest
+
+# テストは Supabase に繋がず、メモリ上の SQLite に架空データを入れて行う
+os.environ["DATA_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = ":memory:"
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# 架空データの人数
+N_USERS = 1000
+
+
+@pytest.fixture(scope="session")
+def synthetic_users():
+    """架空データを1回だけ書き込み、全ユーザーの属性の行を返す"""
+    from attribute_store import attribute_store
+    from synthetic_data import SyntheticData, synthetic_loader
+
+    synthetic_loader.load(SyntheticData(N_USERS, chunk_size=500))
+    return attribute_store.all()
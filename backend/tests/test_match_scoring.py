@@ -0,0 +1,35 @@
+import numpy as np
+from attribute_store import attribute_store
+from match_scoring import score_users, top_k_matches
+from routes.matching import calculate_match_score
+
+# 比べる対象のユーザー数
+N_TARGETS = 150
+
+
+def baseline_top_k(target_user: dict, other_users: list, k: int) -> list:
+    """変更前の /matching_result と同じく、1人ずつ calculate_match_score で計算して安定ソートする"""
+    results = [calculate_match_score(target_user, other_user) for other_user in other_users]
+    return sorted(results, key=lambda x: x["match_score"], reverse=True)[:k]
+
+
+def test_scores_match_baseline(synthetic_users):
+    """まとめて計算したマッチ度が、1人ずつ計算した値と 1e-5 以内で一致する"""
+    encoded, positions = attribute_store.encoded()
+    rows = [attribute_store.get(user_id) for user_id in encoded.user_ids]
+    for target_user in rows[:N_TARGETS]:
+        scores = score_users(target_user, encoded)
+        expected = [calculate_match_score(target_user, other_user)["match_score"] for other_user in rows]
+        assert np.allclose(np.round(scores, 2), expected, rtol=0, atol=1e-5)
+
+
+def test_top_k_order_matches_baseline(synthetic_users):
+    """上位 k 人と同点の並び順が、変更前の実装と同じになる"""
+    encoded, positions = attribute_store.encoded()
+    rows = [attribute_store.get(user_id) for user_id in encoded.user_ids]
+    for target_user in rows[:N_TARGETS]:
+        row = positions[target_user["user_id"]]
+        others = rows[:row] + rows[row + 1:]
+        for k in (5, 50):
+            matches = top_k_matches(encoded.user_ids, score_users(target_user, encoded), k, exclude=[row])
+            assert matches == baseline_top_k(target_user, others, k)
@@ -0,0 +1,83 @@
+import json
+import pytest
+from attribute_store import attribute_store
+from hobby_similarity import HOBBY_VALUES
+from repository import repository
+from recommendations import compute_top_k, precompute_recommendations, top_k_lists, update_recommendations_for_user
+
+K = 5
+NEW_USER_ID = "7e570000-0000-4000-8000-000000000001"
+
+
+def execute(sql: str, params=()):
+    with repository.lock:
+        repository.connection.execute(sql, params)
+        repository.connection.commit()
+
+
+def apply_change(user_id: str, change):
+    """属性を書き換えてから、ルートと同じ手順でスナップショットとおすすめに反映する"""
+    changes_before = attribute_store.changes
+    change()
+    attribute_store.refresh_user(user_id)
+    return update_recommendations_for_user(user_id, changes_before)
+
+
+def assert_same_as_full_recompute():
+    """差分更新した後のおすすめが、全件を計算し直した結果と一致する"""
+    encoded, _ = attribute_store.encoded()
+    expected = compute_top_k(encoded, K)
+    assert top_k_lists.lists == expected
+    assert top_k_lists.is_fresh()
+    for user_id in list(expected)[:20]:
+        stored = [(row["target_user_id"], row["match_score"]) for row in repository.recommendations(user_id, K)]
+        assert stored == [(match["user_id"], match["match_score"]) for match in expected[user_id]]
+
+
+@pytest.fixture
+def recommendations(synthetic_users):
+    precompute_recommendations(k=K)
+    return synthetic_users
+
+
+def test_update_matches_full_recompute(recommendations):
+    """プロフィール更新（他のユーザーと同じ属性・趣味にする）を差分で反映する"""
+    for user, source in [(recommendations[3], recommendations[4]), (recommendations[17], recommendations[400])]:
+        def change():
+            execute(
+                "UPDATE user_attributes SET hometown = ?, field = ?, role = ?, mbti = ?, alma_mater = ?, hobby_ids = ? WHERE user_id = ?",
+                (source["hometown"], source["field"], source["role"], source["mbti"], source["alma_mater"],
+                 json.dumps(source["hobby_ids"]), user["user_id"]),
+            )
+        assert apply_change(user["user_id"], change)["changed_users"] > 0
+        assert_same_as_full_recompute()
+
+
+def test_new_user_matches_full_recompute(recommendations):
+    """新規登録したユーザーを差分で反映する"""
+    source = recommendations[10]
+
+    def change():
+        repository.insert_users([{
+            "id": NEW_USER_ID, "name": "新規 ユーザー", "email": "new@example.com",
+            "slack_id": "SNEWUSER", "password": "x", "created_at": "2024-04-01",
+        }])
+        repository.insert_attributes([{
+            "user_id": NEW_USER_ID,
+            "hobbies": ", ".join(HOBBY_VALUES[hobby_id] for hobby_id in source["hobby_ids"]),
+            **{column: source[column] for column in ("hometown", "field", "role", "mbti", "alma_mater", "preferences")},
+            "self_introductions": "",
+        }])
+
+    apply_change(NEW_USER_ID, change)
+    assert NEW_USER_ID in top_k_lists.lists
+    assert_same_as_full_recompute()
+
+
+def test_deleted_user_matches_full_recompute(recommendations):
+    """削除したユーザーを、そのユーザーを含んでいたおすすめから外す"""
+    user_id = recommendations[5]["user_id"]
+    apply_change(user_id, lambda: execute("DELETE FROM user_attributes WHERE user_id = ?", (user_id,)))
+    assert user_id not in top_k_lists.lists
+    assert all(match["user_id"] != user_id for matches in top_k_lists.lists.values() for match in matches)
+    assert_same_as_full_recompute()
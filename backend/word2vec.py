@@ -1,23 +1,91 @@
-import gensim
+import os
+import sys
+import time
 import numpy as np
 
-# Word2Vecモデルの読み込み(https://www.cl.ecei.tohoku.ac.jp/~m-suzuki/jawiki_vector/)
-word2vec_model = gensim.models.KeyedVectors.load_word2vec_format('./entity_vector.model.bin', binary=True)
-
-# 確認する趣味の単語リスト
-hobbies = [
-    "サッカー", "バスケットボール", "野球", "ランニング", "旅行", "映画鑑賞", "アニメ", "漫画", "ゲーム", "カフェ", 
-    "読書", "音楽", "カメラ", "キャンプ", "筋トレ", "料理", "プログラミング", "ボードゲーム", "ダンス", "登山", 
-    "温泉", "釣り", "DIY", "ガーデニング", "スポーツ観戦", "イラスト", "手芸", "ラーメン", "居酒屋", "ボランティア"
-]
-
-# 単語ベクトルを取得し、辞書に格納
-vectors = {}
-for word in hobbies:
-    if word in word2vec_model:
-        vectors[word] = word2vec_model[word]
-    else:
-        print(f'"{word}" はモデルに含まれていません。')
-
-# ベクトルを圧縮保存
-np.savez_compressed("hobby_vectors.npz", **vectors)
\ No newline at end of file
+# word2vec のバイナリ形式のファイル(https://www.cl.ecei.tohoku.ac.jp/~m-suzuki/jawiki_vector/)から、
+# 語彙ファイルに書いた単語のベクトルだけを取り出して保存する
+#   python word2vec.py [entity_vector.model.bin] [hobby_vocab.txt] [hobby_vectors]
+#
+# gensim でモデル全体を読み込むと数分かかり、メモリも数GB使うので、ファイルを先頭から順に読みながら
+# 必要な単語だけを拾う（全部見つかった時点で読むのをやめる）
+#
+# 出力（hobby_similarity.py が起動時に読み込む）
+#   hobby_vectors.npy:       正規化済みの float32 の行列（語彙ファイルの順番、見つからなかった単語は除く）
+#                            np.load(mmap_mode="r") でコピーせずに読み込める
+#   hobby_vectors.vocab.txt: 行列の各行の単語（1行に1単語）
+
+# 一度に読み込むバイト数
+READ_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+def read_vocab(path: str) -> list:
+    """語彙ファイル（1行に1単語、空行と重複は無視）を読み込む"""
+    with open(path, encoding="utf-8") as f:
+        return list(dict.fromkeys(line.strip() for line in f if line.strip()))
+
+
+def extract_vectors(model_path: str, words: list) -> tuple:
+    """モデルファイルを先頭から読み、words のベクトルを返す（見つかった単語のリスト, 行列）"""
+    wanted = {word.encode("utf-8"): row for row, word in enumerate(words)}
+    with open(model_path, "rb") as f:
+        # 1行目は「単語数 次元数」
+        n_words, dim = map(int, f.readline().split())
+        vector_bytes = dim * 4
+        vectors = np.zeros((len(words), dim), dtype=np.float32)
+        found = np.zeros(len(words), dtype=bool)
+
+        # 各単語は「単語 + 空白 + float32 × dim」（ベクトルの後に改行が入るファイルもある）
+        buffer = b""
+        position = 0
+        remaining = len(wanted)
+        for _ in range(n_words):
+            while True:
+                space = buffer.find(b" ", position)
+                if space >= 0 and len(buffer) - space - 1 >= vector_bytes:
+                    break
+                chunk = f.read(READ_CHUNK_BYTES)
+                if not chunk:
+                    raise ValueError(f"{model_path} ends before {n_words} words")
+                buffer = buffer[position:] + chunk
+                position = 0
+
+            row = wanted.get(buffer[position:space].lstrip(b"\n"))
+            if row is not None and not found[row]:
+                vectors[row] = np.frombuffer(buffer, dtype="<f4", count=dim, offset=space + 1)
+                found[row] = True
+                remaining -= 1
+                if remaining == 0:
+                    break
+            position = space + 1 + vector_bytes
+
+    return [word for word, ok in zip(words, found) if ok], vectors[found]
+
+
+def save_vectors(output_prefix: str, words: list, vectors: np.ndarray):
+    """正規化して .npy と語彙の一覧を保存する（書き終わってから差し替えるので、読み込み中の API には影響しない）"""
+    norms = np.linalg.norm(vectors.astype(np.float64), axis=1, keepdims=True)
+    normalized = (vectors / np.where(norms > 0, norms, 1.0)).astype(np.float32)
+
+    for path, write in [
+        (output_prefix + ".npy", lambda f: np.save(f, normalized)),
+        (output_prefix + ".vocab.txt", lambda f: f.write("".join(word + "\n" for word in words).encode("utf-8"))),
+    ]:
+        with open(path + ".tmp", "wb") as f:
+            write(f)
+        os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    model_path = sys.argv[1] if len(sys.argv) > 1 else "./entity_vector.model.bin"
+    vocab_path = sys.argv[2] if len(sys.argv) > 2 else "hobby_vocab.txt"
+    output_prefix = sys.argv[3] if len(sys.argv) > 3 else "hobby_vectors"
+
+    started = time.perf_counter()
+    words = read_vocab(vocab_path)
+    found, vectors = extract_vectors(model_path, words)
+    for word in words:
+        if word not in found:
+            print(f'"{word}" はモデルに含まれていません。')
+    save_vectors(output_prefix, found, vectors)
+    print(f"{len(found)}/{len(words)} 語を {output_prefix}.npy に保存しました（{time.perf_counter() - started:.1f} 秒）")